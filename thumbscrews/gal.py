@@ -0,0 +1,564 @@
+import csv
+import io
+import itertools
+import json
+import re
+import sqlite3
+import string
+
+from exchangelib.errors import ErrorInvalidOperation, ErrorInvalidRequest, ErrorInvalidServerVersion
+from exchangelib.errors import ErrorInvalidSchemaVersionForMailboxVersion, ErrorSchemaValidation
+from exchangelib.fields import FieldPath
+from exchangelib.items import ID_ONLY, SHALLOW, Persona
+from exchangelib.services import FindPeople, ResolveNames
+from exchangelib.services.common import shape_element
+from exchangelib.util import MNS, TNS, create_element
+
+from thumbscrews.mailbox import BUFFER_SIZE
+from thumbscrews.pool import imap_bounded
+
+EMAIL_REGEX = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+
+# the most entries FindPeople hands out per page
+PEOPLE_PAGE_SIZE = 1000
+# what FindPeople is asked for on every entry
+PEOPLE_FIELDS = ('display_name', 'email_address')
+# and the fields the typed records are filled from
+PEOPLE_RECORD_FIELDS = PEOPLE_FIELDS + ('given_name', 'surname', 'title', 'department', 'company_name',
+                                        'office_locations', 'business_phone_numbers', 'mobile_phones')
+# errors meaning the server can not read the GAL with FindPeople, before Exchange 2013 it does not know it
+# and exchangelib gives up with ErrorInvalidSchemaVersionForMailboxVersion after trying every version
+PEOPLE_ERRORS = (NotImplementedError, ErrorInvalidServerVersion, ErrorInvalidRequest, ErrorInvalidOperation,
+                 ErrorSchemaValidation, ErrorInvalidSchemaVersionForMailboxVersion)
+
+# the columns of a typed GAL record, in the order they are written
+RECORD_FIELDS = ('email_address', 'name', 'first_name', 'last_name', 'title', 'department', 'company', 'office',
+                 'phone', 'mobile')
+# what typed GAL records can be written as
+RECORD_FORMATS = ('csv', 'jsonl')
+
+# characters always tried at each level of an adaptive walk, on top of those seen in a full page
+ADAPTIVE_ALPHABET = string.ascii_lowercase + string.digits
+# give up expanding a prefix once it is this long
+MAX_PREFIX_LENGTH = 6
+
+
+def prefixes(length=2):
+    """
+        Return the fixed list of search prefixes, "aa" to "zz" by default.
+        :param length:
+        :return:
+    """
+
+    return [''.join(x) for x in itertools.product(string.ascii_lowercase, repeat=length)]
+
+
+class QuietResolveNames(ResolveNames):
+    """
+        ResolveNames without the warning exchangelib gives for every
+        lookup that hits the candidate limit. The adaptive walk looks
+        for full pages itself to dig deeper into them, so there it is
+        noise. Warning filters are process wide, so it is left out here
+        rather than filtered, which would hide it for everything else
+        running in the same process.
+    """
+
+    def _get_element_container(self, message, name=None):
+        # skip the override of ResolveNames, all it adds is the warning
+        return super(ResolveNames, self)._get_element_container(message=message, name=name)
+
+
+def resolve(protocol, entry, full=False, quiet=False):
+    """
+        Run a single ResolveNames lookup and return all of its results.
+        Each call gets its own service instance so lookups can run
+        from several threads over the same protocol session pool.
+        :param protocol:
+        :param entry:
+        :param full:
+        :param quiet:
+        :return:
+    """
+
+    service = QuietResolveNames if quiet else ResolveNames
+    return list(service(protocol).call(unresolved_entries=(entry,), return_full_contact_data=full))
+
+
+def addresses(names):
+    """
+        Scrape every email address out of a ResolveNames result.
+        :param names:
+        :return:
+    """
+
+    return EMAIL_REGEX.findall(str(names))
+
+
+def first(values):
+    """
+        Return the first value that is set, None if there is none.
+        :param values:
+        :return:
+    """
+
+    return next((v for v in values if v), None)
+
+
+class GalRecord(object):
+    """
+        One GAL entry, read straight from the fields of a ResolveNames
+        Mailbox and Contact, or of a FindPeople Persona, instead of
+        scraping addresses out of their string form. Slots keep the
+        records of a big directory small.
+    """
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, **values):
+        for field in RECORD_FIELDS:
+            setattr(self, field, values.get(field))
+
+    def __repr__(self):
+        return f'GalRecord({self.name!r}, {self.email_address!r})'
+
+    @classmethod
+    def from_resolution(cls, result):
+        """
+            Make a record out of a ResolveNames result, a Mailbox or with
+            full contact data a (Mailbox, Contact) tuple.
+            :param result:
+            :return:
+        """
+
+        mailbox, contact = result if isinstance(result, tuple) else (result, None)
+        record = cls(email_address=getattr(mailbox, 'email_address', None), name=getattr(mailbox, 'name', None))
+        if contact is None:
+            return record
+
+        phones = {p.label: p.phone_number for p in contact.phone_numbers or ()}
+        record.name = contact.display_name or record.name
+        record.first_name = contact.given_name
+        record.last_name = contact.surname
+        record.title = contact.job_title
+        record.department = contact.department
+        record.company = contact.company_name
+        record.office = contact.office
+        record.phone = first((phones.get('BusinessPhone'), phones.get('PrimaryPhone')))
+        record.mobile = phones.get('MobilePhone')
+        return record
+
+    @classmethod
+    def from_persona(cls, elem):
+        """
+            Make a record out of a FindPeople <t:Persona> element. Only
+            the fields that were asked for are read, which is a lot less
+            work than parsing a whole Persona.
+            :param elem:
+            :return:
+        """
+
+        def text(*path):
+            return elem.findtext('/'.join(f'{{{TNS}}}{tag}' for tag in path))
+
+        return cls(
+            email_address=text('EmailAddress', 'EmailAddress'),
+            name=text('DisplayName'),
+            first_name=text('GivenName'),
+            last_name=text('Surname'),
+            title=text('Title'),
+            department=text('Department'),
+            company=text('CompanyName'),
+            office=text('OfficeLocations', 'StringAttributedValue', 'Value'),
+            phone=text('BusinessPhoneNumbers', 'PhoneNumberAttributedValue', 'Value', 'Number'),
+            mobile=text('MobilePhones', 'PhoneNumberAttributedValue', 'Value', 'Number'),
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**dict(zip(RECORD_FIELDS, row)))
+
+    def row(self):
+        """
+            Return the record as a list in RECORD_FIELDS order, which is
+            also how it is kept in a progress journal.
+            :return:
+        """
+
+        return [getattr(self, field) for field in RECORD_FIELDS]
+
+
+class RecordWriter(object):
+    """
+        Writes GAL records to a file as CSV or JSONL. Records are
+        rendered into a buffer that is written out once it holds
+        buffer_size characters, rather than one write per record.
+    """
+
+    def __init__(self, f, fmt='csv', buffer_size=BUFFER_SIZE):
+        self.f = f
+        self.fmt = fmt
+        self.buffer_size = buffer_size
+        self.buffer = io.StringIO()
+        self.count = 0
+        self.csv = csv.writer(self.buffer) if fmt == 'csv' else None
+        if self.csv is not None:
+            self.csv.writerow(RECORD_FIELDS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, record):
+        self.count += 1
+        if self.csv is not None:
+            self.csv.writerow(record.row())
+        else:
+            self.buffer.write(json.dumps(dict(zip(RECORD_FIELDS, record.row()))) + '\n')
+
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.f.write(self.buffer.getvalue())
+        self.f.flush()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        """
+            Write out what is left in the buffer. The file itself is the
+            caller's to close.
+            :return:
+        """
+
+        self.flush()
+
+
+def normalise(names):
+    """
+        Return the key used to spot duplicate GAL results, the lowercased
+        email address for mailboxes and the stripped string otherwise.
+        :param names:
+        :return:
+    """
+
+    address = getattr(names, 'email_address', None) or str(names)
+    return address.strip().lower()
+
+
+def is_full(results):
+    """
+        Check if a ResolveNames lookup hit the server's candidate limit,
+        meaning there are more matches than were returned.
+        :param results:
+        :return:
+    """
+
+    found = [r for r in results if not isinstance(r, Exception)]
+    return len(found) >= ResolveNames.candidates_limit
+
+
+def lookup(protocol, entry, full=False, records=False, quiet=False):
+    """
+        Resolve a prefix and reduce the results to what gets printed,
+        a dict with the output 'lines' and whether the page was 'full'.
+        Unlike the raw results this can be kept in a progress journal.
+        With records the lines are GalRecord rows, which need the full
+        contact data. quiet leaves out the warning about full pages.
+        :param protocol:
+        :param entry:
+        :param full:
+        :param records:
+        :param quiet:
+        :return:
+    """
+
+    return summarise(resolve(protocol, entry, full=full or records, quiet=quiet), full, records)
+
+
+async def alookup(engine, entry, full=False, records=False, quiet=False):
+    """
+        lookup() for the async engine.
+        :param engine:
+        :param entry:
+        :param full:
+        :param records:
+        :param quiet:
+        :return:
+    """
+
+    service = QuietResolveNames if quiet else ResolveNames
+    return summarise(await engine.resolve_names(entry, full=full or records, service=service), full, records)
+
+
+def summarise(results, full=False, records=False):
+    """
+        Reduce ResolveNames results to the dict lookup() returns.
+        :param results:
+        :param full:
+        :param records:
+        :return:
+    """
+
+    if records:
+        lines = [GalRecord.from_resolution(names).row() for names in results if not isinstance(names, Exception)]
+    elif full:
+        lines = [i for names in results for i in addresses(names)]
+    else:
+        lines = [str(names) for names in results]
+
+    summary = {'lines': lines, 'full': is_full(results)}
+    if summary['full']:
+        summary['next'] = next_characters(results)
+    return summary
+
+
+def next_characters(results):
+    """
+        Return every character, lowercased, in the names and address
+        local parts of ResolveNames results. Besides ADAPTIVE_ALPHABET
+        this is what a full page says the directory holds, like accents,
+        dots and dashes. Whitespace is left out, the server strips it
+        off the end of a prefix.
+        :param results:
+        :return:
+    """
+
+    found = set()
+    for result in results:
+        if isinstance(result, Exception):
+            continue
+        record = GalRecord.from_resolution(result)
+        local_part = (record.email_address or '').partition('@')[0]
+        for text in (local_part, record.name, record.first_name, record.last_name):
+            found.update(c for c in (text or '').lower() if not c.isspace())
+
+    return ''.join(sorted(found))
+
+
+class FindPeoplePages(FindPeople):
+    """
+        FindPeople against an address list, like the GAL, instead of a
+        contacts folder, paging through the whole view. exchangelib's
+        FindPeople only asks for the first page.
+
+        The folder it is called with is a (tag, id) tuple naming the
+        target, ('AddressListId', guid) or ('DistinguishedFolderId',
+        'directory'). Entries come back as GalRecords.
+    """
+
+    def _elem_to_obj(self, elem):
+        return GalRecord.from_persona(elem)
+
+    def get_payload(self, folders, additional_fields, restriction, order_fields, query_string, shape, depth,
+                    page_size, offset=0):
+        payload = create_element(f'm:{self.SERVICE_NAME}')
+        payload.append(shape_element(tag='m:PersonaShape', shape=shape, additional_fields=additional_fields,
+                                     version=self.account.version))
+        payload.append(create_element('m:IndexedPageItemView',
+                                      attrs=dict(MaxEntriesReturned=page_size, Offset=offset, BasePoint='Beginning')))
+        parent = create_element('m:ParentFolderId')
+        for tag, target_id in folders:
+            parent.append(create_element(f't:{tag}', attrs=dict(Id=target_id)))
+        payload.append(parent)
+        if query_string:
+            query = create_element('m:QueryString')
+            query.text = query_string
+            payload.append(query)
+        return payload
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # number of entries in the view, known once a page came back
+        self.total = None
+
+    def _get_paging_values(self, elem):
+        total = int(elem.find(f'{{{MNS}}}TotalNumberOfPeopleInView').text)
+        first_loaded = int(elem.find(f'{{{MNS}}}FirstLoadedRowIndex').text)
+        people = elem.find(f'{{{MNS}}}People')
+        next_offset = first_loaded + (len(people) if people is not None else 0)
+        self.total = total
+        # an empty page would ask for the same one again
+        return total, next_offset if first_loaded < next_offset < total else None
+
+
+def people_page(account, offset, address_list=None, query=None, page_size=PEOPLE_PAGE_SIZE, full=False,
+                records=False):
+    """
+        Read the page_size entries of an address list that start at
+        offset and reduce them to what gets printed, like lookup() does
+        for a prefix: a dict with the output 'lines' and the 'total'
+        number of entries in the view, so it can be kept in a progress
+        journal. Lines are email addresses with full and GalRecord rows
+        otherwise. Entries without an address, like some contacts, are
+        skipped. Without an address list the directory is searched,
+        which the server may want a query for.
+        Raises one of PEOPLE_ERRORS when the server has no FindPeople.
+        :param account:
+        :param offset:
+        :param address_list:
+        :param query:
+        :param page_size:
+        :param full:
+        :param records:
+        :return:
+    """
+
+    target = ('AddressListId', address_list) if address_list else ('DistinguishedFolderId', 'directory')
+    fields = PEOPLE_RECORD_FIELDS if records else PEOPLE_FIELDS
+    additional_fields = {FieldPath(field=Persona.get_field_by_fieldname(f)) for f in fields}
+
+    svc = FindPeoplePages(account=account, page_size=page_size)
+    lines = []
+    for record in svc.call(folder=target, additional_fields=additional_fields, restriction=None,
+                           order_fields=None, shape=ID_ONLY, query_string=query, depth=SHALLOW, max_items=page_size,
+                           offset=offset):
+        if isinstance(record, Exception):
+            raise record
+        if record.email_address:
+            lines.append(record.email_address if full and not records else record.row())
+
+    return {'lines': lines, 'total': svc.total or 0}
+
+
+def people(page, page_size=PEOPLE_PAGE_SIZE, workers=1, imap=imap_bounded):
+    """
+        Yield (offset, result) tuples for every page of an address list
+        as they are read. The first page tells how many entries there
+        are, the others are then read `workers` at a time through imap.
+        The page function must take an offset and return a dict like
+        people_page() does.
+        :param page:
+        :param page_size:
+        :param workers:
+        :param imap:
+        :return:
+    """
+
+    rest = ()
+    for offset, result in imap(page, [0], workers):
+        yield offset, result
+        rest = range(page_size, result['total'], page_size)
+    yield from imap(page, rest, workers)
+
+
+def walk(lookup, workers=1, alphabet=ADAPTIVE_ALPHABET, max_length=MAX_PREFIX_LENGTH, imap=imap_bounded):
+    """
+        Walk the prefix trie breadth first, yielding (entry, results)
+        tuples as lookups finish.
+
+        Only prefixes that come back with a full page of candidates are
+        expanded by another character, every one of alphabet and any
+        other the page's 'next' holds. Empty and partial pages are
+        complete, so their branches are never searched any further.
+        The lookup must return a dict like lookup() does. A prefix that
+        is still full at max_length is yielded as is, see truncated().
+        Each level is run through imap, imap_bounded unless the async
+        engine's is given.
+        :param lookup:
+        :param workers:
+        :param alphabet:
+        :param max_length:
+        :param imap:
+        :return:
+    """
+
+    level = list(alphabet)
+    while level:
+        expand = []
+        for entry, results in imap(lookup, level, workers):
+            if len(entry) < max_length and results['full']:
+                # journals of older runs have no 'next'
+                expand.append((entry, ''.join(sorted(set(alphabet).union(results.get('next', ''))))))
+            yield entry, results
+        level = [entry + c for entry, characters in sorted(expand) for c in characters]
+
+
+def truncated(entry, results, max_length=MAX_PREFIX_LENGTH):
+    """
+        Check if walk() stopped at a prefix that still had more entries
+        than the server returned, which are then missing from the dump.
+        :param entry:
+        :param results:
+        :param max_length:
+        :return:
+    """
+
+    return len(entry) >= max_length and results['full']
+
+
+class AddressIndex(object):
+    """
+        The set of normalised addresses already emitted by a GAL dump.
+        When given a path the set is also kept in a sqlite file, so a
+        later run against the same directory only emits new entries.
+    """
+
+    # number of new addresses to buffer before writing them to the index file
+    FLUSH_SIZE = 500
+
+    def __init__(self, path=None):
+        self.seen = set()
+        self.pending = []
+        self.db = None
+
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS addresses (address TEXT PRIMARY KEY)')
+            self.seen.update(row[0] for row in self.db.execute('SELECT address FROM addresses'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.seen)
+
+    def add(self, names):
+        """
+            Record a result, returning True if it was not seen before.
+            :param names:
+            :return:
+        """
+
+        key = normalise(names)
+        if key in self.seen:
+            return False
+
+        self.seen.add(key)
+        if self.db is not None:
+            self.pending.append((key,))
+            if len(self.pending) >= self.FLUSH_SIZE:
+                self.flush()
+
+        return True
+
+    def flush(self):
+        """
+            Write buffered addresses to the index file.
+            :return:
+        """
+
+        if self.db is None or not self.pending:
+            return
+
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO addresses (address) VALUES (?)', self.pending)
+        self.pending = []
+
+    def close(self):
+        """
+            Flush and close the index file.
+            :return:
+        """
+
+        if self.db is None:
+            return
+
+        self.flush()
+        self.db.close()
+        self.db = None
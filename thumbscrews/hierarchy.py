@@ -0,0 +1,243 @@
+import collections
+import os
+from fnmatch import fnmatch
+
+import exchangelib.folders
+from exchangelib.errors import ErrorInvalidSyncStateData
+from exchangelib.fields import FieldPath
+from exchangelib.folders import Folder, FolderCollection
+from exchangelib.items import ID_ONLY
+from exchangelib.properties import ParentFolderId
+from exchangelib.services import SyncFolderHierarchy
+
+from thumbscrews.store import STATE_DIR, JsonStore
+from thumbscrews.tbestate import tbestate
+
+# where the folder hierarchy of every mailbox is kept between runs
+HIERARCHY_PATH = os.path.join(STATE_DIR, 'folders.json')
+# enough to name, place and type every folder
+HIERARCHY_FIELDS = ('name', 'folder_class', 'parent_folder_id')
+
+
+def hierarchy_key(account):
+    """
+        Return the key the hierarchy of a mailbox is stored under. What
+        a delegate can see of a mailbox depends on who they are, so the
+        user is part of it.
+        :param account:
+        :return:
+    """
+
+    return '{0}|{1}'.format((tbestate.username or '').lower(), account.primary_smtp_address.lower())
+
+
+def folder_record(folder):
+    """
+        Return what is kept of a folder to place it in the hierarchy.
+        :param folder:
+        :return:
+    """
+
+    return {
+        'changekey': folder.changekey,
+        'parent': folder.parent_folder_id.id if folder.parent_folder_id else None,
+        'name': folder.name,
+        'folder_class': folder.folder_class,
+        'class': type(folder).__name__,
+    }
+
+
+def sync_hierarchy(root, sync_state=None):
+    """
+        Walk the changes to the folders below root since sync_state with
+        SyncFolderHierarchy, yielding (changes, sync_state) for every
+        page. Without a sync state every folder comes back as created.
+        :param root:
+        :param sync_state:
+        :return:
+    """
+
+    # a plain Folder with the id of the root, so changes are parsed as the folder classes they are
+    # instead of as more roots
+    top = Folder(root=root, id=root.id, changekey=root.changekey)
+    additional_fields = {FieldPath(field=Folder.get_field_by_fieldname(f)) for f in HIERARCHY_FIELDS}
+
+    svc = SyncFolderHierarchy(account=root.account)
+    while True:
+        changes = list(svc.call(folder=top, shape=ID_ONLY, additional_fields=additional_fields,
+                                sync_state=sync_state))
+        for change in changes:
+            if isinstance(change, Exception):
+                raise change
+        # the server sometimes hands back the same state without flagging the last page
+        done = svc.includes_last_item_in_range or svc.sync_state == sync_state
+        sync_state = svc.sync_state
+        yield changes, sync_state
+        if done:
+            break
+
+
+class FolderHierarchy(object):
+    """
+        The folder hierarchy of a mailbox, cached on disk and kept
+        current with SyncFolderHierarchy.
+
+        The first run fetches every folder in one sync, later runs only
+        fetch what changed since. Globbing and tree printing then work
+        from the cache, where exchangelib would walk the mailbox with
+        FindFolder and GetFolder on every run. The folders are handed to
+        the account's root as well, so folder.parent and folder.absolute
+        need no requests either. A root that was already fetched can be
+        passed in instead of the account's.
+    """
+
+    def __init__(self, account, store=None, root=None):
+        self.account = account
+        self.store = store
+        self.root = root or account.root
+        self.folders = {self.root.id: self.root}
+        self.parents = {}
+        self.children = collections.defaultdict(list)
+
+    def load(self, refresh=False):
+        """
+            Bring the cached hierarchy up to date with the server.
+            :param refresh:
+            :return:
+        """
+
+        key = hierarchy_key(self.account)
+        entry = self.store.get(key) if self.store is not None and not refresh else None
+        if not entry or entry.get('root') != self.root.id:
+            entry = {'root': self.root.id, 'sync_state': None, 'folders': {}}
+
+        records, sync_state, changed = entry['folders'], entry['sync_state'], False
+        try:
+            for changes, sync_state in sync_hierarchy(self.root, sync_state):
+                for change_type, folder in changes:
+                    changed = True
+                    if change_type == 'delete':
+                        records.pop(folder.id, None)
+                    else:
+                        records[folder.id] = folder_record(folder)
+        except ErrorInvalidSyncStateData:
+            # the server no longer knows our state, start over
+            if not entry['sync_state']:
+                raise
+            return self.load(refresh=True)
+
+        if self.store is not None and (changed or sync_state != entry['sync_state']):
+            self.store.put(key, {'root': self.root.id, 'sync_state': sync_state, 'folders': records})
+
+        self.build(records)
+        return self
+
+    def build(self, records):
+        """
+            Make folders out of the cached records.
+            :param records:
+            :return:
+        """
+
+        for folder_id, record in records.items():
+            cls = getattr(exchangelib.folders, record['class'], None)
+            if not isinstance(cls, type) or not issubclass(cls, Folder):
+                cls = Folder
+            parent = ParentFolderId(id=record['parent'], changekey=None) if record['parent'] else None
+            self.folders[folder_id] = cls(root=self.root, id=folder_id, changekey=record['changekey'],
+                                          name=record['name'], folder_class=record['folder_class'],
+                                          parent_folder_id=parent)
+
+        for folder_id, folder in self.folders.items():
+            parent_id = folder.parent_folder_id.id if getattr(folder, 'parent_folder_id', None) else None
+            # some folders name themselves as their parent
+            if parent_id in self.folders and parent_id != folder_id:
+                self.parents[folder_id] = parent_id
+                self.children[parent_id].append(folder)
+
+        for children in self.children.values():
+            children.sort(key=lambda f: f.name or '')
+
+        # exchangelib fills this on first use with a FindFolder walk of the whole mailbox
+        self.root._subfolders = dict(self.folders)
+
+    def walk(self, folder):
+        """
+            Yield every folder below a folder, parents first.
+            :param folder:
+            :return:
+        """
+
+        for child in self.children.get(folder.id, ()):
+            yield child
+            yield from self.walk(child)
+
+    def glob(self, pattern, folder=None):
+        """
+            Return the folders matching a pattern as a FolderCollection,
+            the same as exchangelib's folder.glob().
+            :param pattern:
+            :param folder:
+            :return:
+        """
+
+        return FolderCollection(account=self.account, folders=list(self._glob(folder or self.root, pattern)))
+
+    def _glob(self, folder, pattern):
+        head, _, tail = pattern.partition('/')
+        tail = tail if '/' in pattern else None
+
+        if head == '':
+            # an absolute path, start again at the root
+            yield from self._glob(self.root, tail or '*')
+        elif head == '..':
+            parent_id = self.parents.get(folder.id)
+            if parent_id is None:
+                raise ValueError('Already at top')
+            yield from self._glob(self.folders[parent_id], tail or '*')
+        elif head == '**':
+            # anything at any depth below here, folder names are not case sensitive in Exchange
+            for child in self.walk(folder):
+                if fnmatch((child.name or '').lower(), (tail or '*').lower()):
+                    yield child
+        else:
+            for child in self.children.get(folder.id, ()):
+                if not fnmatch((child.name or '').lower(), head.lower()):
+                    continue
+                if tail is None:
+                    yield child
+                else:
+                    yield from self._glob(child, tail)
+
+    def tree(self, folder=None):
+        """
+            Return the folders below a folder drawn as a tree, the same as
+            exchangelib's folder.tree().
+            :param folder:
+            :return:
+        """
+
+        folder = folder or self.root
+        lines = [folder.name or '']
+        self._tree(folder, '', lines)
+        return '\n'.join(lines).strip()
+
+    def _tree(self, folder, prefix, lines):
+        children = self.children.get(folder.id, ())
+        for i, child in enumerate(children, start=1):
+            last = i == len(children)
+            lines.append(f'{prefix}{"└── " if last else "├── "}{child.name}')
+            self._tree(child, prefix + ('    ' if last else '│   '), lines)
+
+
+def get_hierarchy(account, refresh=False):
+    """
+        Return the up to date folder hierarchy of an account. It is only
+        kept on disk while the config cache is on.
+        :param account:
+        :param refresh:
+        :return:
+    """
+
+    store = JsonStore(HIERARCHY_PATH) if tbestate.cache else None
+    return FolderHierarchy(account, store).load(refresh)
@@ -0,0 +1,187 @@
+import os
+import sqlite3
+
+from thumbscrews.mailbox import address
+from thumbscrews.store import STATE_DIR
+
+# where harvested mail is indexed unless told otherwise
+INDEX_PATH = os.path.join(STATE_DIR, 'mail.db')
+# the fields that make up the recipients column
+RECIPIENT_FIELDS = ('to_recipients', 'cc_recipients', 'bcc_recipients')
+# fetched on top of what a command prints when it also indexes
+INDEX_FIELDS = ('datetime_received',) + RECIPIENT_FIELDS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mails (
+    id TEXT PRIMARY KEY,
+    mailbox TEXT,
+    folder TEXT,
+    received TEXT,
+    subject TEXT,
+    sender TEXT,
+    recipients TEXT,
+    attachments TEXT,
+    body TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS mails_fts USING fts5(
+    subject, sender, recipients, attachments, body, content='mails', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS mails_ai AFTER INSERT ON mails BEGIN
+    INSERT INTO mails_fts(rowid, subject, sender, recipients, attachments, body)
+    VALUES (new.rowid, new.subject, new.sender, new.recipients, new.attachments, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS mails_ad AFTER DELETE ON mails BEGIN
+    INSERT INTO mails_fts(mails_fts, rowid, subject, sender, recipients, attachments, body)
+    VALUES ('delete', old.rowid, old.subject, old.sender, old.recipients, old.attachments, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS mails_au AFTER UPDATE ON mails BEGIN
+    INSERT INTO mails_fts(mails_fts, rowid, subject, sender, recipients, attachments, body)
+    VALUES ('delete', old.rowid, old.subject, old.sender, old.recipients, old.attachments, old.body);
+    INSERT INTO mails_fts(rowid, subject, sender, recipients, attachments, body)
+    VALUES (new.rowid, new.subject, new.sender, new.recipients, new.attachments, new.body);
+END;
+'''
+
+# a field that was not fetched this time keeps what an earlier fetch stored
+UPSERT = '''
+INSERT INTO mails (id, mailbox, folder, received, subject, sender, recipients, attachments, body)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    mailbox = excluded.mailbox,
+    folder = coalesce(excluded.folder, folder),
+    received = coalesce(excluded.received, received),
+    subject = coalesce(excluded.subject, subject),
+    sender = coalesce(excluded.sender, sender),
+    recipients = coalesce(excluded.recipients, recipients),
+    attachments = coalesce(excluded.attachments, attachments),
+    body = coalesce(excluded.body, body)
+'''
+
+
+class MailIndex(object):
+    """
+        A local SQLite full-text index of harvested mail.
+
+        Headers, text bodies and attachment names of fetched mails are
+        kept in an FTS5 table, so search terms can be tried over and over
+        against an already collected mailbox without going back to the
+        server.
+    """
+
+    # commit after this many changes
+    FLUSH_SIZE = 500
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM mails').fetchone()[0]
+
+    def add(self, item, mailbox, folder=None):
+        """
+            Index a mail, replacing an earlier copy of it.
+            Fields that were not fetched are left as they were.
+            :param item:
+            :param mailbox:
+            :param folder:
+            :return:
+        """
+
+        def get(field):
+            return getattr(item, field, None)
+
+        received = get('datetime_received')
+        recipients = [r for field in RECIPIENT_FIELDS for r in get(field) or ()]
+        attachments = get('attachments')
+        body = get('text_body') or get('body')
+
+        self.db.execute(UPSERT, (
+            item.id,
+            mailbox.lower(),
+            folder,
+            received.isoformat() if received else None,
+            get('subject'),
+            address(get('sender')),
+            '\n'.join(address(r) for r in recipients) if recipients else None,
+            '\n'.join(a.name or '' for a in attachments) if attachments else None,
+            str(body) if body else None,
+        ))
+        self.changed()
+
+    def remove(self, id):
+        """
+            Drop a mail from the index.
+            :param id:
+            :return:
+        """
+
+        self.db.execute('DELETE FROM mails WHERE id = ?', (id,))
+        self.changed()
+
+    def changed(self):
+        """
+            Count a change, committing once enough have piled up.
+            :return:
+        """
+
+        self.pending += 1
+        if self.pending >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+            Commit pending changes.
+            :return:
+        """
+
+        self.db.commit()
+        self.pending = 0
+
+    def search(self, query, limit=None, mailbox=None):
+        """
+            Run an FTS5 query against the index, best matches first.
+            Yields dicts with the mail details and a snippet of the match.
+            Raises sqlite3.OperationalError for a malformed query.
+            :param query:
+            :param limit:
+            :param mailbox:
+            :return:
+        """
+
+        sql = '''
+            SELECT m.id, m.mailbox, m.folder, m.received, m.subject, m.sender, m.recipients, m.attachments,
+                   snippet(mails_fts, -1, '[', ']', '...', 12)
+            FROM mails_fts JOIN mails m ON m.rowid = mails_fts.rowid
+            WHERE mails_fts MATCH ?
+        '''
+        params = [query]
+        if mailbox:
+            sql += ' AND m.mailbox = ?'
+            params.append(mailbox.lower())
+        sql += ' ORDER BY bm25(mails_fts)'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        columns = ('id', 'mailbox', 'folder', 'received', 'subject', 'sender', 'recipients', 'attachments', 'snippet')
+        for row in self.db.execute(sql, params):
+            yield dict(zip(columns, row))
+
+    def close(self):
+        """
+            Commit and close the index file.
+            :return:
+        """
+
+        self.flush()
+        self.db.close()
@@ -0,0 +1,283 @@
+import json
+import shlex
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# keys a job in a job file can have
+JOB_KEYS = ('name', 'command', 'args', 'delegates', 'after')
+
+
+class JobSkipped(Exception):
+    pass
+
+
+class Job(object):
+    """
+        One command of a job file, with the arguments to run it with and
+        the names of the jobs that have to finish before it starts.
+    """
+
+    def __init__(self, name, command, argv, after=()):
+        self.name = name
+        self.command = command
+        self.argv = argv
+        self.after = tuple(after)
+
+    def __repr__(self):
+        return '<Job {0}: {1} {2}>'.format(self.name, ' '.join(self.command), ' '.join(self.argv))
+
+
+def job_argv(args):
+    """
+        Turn the args of a job into command line arguments. They can be
+        a list, a string split like a shell would, or a mapping of option
+        names to values: True for a flag, a list to give an option more
+        than once, False or None to leave it out.
+        :param args:
+        :return:
+    """
+
+    if args is None:
+        return []
+    if isinstance(args, str):
+        return shlex.split(args)
+    if isinstance(args, list):
+        return [str(a) for a in args]
+    if not isinstance(args, dict):
+        raise ValueError(f'args must be a list, string or mapping, not {type(args).__name__}')
+
+    argv = []
+    for key, value in args.items():
+        option = '--' + str(key).lstrip('-').replace('_', '-')
+        for v in value if isinstance(value, list) else [value]:
+            if v is True:
+                argv.append(option)
+            elif v is not None and v is not False:
+                argv.extend((option, str(v)))
+
+    return argv
+
+
+def parse_jobs(data):
+    """
+        Build the Jobs described by the contents of a job file.
+
+        Every job names a command, like `gal` or `mail read`, and may
+        give it args. A job with a list of delegates is run once for
+        every mailbox in it with --delegate set. Jobs wait for the jobs
+        named in their after list, everything else is free to run at
+        the same time.
+        Raises ValueError when the jobs do not make sense.
+        :param data:
+        :return:
+    """
+
+    entries = data.get('jobs') if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('A job file needs a list of jobs')
+
+    jobs, groups = [], {}
+    for i, entry in enumerate(entries, start=1):
+        if isinstance(entry, str):
+            entry = {'command': entry}
+        if not isinstance(entry, dict) or not entry.get('command'):
+            raise ValueError(f'Job {i} does not name a command')
+        unknown = set(entry) - set(JOB_KEYS)
+        if unknown:
+            raise ValueError(f'Job {i} has unknown keys: {", ".join(sorted(map(str, unknown)))}')
+
+        command = tuple(str(entry['command']).split())
+        name = str(entry.get('name') or f'{" ".join(command)} #{i}')
+        if name in groups:
+            raise ValueError(f'There is more than one job named {name}')
+
+        after = entry.get('after') or []
+        after = [str(a) for a in (after if isinstance(after, list) else [after])]
+        argv = job_argv(entry.get('args'))
+
+        delegates = entry.get('delegates')
+        if delegates:
+            delegates = delegates if isinstance(delegates, list) else [delegates]
+            groups[name] = [Job(f'{name}[{d}]', command, argv + ['--delegate', str(d)], after) for d in delegates]
+        else:
+            groups[name] = [Job(name, command, argv, after)]
+        jobs.extend(groups[name])
+
+    # after may name a job with delegates, which means waiting for every one of them
+    for job in jobs:
+        for a in job.after:
+            if a not in groups:
+                raise ValueError(f'{job.name} comes after {a}, but there is no job with that name')
+        job.after = tuple(j.name for a in job.after for j in groups[a])
+
+    check_order(jobs)
+    return jobs
+
+
+def check_order(jobs):
+    """
+        Make sure no job waits on itself, through any number of others.
+        Raises ValueError when one does.
+        :param jobs:
+        :return:
+    """
+
+    after = {job.name: job.after for job in jobs}
+    done = set()
+    for job in jobs:
+        path, todo = set(), [(job.name, False)]
+        while todo:
+            name, finished = todo.pop()
+            if finished:
+                path.discard(name)
+                done.add(name)
+                continue
+            if name in done:
+                continue
+            if name in path:
+                raise ValueError(f'{name} ends up waiting on itself')
+            path.add(name)
+            todo.append((name, True))
+            todo.extend((a, False) for a in after[name])
+
+
+def load_jobs(f):
+    """
+        Read the Jobs in a YAML or JSON job file.
+        Raises ValueError when they can not be read or do not make sense.
+        :param f:
+        :return:
+    """
+
+    if getattr(f, 'name', '').lower().endswith('.json'):
+        return parse_jobs(json.load(f))
+
+    import yaml as yamllib
+
+    try:
+        data = yamllib.safe_load(f)
+    except yamllib.YAMLError as e:
+        raise ValueError(f'Could not read the job file: {e}')
+
+    return parse_jobs(data)
+
+
+def run_jobs(jobs, func, workers=1):
+    """
+        Call func for every job, at most `workers` at a time, starting
+        each one as soon as the jobs it comes after are done. Yields
+        (job, exception or None) tuples as jobs finish. Jobs after one
+        that failed are not started and come back with a JobSkipped.
+        :param jobs:
+        :param func:
+        :param workers:
+        :return:
+    """
+
+    waiting = list(jobs)
+    # job name to whether it succeeded
+    finished = {}
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = {}
+        while waiting or pending:
+            for job in list(waiting):
+                failed = [a for a in job.after if finished.get(a) is False]
+                if failed:
+                    waiting.remove(job)
+                    finished[job.name] = False
+                    yield job, JobSkipped(f'{", ".join(failed)} did not finish')
+                elif len(pending) < workers and all(a in finished for a in job.after):
+                    waiting.remove(job)
+                    pending[executor.submit(func, job)] = job
+
+            if not pending:
+                # skipping a job may have failed others, look at what is left again
+                continue
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                error = future.exception()
+                finished[job.name] = error is None
+                yield job, error
+
+
+class JobOutput(object):
+    """
+        Stands in for stdout or stderr while jobs run side by side, so
+        their output does not get mixed up mid line. Every line a job
+        prints is written in one go, with the name of the job in front.
+        Output from outside a job is passed through as it is.
+    """
+
+    # shared by stdout and stderr, they often end up on the same terminal
+    lock = threading.Lock()
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix is None:
+            with self.lock:
+                return self.stream.write(text)
+
+        *lines, self.local.pending = (self.local.pending + text).split('\n')
+        if lines:
+            with self.lock:
+                self.stream.write(''.join(f'{prefix}{line}\n' for line in lines))
+                self.stream.flush()
+
+        return len(text)
+
+    def start(self, name):
+        """
+            Prefix what the current thread prints with a job name.
+            :param name:
+            :return:
+        """
+
+        self.local.prefix = f'[{name}] '
+        self.local.pending = ''
+
+    def stop(self):
+        """
+            Write what is left of the current thread's last line, and
+            stop prefixing its output.
+            :return:
+        """
+
+        if getattr(self.local, 'prefix', None) is None:
+            return
+        if self.local.pending:
+            self.write('\n')
+        self.local.prefix = None
+
+
+class JobStreams(object):
+    """
+        Swaps stdout and stderr for JobOutputs while jobs run.
+    """
+
+    def __enter__(self):
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        self.outputs = JobOutput(self.stdout), JobOutput(self.stderr)
+        sys.stdout, sys.stderr = self.outputs
+        return self
+
+    def __exit__(self, *exc):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def start(self, name):
+        for output in self.outputs:
+            output.start(name)
+
+    def stop(self):
+        for output in self.outputs:
+            output.stop()
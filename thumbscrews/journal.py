@@ -0,0 +1,124 @@
+import inspect
+import json
+import os
+import threading
+
+
+class Journal(object):
+    """
+        An append-only record of finished units of work for the bulk
+        commands, so an interrupted run can pick up where it stopped.
+
+        Every finished unit is written as a single JSON line and synced
+        to disk before the next one is recorded. A line cut short by a
+        crash is ignored when the file is loaded again.
+
+        Results must be JSON serialisable. A dict result with a truthy
+        'transient' key is not recorded, so that unit is tried again on
+        the next run (used for connection failures).
+    """
+
+    def __init__(self, path=None, scope=None):
+        self.path = path
+        self.scope = scope
+        self.done = {}
+        self.lock = threading.Lock()
+        self.fh = None
+
+        if not path:
+            return
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = f.read()
+
+            for line in data.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('scope') == scope:
+                    self.done[record['unit']] = record['result']
+        else:
+            data = ''
+
+        self.fh = open(path, 'a')
+        if data and not data.endswith('\n'):
+            # start on a fresh line after a record that was cut short
+            self.fh.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.done)
+
+    def __contains__(self, unit):
+        return unit in self.done
+
+    def record(self, unit, result):
+        """
+            Append a finished unit to the journal.
+            :param unit:
+            :param result:
+            :return:
+        """
+
+        with self.lock:
+            self.done[unit] = result
+            if self.fh is None:
+                return
+
+            self.fh.write(json.dumps({'scope': self.scope, 'unit': unit, 'result': result}) + '\n')
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def wrap(self, func):
+        """
+            Wrap a unit of work so finished units are replayed from the
+            journal and new ones are recorded once they complete.
+            Coroutine functions are wrapped as coroutine functions.
+            :param func:
+            :return:
+        """
+
+        if self.fh is None:
+            return func
+
+        if inspect.iscoroutinefunction(func):
+            async def wrapped(unit):
+                if unit in self.done:
+                    return self.done[unit]
+
+                result = await func(unit)
+                if not (isinstance(result, dict) and result.get('transient')):
+                    self.record(unit, result)
+                return result
+
+            return wrapped
+
+        def wrapped(unit):
+            if unit in self.done:
+                return self.done[unit]
+
+            result = func(unit)
+            if not (isinstance(result, dict) and result.get('transient')):
+                self.record(unit, result)
+            return result
+
+        return wrapped
+
+    def close(self):
+        """
+            Close the journal file.
+            :return:
+        """
+
+        if self.fh is None:
+            return
+
+        self.fh.close()
+        self.fh = None
@@ -0,0 +1,245 @@
+import hashlib
+import itertools
+import os
+import tempfile
+
+from thumbscrews.store import STATE_DIR
+from thumbscrews.tbestate import tbestate
+
+# the fields `mail read` prints, everything else is left on the server
+READ_FIELDS = ('subject', 'sender', 'received_by', 'has_attachments', 'attachments')
+# fields for listing mail without pulling bodies or attachments
+HEADER_FIELDS = ('subject', 'sender', 'received_by', 'datetime_received', 'has_attachments')
+# the fields `mail getattachments` needs
+ATTACHMENT_FIELDS = ('subject', 'sender', 'received_by', 'attachments')
+
+# read size when streaming attachment content to disk
+BUFFER_SIZE = 1024 * 1024
+# deduplicated attachments are kept in here, named by content hash
+BLOB_DIR = 'blobs'
+# maps messages and attachment names to blobs
+MANIFEST = 'manifest.jsonl'
+# where `mail sync` keeps the sync state of every folder
+SYNC_PATH = os.path.join(STATE_DIR, 'sync.json')
+
+
+def project(qs, fields=None, page_size=None, chunk_size=None):
+    """
+        Restrict a QuerySet to the given item fields and set how many
+        items are requested per FindItem page and GetItem chunk.
+
+        QuerySets are not cached, so as long as the caller handles one
+        item at a time memory use stays flat however many are fetched.
+        Raises ValueError when a field is not valid for the folder.
+        :param qs:
+        :param fields:
+        :param page_size:
+        :param chunk_size:
+        :return:
+    """
+
+    if fields:
+        qs = qs.only(*fields)
+    if page_size:
+        qs.page_size = page_size
+    if chunk_size:
+        qs.chunk_size = chunk_size
+
+    return qs
+
+
+def read_ids(f):
+    """
+        Yield the item IDs in a file, one per line. Blank lines and lines
+        starting with # are skipped, and so is an `ID: ` prefix, so the
+        ID lines `mail read` prints can be fed straight back in.
+        :param f:
+        :return:
+    """
+
+    for line in f:
+        line = line.strip()
+        if line.startswith('ID:'):
+            line = line[len('ID:'):].strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def fetch_items(account, ids, fields=None, chunk_size=None):
+    """
+        Fetch items by ID with batched GetItem requests of chunk_size
+        items each, yielding (id, item) tuples in the order of ids. The
+        item is an exception when the server could not return it, like
+        ErrorItemNotFound for an ID that no longer exists.
+
+        ids are read one batch at a time, so a long ID list is never
+        held in memory all at once.
+        Raises ValueError when a field is not valid for an item.
+        :param account:
+        :param ids:
+        :param fields:
+        :param chunk_size:
+        :return:
+    """
+
+    from exchangelib.properties import ItemId
+    from exchangelib.services import GetItem
+
+    chunk_size = chunk_size or GetItem.CHUNK_SIZE
+    ids = iter(ids)
+    while True:
+        batch = list(itertools.islice(ids, chunk_size))
+        if not batch:
+            break
+        # plain strings would be taken for (id, changekey) tuples
+        items = account.fetch(ids=[ItemId(id=i) for i in batch], only_fields=fields, chunk_size=chunk_size)
+        yield from zip(batch, items)
+
+
+def address(mailbox):
+    """
+        Return a printable 'Name <address>' for a Mailbox, None if there
+        is none.
+        :param mailbox:
+        :return:
+    """
+
+    if mailbox is None:
+        return None
+    if mailbox.name and mailbox.email_address:
+        return f'{mailbox.name} <{mailbox.email_address}>'
+
+    return mailbox.name or mailbox.email_address
+
+
+def split_fields(value):
+    """
+        Split a comma separated --fields value into field names.
+        :param value:
+        :return:
+    """
+
+    if not value:
+        return None
+
+    return tuple(f.strip() for f in value.split(',') if f.strip())
+
+
+def save_attachment(attachment, local_path, buffer_size=BUFFER_SIZE):
+    """
+        Stream a FileAttachment to disk without holding it in memory.
+        Returns the sha256 hex digest and size of the content.
+        :param attachment:
+        :param local_path:
+        :param buffer_size:
+        :return:
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(local_path, 'wb') as f, attachment.fp as fp:
+        buffer = fp.read(buffer_size)
+        while buffer:
+            digest.update(buffer)
+            size += len(buffer)
+            f.write(buffer)
+            buffer = fp.read(buffer_size)
+
+    return digest.hexdigest(), size
+
+
+def store_blob(attachment, path, buffer_size=BUFFER_SIZE):
+    """
+        Save a FileAttachment into the content addressed store under
+        path/blobs, named after the sha256 of its content, so the same
+        file attached to many mails is only kept once.
+        Returns (blob path, sha256, size, True if the blob is new).
+        :param attachment:
+        :param path:
+        :param buffer_size:
+        :return:
+    """
+
+    blobs = os.path.join(path, BLOB_DIR)
+    os.makedirs(blobs, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=blobs, suffix='.part')
+    os.close(fd)
+    try:
+        digest, size = save_attachment(attachment, tmp, buffer_size)
+        blob = os.path.join(blobs, digest)
+        if os.path.exists(blob):
+            os.remove(tmp)
+            return blob, digest, size, False
+
+        os.replace(tmp, blob)
+        return blob, digest, size, True
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def sync_key(folder):
+    """
+        Return the key a folder's sync state is stored under. What a
+        delegate is shown of a folder depends on who they are, so the
+        user is part of it, like for hierarchy_key().
+        :param folder:
+        :return:
+    """
+
+    return '{0}|{1}|{2}'.format((tbestate.username or '').lower(), folder.account.primary_smtp_address.lower(),
+                                folder.id)
+
+
+def sync_pages(folder, sync_state=None, only_fields=None, max_changes=None):
+    """
+        Walk the changes to a folder since sync_state with SyncFolderItems,
+        yielding (changes, sync_state) for every page.
+
+        The sync state after each page is handed out straight away, so it
+        can be saved before the next page is requested and an interrupted
+        sync only repeats the page it was on. Without a sync state the
+        whole folder comes back as created items. A page the server could
+        not answer, like for a sync state it no longer accepts, comes back
+        as a list with the exception in it.
+        Raises ValueError when a field is not valid for the folder.
+        :param folder:
+        :param sync_state:
+        :param only_fields:
+        :param max_changes:
+        :return:
+    """
+
+    # imported here so the option defaults above can be read without loading exchangelib
+    from exchangelib.errors import ErrorInvalidSyncStateData
+    from exchangelib.fields import FieldPath
+    from exchangelib.items import ID_ONLY
+    from exchangelib.services import SyncFolderItems
+
+    version = folder.account.version
+    if only_fields is None:
+        additional_fields = {FieldPath(field=f) for f in folder.allowed_item_fields(version=version)}
+    else:
+        for field in only_fields:
+            folder.validate_item_field(field=field, version=version)
+        # ids and changekeys always come back
+        additional_fields = {f for f in folder.normalize_fields(fields=only_fields) if not f.field.is_attribute}
+
+    svc = SyncFolderItems(account=folder.account)
+    while True:
+        try:
+            changes = list(svc.call(folder=folder, shape=ID_ONLY, additional_fields=additional_fields,
+                                    sync_state=sync_state, ignore=None, max_changes_returned=max_changes,
+                                    sync_scope=None))
+        except ErrorInvalidSyncStateData as e:
+            # handed out like the errors the service returns in place of changes, with the state unchanged
+            yield [e], sync_state
+            break
+        # the server sometimes hands back the same state without flagging the last page
+        done = svc.includes_last_item_in_range or svc.sync_state == sync_state
+        sync_state = svc.sync_state
+        yield changes, sync_state
+        if done:
+            break
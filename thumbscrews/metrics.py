@@ -0,0 +1,285 @@
+import bisect
+import collections
+import functools
+import json
+import re
+import threading
+import time
+
+import click
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+# the first element in the SOAP body names the operation
+OPERATION_REGEX = re.compile(rb'<(?:\w+:)?Body[^>]*>\s*<(?:\w+:)?(\w+)')
+
+
+def operation(data):
+    """
+        Return the name of the EWS operation in a SOAP request.
+        :param data:
+        :return:
+    """
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    match = OPERATION_REGEX.search(data or b'')
+    if match is None:
+        return 'Unknown'
+
+    name = match.group(1).decode()
+    # autodiscover names its requests like GetUserSettingsRequestMessage
+    return name[:-len('RequestMessage')] if name.endswith('RequestMessage') else name
+
+
+class Counter(object):
+    """
+        Request counters for one operation.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.sent = 0
+        self.received = 0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, seconds, sent, received, error):
+        self.requests += 1
+        self.errors += bool(error)
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.sent += sent
+        self.received += received
+        self.histogram[bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+
+    def percentile(self, p):
+        """
+            Return the upper bound of the bucket the p-th percentile
+            request falls in, in milliseconds. None for the last,
+            unbounded bucket.
+            :param p:
+            :return:
+        """
+
+        rank = p / 100 * self.requests
+        seen = 0
+        for bound, count in zip(BUCKETS, self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return bound if bound != float('inf') else None
+        return 0
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'seconds': round(self.seconds, 3),
+            'mean_ms': round(self.seconds * 1000 / self.requests, 1) if self.requests else 0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'max_ms': round(self.max * 1000, 1),
+            'bytes_sent': self.sent,
+            'bytes_received': self.received,
+            'histogram': self.histogram,
+        }
+
+
+class Metrics(object):
+    """
+        Counts the EWS requests of a run: requests, latency, bytes and
+        errors per operation, plus retries and the time spent backing
+        off from a busy server.
+
+        Nothing is recorded until start() is called, so without --stats
+        the only cost is an attribute check per request.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        self.operations = collections.defaultdict(Counter)
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+            Start recording. Requests exchangelib sends are only timed
+            once instrument() has wrapped it.
+            :return:
+        """
+
+        self.enabled = True
+        self.started = time.monotonic()
+
+    def record(self, op, seconds, sent=0, received=0, status=None, error=None):
+        """
+            Record a finished request.
+            :param op:
+            :param seconds:
+            :param sent:
+            :param received:
+            :param status:
+            :param error:
+            :return:
+        """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.operations[op].add(seconds, sent, received, error)
+            if status is not None:
+                self.statuses[status] += 1
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+
+    def retry(self, error):
+        """
+            Record a unit of work retried after a busy answer.
+            :param error:
+            :return:
+        """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.retries[type(error).__name__] += 1
+
+    def wait(self, seconds):
+        """
+            Record time spent waiting before starting a unit of work.
+            :param seconds:
+            :return:
+        """
+
+        if not self.enabled or not seconds:
+            return
+
+        with self.lock:
+            self.waited += seconds
+
+    def summary(self):
+        """
+            Return everything recorded as a JSON serialisable dict.
+            :return:
+        """
+
+        with self.lock:
+            wall = time.monotonic() - self.started if self.started else 0
+            total = Counter()
+            for counter in self.operations.values():
+                total.requests += counter.requests
+                total.errors += counter.errors
+                total.seconds += counter.seconds
+                total.max = max(total.max, counter.max)
+                total.sent += counter.sent
+                total.received += counter.received
+                total.histogram = [a + b for a, b in zip(total.histogram, counter.histogram)]
+
+            return {
+                'wall_seconds': round(wall, 3),
+                'requests_per_second': round(total.requests / wall, 1) if wall else 0,
+                'total': total.summary(),
+                'operations': {op: c.summary() for op, c in sorted(self.operations.items())},
+                'statuses': {str(k): v for k, v in sorted(self.statuses.items())},
+                'errors': dict(self.errors),
+                'retries': dict(self.retries),
+                'throttle_wait_seconds': round(self.waited, 3),
+                'histogram_buckets_ms': [b if b != float('inf') else None for b in BUCKETS],
+            }
+
+    def echo(self):
+        """
+            Print the summary to stderr.
+            :return:
+        """
+
+        summary = self.summary()
+        total = summary['total']
+        click.secho(f'\n[*] {total["requests"]} requests in {summary["wall_seconds"]}s, '
+                    f'{summary["requests_per_second"]} req/s, {total["bytes_sent"] / 1024:.1f} KB sent, '
+                    f'{total["bytes_received"] / 1024:.1f} KB received', fg='yellow', err=True)
+        if not total['requests']:
+            return
+
+        click.secho(f'    {"operation":<24} {"requests":>8} {"errors":>6} {"mean ms":>8} {"p50 ms":>7} '
+                    f'{"p95 ms":>7} {"max ms":>8} {"sent KB":>9} {"recv KB":>9}', dim=True, err=True)
+        for op, c in list(summary['operations'].items()) + [('total', total)]:
+            click.secho(f'    {op:<24} {c["requests"]:>8} {c["errors"]:>6} {c["mean_ms"]:>8} '
+                        f'{bound(c["p50_ms"]):>7} {bound(c["p95_ms"]):>7} {c["max_ms"]:>8} '
+                        f'{c["bytes_sent"] / 1024:>9.1f} {c["bytes_received"] / 1024:>9.1f}',
+                        err=True, bold=op == 'total')
+
+        histogram = '  '.join(f'{bound(b)}: {n}' for b, n in zip(BUCKETS, total['histogram']) if n)
+        click.secho(f'    latency   {histogram}', err=True)
+        if summary['statuses']:
+            click.secho('    status    ' + '  '.join(f'{k}: {v}' for k, v in summary['statuses'].items()), err=True)
+        if summary['errors']:
+            click.secho('    errors    ' + '  '.join(f'{k}: {v}' for k, v in summary['errors'].items()),
+                        fg='red', err=True)
+        if summary['retries'] or summary['throttle_wait_seconds']:
+            click.secho('    retries   ' + '  '.join(f'{k}: {v}' for k, v in summary['retries'].items())
+                        + f'  waited {summary["throttle_wait_seconds"]}s', fg='yellow', err=True)
+
+    def write(self, path):
+        """
+            Write the summary to a JSON file.
+            :param path:
+            :return:
+        """
+
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def bound(ms):
+    """
+        Format a histogram bucket bound for printing.
+        :param ms:
+        :return:
+    """
+
+    return f'>{BUCKETS[-2]}' if ms is None or ms == float('inf') else f'<{ms}'
+
+
+def instrument():
+    """
+        Wrap the function every exchangelib service sends its requests
+        through, so each one is timed and counted.
+        :return:
+    """
+
+    from exchangelib.services import common
+
+    post = common.post_ratelimited
+    if getattr(post, 'timed', False):
+        return
+
+    @functools.wraps(post)
+    def timed(protocol, session, url, headers, data, stream=False, timeout=None):
+        start = time.monotonic()
+        try:
+            r, session = post(protocol, session, url, headers, data, stream=stream, timeout=timeout)
+        except Exception as e:
+            metrics.record(operation(data), time.monotonic() - start, len(data), error=e)
+            raise
+
+        # streamed bodies are not read yet, count what the server says is coming
+        received = int(r.headers.get('Content-Length') or 0) if stream else len(r.content)
+        metrics.record(operation(data), time.monotonic() - start, len(data), received, r.status_code)
+        return r, session
+
+    timed.timed = True
+    common.post_ratelimited = timed
+
+
+metrics = Metrics()
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from thumbscrews.throttle import Scheduler
+
+
+def imap_bounded(func, items, workers=1, scheduler=None):
+    """
+        Call func for every item using at most `workers` threads,
+        yielding (item, result) tuples as each call finishes.
+
+        Only a bounded number of items are pulled from the iterable at
+        any time, so very long work lists (user files, email lists) are
+        never loaded into the executor all at once. With a single worker
+        everything runs in the calling thread, in order.
+
+        Every call goes through a Scheduler, which retries calls the
+        server was too busy for and lowers the number in flight while
+        it is being throttled.
+
+        Exceptions raised by func are re-raised in the calling thread.
+
+        :param func:
+        :param items:
+        :param workers:
+        :param scheduler:
+        :return:
+    """
+
+    if scheduler is None:
+        scheduler = Scheduler(workers)
+
+    if workers is None or workers <= 1:
+        for item in items:
+            yield item, scheduler.call(func, item)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def fill():
+            while len(pending) < scheduler.limit:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending[executor.submit(scheduler.call, func, item)] = item
+
+        fill()
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    yield item, future.result()
+                fill()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+
+# where thumbscr-ews keeps what it learns between runs
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.thumbscr-ews')
+
+
+class JsonStore(object):
+    """
+        A small JSON file of key/value pairs. Every update rewrites the
+        file through a temporary file, so a crash never leaves it half
+        written.
+    """
+
+    # writes may come from worker threads
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+            Read the whole store, an empty dict if there is none.
+            :return:
+        """
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key, default=None):
+        """
+            Return the value stored for a key.
+            :param key:
+            :param default:
+            :return:
+        """
+
+        return self.load().get(key, default)
+
+    def put(self, key, value):
+        """
+            Store a value, a value of None removes the key.
+            :param key:
+            :param value:
+            :return:
+        """
+
+        with self.lock:
+            data = self.load()
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(data, f, indent=2)
+                os.replace(tmp, self.path)
+            except OSError:
+                # state we cannot write just means more work next run
+                pass
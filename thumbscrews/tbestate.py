@@ -37,6 +37,12 @@ class TBEState(State):
         self.password = None
         self.user_agent = None
         self.exch_host = None
+        self.cache = True
+        self.cache_ttl = None
+        self.rate = None
+        self.verbose = False
+        self.stats = False
+        self.stats_file = None
 
         # arbitrary settings. This should not really be here
         # but hey...
@@ -0,0 +1,229 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+import click
+from exchangelib.errors import ErrorInternalServerTransientError, ErrorServerBusy, ErrorTooManyObjectsOpened
+from exchangelib.errors import SessionPoolMinSizeReached
+
+from thumbscrews.metrics import metrics
+from thumbscrews.tbestate import tbestate
+
+# errors meaning the server wants us to slow down, the same ones exchangelib backs off from
+BUSY_ERRORS = (ErrorServerBusy, ErrorTooManyObjectsOpened, ErrorInternalServerTransientError)
+# seconds to back off when the server did not say how long, doubled on every retry
+BACK_OFF = 10
+# times a unit of work is retried after the server said it was busy
+RETRIES = 5
+
+# schedulers shared by everything that talks to the same host during a run
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+
+def retry_after(response):
+    """
+        Return the Retry-After header of an HTTP response in seconds,
+        None if there is none.
+        :param response:
+        :return:
+    """
+
+    try:
+        return int(response.headers.get('Retry-After', '')) or None
+    except ValueError:
+        return None
+
+
+def hold_pool_size(protocol):
+    """
+        Stand-in for BaseProtocol.decrease_poolsize, which exchangelib
+        calls on every busy answer. It takes a session out of the pool
+        while holding the pool lock, and deadlocks when the pool is empty
+        but below its maximum size, so with several workers a throttled
+        run can hang. The Scheduler already lowers the number of requests
+        in flight, so the pool is left as it is.
+        :param protocol:
+        :return:
+    """
+
+    raise SessionPoolMinSizeReached('The session pool size is left to the scheduler')
+
+
+class TokenBucket(object):
+    """
+        Hands out `rate` tokens a second, with up to `burst` saved up.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+            Take a token, returning the seconds to wait before using it.
+            :return:
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+
+class Scheduler(object):
+    """
+        Paces the units of work of a bulk command against one host.
+
+        Concurrency is adapted AIMD style: every time the server says it
+        is busy the number of units in flight is halved and everything
+        waits out the back off the server asked for, and after a
+        window of successes it grows by one again, up to the number of
+        workers. With a rate, a token bucket also caps requests a second.
+    """
+
+    def __init__(self, workers=1, rate=None, retries=RETRIES):
+        self.workers = workers
+        self.limit = workers
+        self.bucket = TokenBucket(rate, workers) if rate else None
+        self.retries = retries
+        self.successes = 0
+        self.pause_until = 0
+        self.lock = threading.Lock()
+
+    def allow(self, workers):
+        """
+            Raise the number of units allowed in flight to workers, for a
+            command sharing the scheduler that asks for more than the one
+            that made it. It is never lowered, other commands may still
+            be running with theirs.
+            :param workers:
+            :return:
+        """
+
+        with self.lock:
+            if workers > self.workers:
+                self.limit += workers - self.workers
+                self.workers = workers
+                if self.bucket is not None:
+                    self.bucket.capacity = max(self.bucket.capacity, workers)
+
+    def delay(self):
+        """
+            Return the seconds to wait before starting the next unit.
+            :return:
+        """
+
+        with self.lock:
+            pause = max(0, self.pause_until - time.monotonic())
+
+        if self.bucket is not None:
+            pause = max(pause, self.bucket.reserve())
+        metrics.wait(pause)
+        return pause
+
+    def succeeded(self):
+        """
+            Additive increase, one more unit in flight per window of
+            successes.
+            :return:
+        """
+
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.successes = 0
+                self.limit = min(self.workers, self.limit + 1)
+
+    def throttled(self, back_off):
+        """
+            Multiplicative decrease, and hold everything for back_off
+            seconds.
+            :param back_off:
+            :return:
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            # units already in flight when the server pushed back count as the same push
+            if now >= self.pause_until:
+                self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            self.pause_until = max(self.pause_until, now + back_off)
+            limit = self.limit
+
+        click.secho(f'[!] Server is busy, backing off for {back_off}s with {limit} in flight', fg='yellow', err=True)
+
+    def call(self, func, item):
+        """
+            Run a unit of work, retrying it when the server is busy.
+            :param func:
+            :param item:
+            :return:
+        """
+
+        wait = BACK_OFF
+        for attempt in range(self.retries + 1):
+            time.sleep(self.delay())
+            try:
+                result = func(item)
+            except BUSY_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                metrics.retry(e)
+                self.throttled(getattr(e, 'back_off', None) or wait)
+                wait *= 2
+                continue
+
+            self.succeeded()
+            return result
+
+    async def acall(self, func, item):
+        """
+            call() for coroutine functions.
+            :param func:
+            :param item:
+            :return:
+        """
+
+        wait = BACK_OFF
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(self.delay())
+            try:
+                result = await func(item)
+            except BUSY_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                metrics.retry(e)
+                self.throttled(getattr(e, 'back_off', None) or wait)
+                wait *= 2
+                continue
+
+            self.succeeded()
+            return result
+
+
+def get_scheduler(workers=1, endpoint=None):
+    """
+        Return the scheduler for the host of an endpoint, shared by every
+        bulk operation against that host in this run, allowing at least
+        `workers` units in flight. --rate sets the requests a second
+        allowed per host.
+        :param workers:
+        :param endpoint:
+        :return:
+    """
+
+    host = (urlparse(endpoint).netloc if endpoint and '//' in endpoint else endpoint) or ''
+    with schedulers_lock:
+        if host not in schedulers:
+            schedulers[host] = Scheduler(workers, tbestate.rate)
+        else:
+            schedulers[host].allow(workers)
+        return schedulers[host]